@@ -1,70 +1,109 @@
 import os
-import cv2
+import argparse
 import numpy as np
 import pyrealsense2 as rs
 
 from utils import viewer
 from utils import logger
-from auto_exposure import AE
+from utils import device_profile
+from utils import frame_source
+from utils import telemetry
+from utils import segment_writer
+from utils import buffer_pool
+from utils import session_config
+from utils.recorder import ConcurrentRecorder
+from auto_exposure import AE_ALGORITHMS, create_ae, next_exposure
 from colorama import Fore, Style, init
 
 if __name__ == "__main__":
-    pipeline = rs.pipeline()
-    config = rs.config()
-    
-    # setting for streams
-    framerate = 15
-    image_resolution = [1280, 720]
-    config.enable_stream(rs.stream.color, image_resolution[0], image_resolution[1], rs.format.bgr8, framerate)
-    
-    # config
-    pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-    pipeline_profile = config.resolve(pipeline_wrapper)
-    device = pipeline_profile.get_device()
-    device_product_line = str(device.get_info(rs.camera_info.product_line))
-    print("[INFO] Device type:",device_product_line)
-
-    # check sensor
-    found_rgb = False
-    found_depth = False
-    found_imu = False
-    rgb_sensor_index = None
-    depth_sensor_index = None
-    imu_sensor_index = None
-    for i, s in enumerate(device.query_sensors()):
-        print("[INFO] Sensor name:", s)
-        if s.get_info(rs.camera_info.name) == 'RGB Camera':
-            found_rgb = True
-            rgb_sensor_index = i
-            print("[INFO] RGB camera sensor is sucessfully detected!")
-        if s.get_info(rs.camera_info.name) == 'Stereo Module':
-            found_depth = True
-            depth_sensor_index = i
-            print("[INFO] Depth camera sensor is sucessfully detected!")
-        if s.get_info(rs.camera_info.name) == 'Motion Module':
-            found_imu = True
-            imu_sensor_index = i
-            print("[INFO] Motion sensor is sucessfully detected!")
-        else:
-            pass
-    if not found_rgb:
-        print("[ERROR] Can't find RGB camera sensor!")
-        exit(0)
-    if not found_depth:
-        print("[ERROR] Can't find Depth camera sensor!")
-        exit(0)
-    if not found_imu:
-        print("[ERROR] Can't find motion sensor!")
-        exit(0)
+    parser = argparse.ArgumentParser(description="Record color stream with the custom auto exposure algorithm.")
+    parser.add_argument("--source", choices=["camera", "synthetic"], default="camera",
+                        help="Frame source, synthetic runs the AE loop without a camera")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="Run capture, auto exposure and display in separate threads")
+    parser.add_argument("--ae", choices=list(AE_ALGORITHMS),
+                        help="Auto exposure engine, baseline (default) is the original closed-form controller")
+    parser.add_argument("--preview-fps", type=float, help="Preview refresh rate, 0 shows every frame")
+    parser.add_argument("--preview-scale", type=float, help="Downscale factor of the preview")
+    parser.add_argument("--headless", action="store_true", help="No preview window, stop with Ctrl+C")
+    parser.add_argument("--record", choices=["bag", "segments"],
+                        help="data.bag written by librealsense, or buffered segment files from a writer thread")
+    parser.add_argument("--ring-frames", type=int, help="Frames the segment writer buffers in memory")
+    parser.add_argument("--drop-policy", choices=list(segment_writer.DROP_POLICIES),
+                        help="Frame dropped when the segment writer falls behind and the buffer is full")
+    parser.add_argument("--segment-mb", type=float, help="Start a new segment after this many MB")
+    parser.add_argument("--segment-sec", type=float, help="Start a new segment after this many seconds")
+    parser.add_argument("--refresh-profile", action="store_true",
+                        help="Query the camera again instead of loading the cached device profile")
+    session_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    # stream profiles, AE parameters and output location, flags left out keep the configured values
+    config = session_config.from_args(args, session_config.defaults(), {
+        "ae": "ae.algorithm", "preview_fps": "preview.fps", "preview_scale": "preview.scale",
+        "record": "record.format", "ring_frames": "record.ring_frames", "drop_policy": "record.drop_policy",
+        "segment_mb": "record.segment_mb", "segment_sec": "record.segment_sec"})
+    if args.headless:
+        config.set("stages.preview", "off")
+    # color only, AE needs no depth
+    config.set("streams.depth.enabled", False)
+    color_stream = config.stream("color")
+    framerate = color_stream[4]
+    record = config["record"]
+
+    if args.dry_run:
+        valid = session_config.dry_run(config, frame_source.find_device() if args.source == "camera" else None,
+                                       args.refresh_profile)
+        raise SystemExit(0 if valid else 1)
+    # a bad stage mode, format or drop policy from a config file fails here, not deep in the run
+    errors = config.errors()
+    if errors:
+        for error in errors:
+            print("[ERROR] " + error)
+        raise SystemExit(1)
+    logger.set_work_dir(config.work_dir())
+    config.save()
+
+    if args.source == "synthetic":
+        # camera-free run, the synthetic scene responds to the exposure we set
+        source = frame_source.SyntheticSource(color_stream[1], color_stream[2], framerate,
+                                              depth=False, realtime=True)
+        color_sensor = source.get_color_sensor()
+        exposure_range = color_sensor.get_option_range(rs.option.exposure)
+    else:
+        # sensor indices, option ranges and intrinsics come from the per-device profile cache
+        device = frame_source.find_device()
+        profile, device_sensors = device_profile.load_device_profile(device, [color_stream],
+                                                                     refresh=args.refresh_profile)
+        print("[INFO] Device type:", profile.product_line)
+
+        source = frame_source.LiveCameraSource(serial=profile.serial)
+        source.enable_stream(*color_stream)
+
+        if record["format"] == "bag":
+            logger.set_record_to_bag_file(source.config)
+        logger.save_device_profile(profile, device_profile.stream_key(*color_stream))
+        color_sensor = device_sensors[profile.rgb_index]
+        exposure_range = profile.option_range("rgb", "exposure")
 
     # Initialize logger
-    exposure_time_saver = logger.ExposureTimeSaver()
-    timestamps_saver = logger.TimeStampSaver()
-    logger.set_record_to_bag_file(config)
-    logger.save_sensor_intrinsics(pipeline_profile, rs.stream.color)
+    exposure_time_saver = logger.ExposureTimeSaver(background=True)
+    timestamps_saver = logger.TimeStampSaver(background=True)
+    # preview window, created once and throttled to --preview-fps
+    preview = viewer.Viewer(viewer.EXPOSURE_WINDOW, config["preview"]["fps"], config["preview"]["scale"],
+                            not config.live("preview"))
+    # drops, latency and stage timings, summarized next to data.bag
+    # (only the logging stage runs on the capture thread of the concurrent recorder)
+    capture_telemetry = telemetry.CaptureTelemetry(framerate, os.path.join(logger.WORK_DIR, telemetry.SUMMARY_FILE),
+                                                   busy_stages=("logging",) if args.concurrent else None)
+    # buffered recording, frames are copied into a ring and written by a background thread
+    frame_writer = None
+    if record["format"] == "segments":
+        frame_writer = segment_writer.SegmentWriter(os.path.join(logger.WORK_DIR, "segments"), record["ring_frames"],
+                                                    record["drop_policy"], max_segment_bytes=int(record["segment_mb"] * 1e6),
+                                                    max_segment_sec=record["segment_sec"], telemetry=capture_telemetry)
 
     # set sensor option
-    color_sensor = pipeline_profile.get_device().query_sensors()[rgb_sensor_index]
     color_sensor.set_option(rs.option.enable_auto_exposure, False)
     color_sensor.set_option(rs.option.enable_auto_white_balance, False)
     color_sensor.set_option(rs.option.power_line_frequency, 1)
@@ -72,7 +111,6 @@ if __name__ == "__main__":
 
     # calculate exposure time range
     # indoor_flicker_freq = 50
-    exposure_range = color_sensor.get_option_range(rs.option.exposure)
     max_exposure_time = min(1 / framerate * 1e3, exposure_range.max * 0.1) - 2
     min_exposure_time = exposure_range.min
     # min_exposure_time = max((1 / (indoor_flicker_freq * 2)) * 1e3, exposure_range.min * 0.1) - 5
@@ -80,11 +118,11 @@ if __name__ == "__main__":
     print(f"exposure time max: {round(max_exposure_time, 1)} msec")
 
     # start pipeline
-    pipeline.start(config)
+    source.start()
 
     # initialize Auto Exposure algorithm
     try:
-        while True:
+        while args.source == "camera":
             user_input = input(Fore.GREEN + "Are you ready to determine the initial target brightness for AE now?").lower()
             if user_input == 'y':
                 break
@@ -93,56 +131,85 @@ if __name__ == "__main__":
             else:
                 print(Fore.RED + "[ERROR] Invalid input. Please enter 'y' or 'n'!")
     finally:
-        intial_exposure_time = 25
+        intial_exposure_time = config["exposure"]["initial_ms"]
         color_sensor.set_option(rs.option.exposure, intial_exposure_time * 10)
-        frames = pipeline.wait_for_frames()
+        frames = source.wait_for_frames()
         color_frame = frames.get_color_frame()
         color_image = np.asanyarray(color_frame.get_data())
-        auto_exposure = AE(intial_exposure_time, max_exposure_time, min_exposure_time, color_image)
+        ae_options = dict(config["ae"])
+        auto_exposure = create_ae(ae_options.pop("algorithm"), intial_exposure_time, max_exposure_time,
+                                  min_exposure_time, color_image, **ae_options)
         print(Fore.WHITE + "[INFO] Initial exposure time: ", intial_exposure_time)
         print("[INFO] Initialial brightness: ",auto_exposure.w_avg_bright)
         print("[INFO] Successfully intialize auto-exposure algorithm.")
 
     # loop collect data
     try:
-        next_exposure_time = intial_exposure_time * 10
-        while True:
-            # set exposure time 
-            manual_exposure_time = next_exposure_time
-            color_sensor.set_option(rs.option.exposure, manual_exposure_time)
-
-            # Wait for a frames metadata
-            frames = pipeline.wait_for_frames()
-            color_frame = frames.get_color_frame()
-            if not color_frame:
-                continue
-
-            # Convert images to numpy arrays
-            color_image = np.asanyarray(color_frame.get_data())
-
-            # get actual exposure time
-            actual_exp_time = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
-            exposure_time_saver.save_exposure_time(actual_exp_time / 10)
-            # print("[INFO] Actual exposure time:", (actual_exp_time / 10), "msec")
-
-            # get timestamp
-            color_sensor_timestamp_domain = color_frame.get_frame_timestamp_domain()
-            color_sensor_timestamp = color_frame.get_timestamp() / 1000
-            timestamps_saver.save_timestamps(color_sensor_timestamp)
-
-            # calculate exposure time for next frame
-            next_exposure_time = auto_exposure.adjust_exposure(color_image, manual_exposure_time)
-            # print("[INFO] exposure time for next frame", next_exposure_time, "msec")
-
-            # Show images
-            viewer.visualizer(color_image, actual_exp_time, auto_exposure.w_avg_bright, color_sensor_timestamp)
-
-            key = cv2.waitKey(1)
-            if key & 0xFF == ord('q') or key == 27:
-                cv2.destroyAllWindows()
-                break
+        if args.concurrent:
+            recorder = ConcurrentRecorder(source, color_sensor, auto_exposure, intial_exposure_time * 10,
+                                          exposure_time_saver, timestamps_saver, telemetry=capture_telemetry,
+                                          preview=preview, frame_writer=frame_writer)
+            recorder.run()
+        else:
+            next_exposure_time = intial_exposure_time * 10
+            while True:
+                # set exposure time 
+                manual_exposure_time = next_exposure_time
+                color_sensor.set_option(rs.option.exposure, manual_exposure_time)
+
+                # Wait for a frames metadata
+                with capture_telemetry.stage("wait"):
+                    frames = source.wait_for_frames()
+                color_frame = frames.get_color_frame()
+                if not color_frame:
+                    continue
+
+                # Convert images to numpy arrays
+                color_image = np.asanyarray(color_frame.get_data())
+
+                # get actual exposure time
+                actual_exp_time = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+
+                # get timestamp
+                color_sensor_timestamp_domain = color_frame.get_frame_timestamp_domain()
+                color_sensor_timestamp = color_frame.get_timestamp() / 1000
+                capture_telemetry.frame(color_frame.get_frame_number(), color_sensor_timestamp)
+
+                with capture_telemetry.stage("logging"):
+                    exposure_time_saver.save_exposure_time(actual_exp_time / 10)
+                    # print("[INFO] Actual exposure time:", (actual_exp_time / 10), "msec")
+                    timestamps_saver.save_timestamps(color_sensor_timestamp)
+                    if frame_writer is not None:
+                        frame_writer.push(color_image, None, color_sensor_timestamp, exposure=actual_exp_time,
+                                          frame_number=color_frame.get_frame_number())
+
+                # calculate exposure time for next frame
+                with capture_telemetry.stage("ae"):
+                    next_exposure_time = next_exposure(auto_exposure, color_image, manual_exposure_time, actual_exp_time)
+                # print("[INFO] exposure time for next frame", next_exposure_time, "msec")
+
+                # Show images
+                if preview.due():
+                    with capture_telemetry.stage("display"):
+                        overlay = capture_telemetry.overlay_lines()
+                        if frame_writer is not None:
+                            overlay += frame_writer.overlay_lines()
+                        key = preview.show_exposure(color_image, actual_exp_time, auto_exposure.w_avg_bright,
+                                                    color_sensor_timestamp, overlay)
+                    if key & 0xFF == ord('q') or key == 27:
+                        preview.close()
+                        break
+    except KeyboardInterrupt:
+        print("[INFO] Stopped")
     except Exception as e:
         print("[ERROR] ",e)
     finally:
         # Stop streaming
-        pipeline.stop()
\ No newline at end of file
+        source.stop()
+        # Flush buffered metadata
+        exposure_time_saver.close()
+        timestamps_saver.close()
+        if frame_writer is not None:
+            frame_writer.close()
+        capture_telemetry.report()
+        print("[INFO] " + buffer_pool.default_pool.summary())
\ No newline at end of file
@@ -0,0 +1,391 @@
+import os
+import ast
+import csv
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import tempfile
+import concurrent.futures
+from pathlib import Path
+import cv2
+import numpy as np
+import pyrealsense2 as rs
+
+from auto_exposure import AE_ALGORITHMS, create_ae, next_exposure
+from utils import frame_codec
+from utils import frame_source
+from utils import frame_archive
+
+# Offline AE replay and tuning. A recorded sequence (bag, extracted folder or
+# frame archive) is decoded once into a raw frame cache that every worker
+# process memory-maps, then each AE configuration replays it as fast as the
+# controller runs. In the default closed-loop mode a frame is rescaled from
+# the exposure it was recorded with to the exposure the controller commanded
+# one frame earlier (linear sensor, saturating at 255), so convergence and
+# oscillation can be measured without a camera. --open-loop feeds the frames
+# as recorded and only logs what the controller would have commanded.
+# "synthetic" replays the closed-loop synthetic scene instead of a recording.
+
+CACHE_META = "sequence.json"
+CACHE_FRAMES = "color.u8"
+
+# AE constructor arguments a sweep can vary, exposures in msec like the recorders
+AE_PARAMETERS = ("algorithm", "initial_exposure", "max_exposure", "min_exposure", "target_brightness",
+                 "metering", "stride", "deadband", "zones", "max_step")
+
+
+class ReplaySequence:
+    def __init__(self, colors, exposures, timestamps):
+        # colors (N, H, W, 3) uint8, exposures in 100 usec units, timestamps in seconds
+        self.colors = colors
+        self.exposures = np.asarray(exposures, dtype=np.float64)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.colors)
+
+    @property
+    def fps(self):
+        if len(self.timestamps) < 2:
+            return 30.
+        return 1. / float(np.median(np.diff(self.timestamps)))
+
+    @classmethod
+    def open(cls, path, max_frames=None):
+        # a frame cache written by build_cache() or an extracted folder with an archive
+        path = Path(path)
+        if (path / CACHE_META).exists():
+            with open(path / CACHE_META) as f:
+                meta = json.load(f)
+            colors = np.memmap(path / CACHE_FRAMES, dtype=np.uint8, mode="r", shape=tuple(meta["shape"]))
+            exposures, timestamps = meta["exposures"], meta["timestamps"]
+        else:
+            archive = frame_archive.FrameArchive(path)
+            colors, exposures, timestamps = archive.color_frames, archive.index["exposure"], archive.index["timestamp"]
+        return cls(colors[:max_frames], exposures[:max_frames], timestamps[:max_frames])
+
+
+def read_exposures(path):
+    # exposure_time.txt of an extracted folder, "timestamp exposure" rows
+    timestamps, values = frame_codec.read_index(path)
+    return dict(zip(timestamps.tolist(), (float(v) for v in values)))
+
+
+def iterate_recording(path, max_frames=None):
+    # (color image, exposure, timestamp) of a bag or an extracted folder
+    path = Path(path)
+    if path.is_dir():
+        reader = frame_codec.FrameReader(path)
+        exposure_path = path / "exposure_time.txt"
+        exposures = read_exposures(exposure_path) if exposure_path.exists() else {}
+        for i in range(len(reader) if max_frames is None else min(len(reader), max_frames)):
+            timestamp = float(reader.rgb_timestamps[i])
+            yield reader.read_color(i), exposures.get(timestamp, np.nan), timestamp
+        return
+
+    source = frame_source.BagSource(path)
+    source.start()
+    try:
+        count = 0
+        while max_frames is None or count < max_frames:
+            ok, frames = source.try_wait_for_frames()
+            if not ok:
+                break
+            color_frame = frames.get_color_frame()
+            if not color_frame:
+                continue
+            exposure = np.nan
+            if color_frame.supports_frame_metadata(rs.frame_metadata_value.actual_exposure):
+                exposure = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+            yield np.asanyarray(color_frame.get_data()), exposure, color_frame.get_timestamp() / 1000
+            count += 1
+    finally:
+        source.stop()
+
+
+def build_cache(path, cache_dir, max_frames=None):
+    # decode the recording once into a raw file the sweep workers memory-map
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    shape = None
+    exposures = []
+    timestamps = []
+    with open(cache_dir / CACHE_FRAMES, "wb") as f:
+        for image, exposure, timestamp in iterate_recording(path, max_frames):
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            if shape is None:
+                shape = image.shape
+            elif image.shape != shape:
+                raise ValueError(f"Frame shape changed from {shape} to {image.shape}")
+            f.write(memoryview(image).cast("B"))
+            exposures.append(float(exposure))
+            timestamps.append(float(timestamp))
+    if shape is None:
+        raise ValueError(f"No color frames in {path}")
+    exposures = np.array(exposures)
+    if np.isnan(exposures).all():
+        print("[INFO] No exposure metadata, assuming the frames were taken at 25 msec")
+    exposures[np.isnan(exposures)] = np.nanmedian(exposures) if not np.isnan(exposures).all() else 250.
+    with open(cache_dir / CACHE_META, "w") as f:
+        json.dump({"source": str(path), "shape": [len(timestamps), *shape],
+                   "exposures": exposures.tolist(), "timestamps": timestamps}, f)
+    return cache_dir
+
+
+def make_ae(config, image):
+    # zones and max_step only apply to the adaptive engine
+    return create_ae(config["algorithm"], config["initial_exposure"], config["max_exposure"], config["min_exposure"],
+                     image, target_brightness=config["target_brightness"], metering=config["metering"],
+                     stride=config["stride"], deadband=config["deadband"], zones=str(config["zones"]),
+                     max_step=config["max_step"])
+
+
+def replay_sequence(sequence, config, closed_loop=True):
+    # per-frame (applied exposure, brightness, commanded exposure), exposures in 100 usec units
+    count = len(sequence)
+    applied = np.empty(count)
+    brightness = np.empty(count)
+    commanded = np.empty(count)
+    auto_exposure = make_ae(config, np.asarray(sequence.colors[0]))
+    exposure = config["initial_exposure"] * 10 if closed_loop else sequence.exposures[0]
+    for i in range(count):
+        image = np.asarray(sequence.colors[i])
+        recorded = sequence.exposures[i]
+        if closed_loop:
+            # rescale to what the sensor would have seen at the commanded exposure
+            gain = exposure / recorded if recorded > 0 else 1.
+            if abs(gain - 1.) > 1e-3:
+                image = cv2.convertScaleAbs(image, alpha=gain)
+        else:
+            exposure = recorded
+        applied[i] = exposure
+        commanded[i] = next_exposure(auto_exposure, image, exposure, exposure)
+        brightness[i] = auto_exposure.w_avg_bright
+        if closed_loop:
+            exposure = commanded[i]
+    return applied, brightness, commanded
+
+
+def replay_synthetic(config, frames, width, height, fps, scene_gain):
+    # the synthetic source applies the exposure set during the previous frame, like the camera
+    source = frame_source.SyntheticSource(width, height, fps, depth=False, exposure=config["initial_exposure"] * 10,
+                                          scene_gain=scene_gain, max_frames=frames, base_timestamp_ms=0.)
+    sensor = source.get_color_sensor()
+    first = source.wait_for_frames().get_color_frame()
+    auto_exposure = make_ae(config, first.get_data())
+    applied = np.empty(frames - 1)
+    brightness = np.empty(frames - 1)
+    commanded = np.empty(frames - 1)
+    exposure = config["initial_exposure"] * 10
+    for i in range(frames - 1):
+        color_frame = source.wait_for_frames().get_color_frame()
+        applied[i] = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+        commanded[i] = next_exposure(auto_exposure, color_frame.get_data(), exposure, applied[i])
+        brightness[i] = auto_exposure.w_avg_bright
+        exposure = commanded[i]
+        sensor.set_option(rs.option.exposure, exposure)
+    timestamps = np.arange(frames - 1) / fps
+    return applied, brightness, commanded, timestamps
+
+
+def step_scene(t):
+    # lighting drops to a third after 2 sec and comes back after 5 sec
+    return 1. / 3. if 2. <= t < 5. else 1.
+
+
+def metrics(config, applied, brightness, commanded, timestamps, tolerance=None, settle_frames=5):
+    target = config["target_brightness"]
+    tolerance = tolerance if tolerance is not None else (config["deadband"] or 20)
+    error = brightness - target
+    within = np.abs(error) <= tolerance
+
+    # converged from the first frame after which settle_frames in a row stay within tolerance
+    converged_at = None
+    run = 0
+    for i, ok in enumerate(within):
+        run = run + 1 if ok else 0
+        if run >= settle_frames:
+            converged_at = i - settle_frames + 1
+            break
+
+    # direction reversals of meaningful (>1%) exposure steps
+    steps = np.diff(commanded)
+    steps = steps[np.abs(steps) > 0.01 * np.maximum(commanded[:-1], 1.)]
+    reversals = int(np.count_nonzero(np.diff(np.sign(steps)) != 0)) if len(steps) > 1 else 0
+    duration = float(timestamps[-1] - timestamps[0]) if len(timestamps) > 1 else 0.
+
+    settled = slice(converged_at, None) if converged_at is not None else slice(len(commanded), None)
+    settled_exposure = commanded[settled]
+
+    # overshoot: how far brightness went past the target after first crossing it, from the side it started on
+    side = np.sign(error[0]) if len(error) else 0.
+    crossed = np.flatnonzero(np.sign(error) == -side) if side else np.zeros(0, dtype=np.intp)
+    overshoot = float(np.max(-side * error[crossed[0]:])) if crossed.size else 0.
+    result = {"frames": len(brightness),
+              "converged": converged_at is not None,
+              "convergence_frames": converged_at,
+              "convergence_sec": float(timestamps[converged_at] - timestamps[0]) if converged_at is not None else None,
+              "within_tolerance_fraction": float(within.mean()),
+              "mean_abs_error": float(np.abs(error).mean()),
+              "rms_error": float(np.sqrt((error ** 2).mean())),
+              "overshoot": max(overshoot, 0.),
+              "max_settled_error": float(np.max(np.abs(error[settled]))) if settled_exposure.size else None,
+              "exposure_reversals": reversals,
+              "reversals_per_sec": reversals / duration if duration > 0 else 0.,
+              "settled_exposure_cv": float(settled_exposure.std() / settled_exposure.mean())
+                                     if settled_exposure.size and settled_exposure.mean() > 0 else None,
+              "saturated_fraction": float(np.mean((commanded <= config["min_exposure"] * 10 + 1e-6) |
+                                                  (commanded >= config["max_exposure"] * 10 - 1e-6))),
+              "mean_applied_exposure_ms": float(applied.mean() / 10)}
+    return result
+
+
+def score(result):
+    # lower is better: error dominates, oscillation and slow convergence add to it
+    convergence = result["convergence_sec"] if result["convergence_sec"] is not None else 1e3
+    return result["mean_abs_error"] + 2. * result["reversals_per_sec"] + convergence
+
+
+_sequence = None
+
+
+def _init_worker(cache_dir, max_frames):
+    global _sequence
+    if cache_dir is not None:
+        _sequence = ReplaySequence.open(cache_dir, max_frames)
+
+
+def run_config(index, config, options, trace_dir=None):
+    start = time.perf_counter()
+    if options["source"] == "synthetic":
+        applied, brightness, commanded, timestamps = replay_synthetic(
+            config, options["frames"], options["width"], options["height"], options["fps"], step_scene)
+    else:
+        applied, brightness, commanded = replay_sequence(_sequence, config, not options["open_loop"])
+        timestamps = _sequence.timestamps
+    result = metrics(config, applied, brightness, commanded, timestamps, options["tolerance"])
+    result.update(index=index, config=config, score=score(result),
+                  replay_fps=len(commanded) / (time.perf_counter() - start))
+    if trace_dir is not None:
+        trace_path = Path(trace_dir) / f"trace_{index:04d}.csv"
+        with open(trace_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["timestamp", "applied_exposure", "brightness", "commanded_exposure"])
+            writer.writerows(zip(timestamps.tolist(), applied.tolist(), brightness.tolist(), commanded.tolist()))
+        result["trace"] = str(trace_path)
+    return result
+
+
+def parse_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def sweep_configs(base, sweeps):
+    # "name=v1,v2,..." entries, every combination becomes one configuration
+    names = []
+    values = []
+    for sweep in sweeps:
+        name, _, spec = sweep.partition("=")
+        if name not in AE_PARAMETERS:
+            raise ValueError(f"Unknown AE parameter {name}, choose from {', '.join(AE_PARAMETERS)}")
+        names.append(name)
+        values.append([parse_value(v) for v in spec.split(",")])
+    return [dict(base, **dict(zip(names, combination))) for combination in itertools.product(*values)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recordings through AE offline and sweep its parameters.")
+    parser.add_argument("input", type=str,
+                        help="Bag file, extracted folder (rgb.txt or archive/) or 'synthetic'")
+    parser.add_argument("-o", "--output", type=str, default="ae_replay", help="Output directory for the results")
+    parser.add_argument("--sweep", nargs="*", default=[],
+                        help="Parameter grid, e.g. target_brightness=100,128,150 deadband=None,10,20")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Parallel worker processes")
+    parser.add_argument("--max-frames", type=int, help="Only replay the first frames of the recording")
+    parser.add_argument("--open-loop", action="store_true",
+                        help="Feed frames as recorded instead of simulating the commanded exposure")
+    parser.add_argument("--tolerance", type=float, help="Brightness error counted as converged (default: deadband or 20)")
+    parser.add_argument("--traces", action="store_true", help="Write the per-frame trace of every configuration")
+    parser.add_argument("--top", type=int, default=10, help="Best configurations to print")
+    # baseline configuration, the same defaults as ae_color_record.py at 15 fps
+    parser.add_argument("--algorithm", choices=list(AE_ALGORITHMS), default="baseline",
+                        help="AE engine, baseline is the original closed-form controller")
+    parser.add_argument("--initial-exposure", type=float, default=25)
+    parser.add_argument("--max-exposure", type=float, default=1 / 15 * 1e3 - 2)
+    parser.add_argument("--min-exposure", type=float, default=1)
+    parser.add_argument("--target-brightness", type=float, default=128)
+    parser.add_argument("--metering", type=str, default="center")
+    parser.add_argument("--stride", type=int, default=2)
+    parser.add_argument("--deadband", type=float, default=None)
+    parser.add_argument("--zones", type=str, default="4x4", help="Adaptive metering grid, rows x columns")
+    parser.add_argument("--max-step", type=float, default=4.0, help="Largest adaptive exposure change per frame")
+    # synthetic scene
+    parser.add_argument("--frames", type=int, default=300, help="Synthetic frames per configuration")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    base = {name: getattr(args, name) for name in AE_PARAMETERS}
+    configs = sweep_configs(base, args.sweep)
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    trace_dir = None
+    if args.traces:
+        trace_dir = output_dir / "traces"
+        trace_dir.mkdir(exist_ok=True)
+    options = dict(source="synthetic" if args.input == "synthetic" else "recording", open_loop=args.open_loop,
+                   tolerance=args.tolerance, frames=args.frames, width=args.width, height=args.height, fps=args.fps)
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        cache_dir = None
+        if options["source"] == "recording":
+            input_path = Path(args.input)
+            if input_path.is_dir() and (input_path / frame_archive.ARCHIVE_DIR / "meta.json").exists():
+                cache_dir = input_path
+            else:
+                start = time.perf_counter()
+                cache_dir = build_cache(input_path, tmp_dir, args.max_frames)
+                print(f"[INFO] Decoded {args.input} in {time.perf_counter() - start:.1f} sec")
+            print(f"[INFO] Replaying {len(ReplaySequence.open(cache_dir, args.max_frames))} frames")
+
+        print(f"[INFO] Running {len(configs)} configurations on {args.jobs} processes")
+        start = time.perf_counter()
+        results = []
+        # spawn, librealsense state does not survive a fork; the workers share the cache through the page cache
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=_init_worker,
+                                                    initargs=(cache_dir, args.max_frames)) as executor:
+            futures = [executor.submit(run_config, i, config, options, trace_dir) for i, config in enumerate(configs)]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+        elapsed = time.perf_counter() - start
+
+    results.sort(key=lambda r: r["score"])
+    with open(output_dir / "results.json", "w") as f:
+        json.dump({"input": args.input, "options": options, "elapsed_sec": elapsed, "results": results}, f, indent=2)
+    with open(output_dir / "results.csv", "w", newline="") as f:
+        columns = list(AE_PARAMETERS) + ["score", "convergence_sec", "mean_abs_error", "rms_error",
+                                         "overshoot", "max_settled_error", "reversals_per_sec", "settled_exposure_cv",
+                                         "within_tolerance_fraction", "saturated_fraction"]
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for r in results:
+            writer.writerow([r["config"][c] if c in r["config"] else r[c] for c in columns])
+
+    print(f"[INFO] {len(configs)} configurations in {elapsed:.1f} sec, results in {output_dir}")
+    for r in results[:args.top]:
+        changed = {k: v for k, v in r["config"].items() if base[k] != v} or "baseline"
+        convergence = f"{r['convergence_sec']:.2f} sec" if r["convergence_sec"] is not None else "never"
+        print(f"[INFO] score {r['score']:8.2f}  converged {convergence:>10s}  error {r['mean_abs_error']:6.1f}  "
+              f"reversals/sec {r['reversals_per_sec']:5.2f}  {changed}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,110 @@
+import time
+import inspect
+import collections
 import cv2
 import numpy as np
 
+from utils import buffer_pool
+
+METERING_MODES = ("center", "gaussian", "full")
+
+class BrightnessStats:
+    # Brightness statistics for AE computed on a strided luma plane of the
+    # metered region only. The histogram is only built when asked for, and
+    # the Gaussian weights are cached per plane shape as normalized float32.
+    # The downscaled and gray planes are borrowed from a buffer pool per frame.
+    def __init__(self, metering = "center", stride = 2, crop_width = 320, crop_height = 240,
+                 sigma = 1.0, histogram = False, pool = None) -> None:
+        if metering not in METERING_MODES:
+            raise ValueError(f"Unknown metering mode: {metering}")
+        self.metering = metering
+        self.stride = max(1, int(stride))
+        self.crop_width = crop_width
+        self.crop_height = crop_height
+        self.sigma = sigma
+        self.histogram = histogram
+        self._weights = {}
+        self._levels = np.arange(256, dtype=np.float32)
+        self.pool = pool if pool is not None else buffer_pool.default_pool
+
+    def region(self, image):
+        if self.metering != "center":
+            return image
+        img_height, img_width = image.shape[:2]
+        start_x = max((img_width - self.crop_width) // 2, 0)
+        start_y = max((img_height - self.crop_height) // 2, 0)
+        return image[start_y:start_y + self.crop_height, start_x:start_x + self.crop_width]
+
+    def luma(self, image, out = None):
+        # gray plane of the metered region, conversions write to out when it is given
+        region = self.region(image)
+        if self.stride > 1:
+            # nearest-neighbour resize is a strided gather without a numpy copy
+            height, width = region.shape[:2]
+            size = (max(width // self.stride, 1), max(height // self.stride, 1))
+            if region.ndim == 2:
+                return cv2.resize(region, size, dst=out, interpolation=cv2.INTER_NEAREST)
+            with self.pool.borrow((size[1], size[0]) + region.shape[2:], region.dtype) as small:
+                cv2.resize(region, size, dst=small, interpolation=cv2.INTER_NEAREST)
+                return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=out)
+        if region.ndim == 2:
+            return region
+        return cv2.cvtColor(region, cv2.COLOR_BGR2GRAY, dst=out)
+
+    def gaussian_weight(self, shape):
+        shape = tuple(shape[:2])
+        weights = self._weights.get(shape)
+        if weights is None:
+            weights = generate_gaussian_weight(shape, self.sigma)
+            self._weights[shape] = weights
+        return weights
+
+    def compute(self, image):
+        # returns (histogram or None, mean, weighted mean or None) from one luma plane
+        height, width = self.region(image).shape[:2]
+        if self.stride > 1:
+            height, width = max(height // self.stride, 1), max(width // self.stride, 1)
+        out = self.pool.get((height, width), np.uint8)
+        gray = self.luma(image, out)
+        hist = None
+        weighted_mean = None
+        if self.histogram:
+            hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
+            mean = float(hist.ravel() @ self._levels) / gray.size
+        else:
+            mean = cv2.mean(gray)[0]
+        if self.metering == "gaussian":
+            weights = self.gaussian_weight(gray.shape)
+            weighted_mean = float(np.dot(weights.ravel(), gray.ravel().astype(np.float32)))
+        self.pool.put(out)
+        return hist, mean, weighted_mean
+
+    def brightness(self, mean, weighted_mean):
+        return weighted_mean if weighted_mean is not None else mean
+
+def generate_gaussian_weight(shape, sigma = 1.0):
+    # float32 weights normalized to sum to one
+    rows, cols = shape[:2]
+    x = np.linspace(-1, 1, cols, dtype=np.float32)
+    y = np.linspace(-1, 1, rows, dtype=np.float32)
+    x, y = np.meshgrid(x, y)
+    gaussian_weights = np.exp(-((x * x + y * y) / np.float32(2.0 * sigma ** 2)))
+    return gaussian_weights / gaussian_weights.sum()
+
 class AE:
     def __init__(self, initial_exposure_time, max_exposure_time, min_exposure_time, 
-                 image: np.ndarray, target_brightness = 128, contrast_factor = 1.0) -> None:
+                 image: np.ndarray, target_brightness = 128, contrast_factor = 1.0,
+                 metering = "center", stride = 2, histogram = False, deadband = None) -> None:
         self.base_exp_t = initial_exposure_time
         self.max_exp_t = max_exposure_time * 10
         self.min_exp_t = min_exposure_time * 10
         self.c_f = contrast_factor
         self.target_bright = target_brightness
+        # hold the exposure while the brightness is within deadband of the target,
+        # None keeps the original behaviour where the band check does not stop the update
+        self.deadband = deadband
         self.counter_ = 1
+        self.stats = BrightnessStats(metering, stride, histogram = histogram)
         self.hist = self.calculate_histogram(image)
         self.gsw = self.generate_gaussian_weight(image.shape)
         self.w_avg_bright = self.calculate_average_brightness(image)
@@ -29,17 +124,12 @@ class AE:
         return np.mean(gray_image)
         
     def generate_gaussian_weight(self, shape, sigma = 1.0):
-        rows, cols, _ = shape
-        x = np.linspace(-1, 1, cols)
-        y = np.linspace(-1, 1, rows)
-        x, y = np.meshgrid(x, y)
-        d = np.sqrt(x * x + y * y)
-        gaussian_weights = np.exp(-(d ** 2 / (2.0 * sigma ** 2)))
-        return gaussian_weights
+        return generate_gaussian_weight(shape, sigma)
 
     def calculate_weighted_average_brightness(self, color_image):
         gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
-        weighted_brightness = np.sum(self.gsw * gray_image) / np.sum(self.gsw)
+        # the cached weights are already normalized
+        weighted_brightness = float(np.sum(self.gsw * gray_image))
         return weighted_brightness
 
     def calculate_histogram_contrast(self, color_image):
@@ -57,14 +147,14 @@ class AE:
          return hist
         
     def adjust_exposure(self, color_image, old_et):
-        total_pix_num = color_image.shape[0] * color_image.shape[1]
-        # calculate image histogram
-        self.hist = self.calculate_histogram(color_image)
-        # calculate weighted average brightness
-        crop_image = self.crop_image(color_image)
-        self.w_avg_bright = self.calculate_average_brightness(crop_image)
-
-        if (abs(self.w_avg_bright - self.target_bright) <= 20):
+        # calculate brightness statistics of the metered region in one pass
+        hist, mean, weighted_mean = self.stats.compute(color_image)
+        if hist is not None:
+            self.hist = hist
+        self.w_avg_bright = self.stats.brightness(mean, weighted_mean)
+
+        deadband = self.deadband if self.deadband is not None else 20
+        if (abs(self.w_avg_bright - self.target_bright) <= deadband):
             # if (np.sum(self.hist[220:]) > total_pix_num / 20):
             #     print(self.counter_)
             #     if self.counter_ % 10 == 0:
@@ -82,6 +172,8 @@ class AE:
             #         self.counter_ = self.counter_ + 1
             # else: 
             new_et = old_et
+            if self.deadband is not None:
+                return new_et
         if old_et == self.max_exp_t:
             old_et = old_et - 1   
 
@@ -108,3 +200,164 @@ class AE:
     #     exposure_time = self.base_exp_t * (1 + 0.8 * linear_term) + 1.0 * nonlinear_term
     #     # constrains exposure time
     #     return np.clip(exposure_time, self.min_exp_t, self.max_exp_t)  
+
+
+def zone_weights(grid, metering = "gaussian", sigma = 0.5):
+    # normalized (rows, cols) weights of the metering zones
+    rows, cols = grid
+    if metering == "gaussian":
+        weights = generate_gaussian_weight((rows, cols), sigma)
+    elif metering == "center":
+        # zones in the inner half of the frame count four times the border zones
+        y = np.abs((np.arange(rows) + 0.5) / rows - 0.5)
+        x = np.abs((np.arange(cols) + 0.5) / cols - 0.5)
+        weights = np.where((y[:, None] < 0.25) & (x[None, :] < 0.25), 4., 1.).astype(np.float32)
+    elif metering == "full":
+        weights = np.ones((rows, cols), dtype=np.float32)
+    else:
+        raise ValueError(f"Unknown metering mode: {metering}")
+    return weights / weights.sum()
+
+class AdaptiveAE:
+    # Scene-adaptive AE. The luma plane is metered on a grid of zones whose
+    # weights follow the metering mode, and the histogram moves the target
+    # down when highlights clip (or up when only the shadows do). Exposure is
+    # commanded from a model fitted on recent frames, log(brightness) =
+    # a + slope * log(exposure): the slope is a sensor property and survives
+    # scene changes, the offset is reset when a frame stops matching the model.
+    # Since the model gives the exposure for the target directly, one step
+    # usually converges, steps that reverse direction are damped and every
+    # step is bounded by max_step. The metering stride doubles whenever the
+    # per-frame compute time goes over budget_ms and comes back when there is
+    # room again. Exposures are in msec like AE, commands in 100 usec units.
+    def __init__(self, initial_exposure_time, max_exposure_time, min_exposure_time,
+                 image: np.ndarray, target_brightness = 128, metering = "gaussian", stride = 2,
+                 deadband = None, zones = (4, 4), history = 8, max_step = 4.0, budget_ms = 2.0,
+                 clip_limit = 0.02, pool = None) -> None:
+        self.max_exp_t = max_exposure_time * 10
+        self.min_exp_t = min_exposure_time * 10
+        self.target_bright = target_brightness
+        self.deadband = deadband if deadband is not None else 4
+        if isinstance(zones, str):
+            # "4x4", rows by columns
+            zones = tuple(int(n) for n in zones.lower().split("x"))
+        self.weights = zone_weights(zones, metering)
+        self.zones = tuple(zones)
+        self.max_log_step = np.log(max_step)
+        self.budget = budget_ms / 1e3
+        self.clip_limit = clip_limit
+        self.stats = BrightnessStats("full", stride, pool = pool)
+        self.base_stride = self.stats.stride
+        self.log_exposures = collections.deque(maxlen=history)
+        self.log_brightness = collections.deque(maxlen=history)
+        # start from a linear sensor, the output gamma lowers the slope as the history shows it
+        self.slope = 1.
+        self.damping = 1.
+        self.last_step = 0.
+        self.compute_time = 0.
+        self.target = target_brightness
+        self.hist = None
+        self.zone_means = None
+        self.w_avg_bright = self.meter(image)
+
+    def meter(self, image):
+        # weighted zone brightness, also updates the histogram and the scene target
+        stats = self.stats
+        height, width = stats.region(image).shape[:2]
+        shape = (max(height // stats.stride, 1), max(width // stats.stride, 1))
+        with stats.pool.borrow(shape, np.uint8) as gray:
+            gray = stats.luma(image, gray)
+            self.hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+            # area resize averages each zone exactly when the plane divides evenly
+            self.zone_means = cv2.resize(gray, self.zones[::-1], interpolation=cv2.INTER_AREA).astype(np.float32)
+        self.target = self.scene_target(self.hist)
+        return float(np.dot(self.weights.ravel(), self.zone_means.ravel()))
+
+    def scene_target(self, hist):
+        total = hist.sum()
+        highlights = hist[250:].sum() / total
+        shadows = hist[:6].sum() / total
+        if highlights > self.clip_limit:
+            # protect clipped highlights, at most 30% below the target
+            return self.target_bright * (1. - min(2. * (highlights - self.clip_limit), 0.3))
+        if shadows > self.clip_limit:
+            return self.target_bright * (1. + min(2. * (shadows - self.clip_limit), 0.2))
+        return self.target_bright
+
+    def update_model(self, log_exposure, log_brightness):
+        if self.log_exposures:
+            offset = np.mean(np.array(self.log_brightness) - self.slope * np.array(self.log_exposures))
+            # the scene changed when the new frame is 25% off the prediction, start over from it
+            if abs(offset + self.slope * log_exposure - log_brightness) > np.log(1.25):
+                self.log_exposures.clear()
+                self.log_brightness.clear()
+        self.log_exposures.append(log_exposure)
+        self.log_brightness.append(log_brightness)
+        exposures = np.array(self.log_exposures)
+        if len(exposures) >= 3 and np.ptp(exposures) > 0.1:
+            brightness = np.array(self.log_brightness)
+            centered = exposures - exposures.mean()
+            slope = float(centered @ (brightness - brightness.mean()) / (centered @ centered))
+            self.slope = 0.7 * self.slope + 0.3 * float(np.clip(slope, 0.3, 1.2))
+        return float(np.mean(np.array(self.log_brightness) - self.slope * exposures))
+
+    def adapt_stride(self, elapsed):
+        self.compute_time = elapsed if self.compute_time == 0. else 0.8 * self.compute_time + 0.2 * elapsed
+        if self.compute_time > self.budget and self.stats.stride < 16:
+            self.stats.stride *= 2
+            self.compute_time = 0.
+        elif self.compute_time < self.budget / 4 and self.stats.stride > self.base_stride:
+            self.stats.stride //= 2
+            self.compute_time = 0.
+
+    def adjust_exposure(self, color_image, old_et, actual_exposure = None):
+        # old_et is the current command, actual_exposure what the frame was taken with
+        # (frame metadata), they differ while a new command has not reached the sensor yet
+        start = time.perf_counter()
+        self.w_avg_bright = self.meter(color_image)
+        exposure = actual_exposure if actual_exposure else old_et
+        old_et = max(float(old_et), 1e-3)
+        # saturated frames say nothing about the model, only about the direction
+        saturated = not 3. < self.w_avg_bright < 250.
+        if not saturated:
+            offset = self.update_model(np.log(max(exposure, 1e-3)), np.log(self.w_avg_bright))
+        if abs(self.w_avg_bright - self.target) <= self.deadband:
+            step = 0.
+        elif saturated:
+            step = -self.max_log_step if self.w_avg_bright >= 250. else self.max_log_step
+        else:
+            step = (np.log(self.target) - offset) / self.slope - np.log(old_et)
+            # halve the step after a reversal, recover while the direction holds
+            if step * self.last_step < 0:
+                self.damping = max(self.damping * 0.5, 0.25)
+            else:
+                self.damping = min(self.damping * 1.5, 1.)
+            step = float(np.clip(step * self.damping, -self.max_log_step, self.max_log_step))
+        if step:
+            self.last_step = step
+        self.adapt_stride(time.perf_counter() - start)
+        return np.clip(old_et * np.exp(step), self.min_exp_t, self.max_exp_t)
+
+
+# selectable AE engines, AE is the original closed-form controller and the default
+AE_ALGORITHMS = {"baseline": AE, "adaptive": AdaptiveAE}
+
+def engine_options(cls):
+    # keyword options the engine's constructor takes besides the four positional ones
+    parameters = list(inspect.signature(cls).parameters.values())[4:]
+    return [p.name for p in parameters if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
+
+def create_ae(algorithm, initial_exposure_time, max_exposure_time, min_exposure_time, image, **kwargs):
+    # kwargs the chosen engine does not take are dropped, so callers can pass one set,
+    # None keeps the engine default
+    cls = AE_ALGORITHMS[algorithm]
+    accepted = engine_options(cls)
+    kwargs = {k: v for k, v in kwargs.items() if k in accepted and v is not None}
+    return cls(initial_exposure_time, max_exposure_time, min_exposure_time, image, **kwargs)
+
+def next_exposure(auto_exposure, color_image, old_et, actual_exposure = None):
+    # exposure command for the next frame; the measured exposure of the frame (metadata) only
+    # goes to engines that model it, the baseline AE gets the same call as before
+    if "actual_exposure" in inspect.signature(auto_exposure.adjust_exposure).parameters:
+        return auto_exposure.adjust_exposure(color_image, old_et, actual_exposure)
+    return auto_exposure.adjust_exposure(color_image, old_et)
@@ -0,0 +1,351 @@
+import os
+import cv2
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from auto_exposure import AE, AdaptiveAE
+from utils import logger
+from utils import viewer
+from utils import dataset_loader
+from utils.align import DepthAligner, Extrinsics, Intrinsics
+from utils.frame_source import SyntheticSource
+
+# name -> setup function returning the callable that is timed, or a
+# (callable, cleanup) pair when the benchmark holds resources
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def synthetic_frames(width, height):
+    source = SyntheticSource(width, height)
+    frames = source.wait_for_frames()
+    color_image = np.asanyarray(frames.get_color_frame().get_data())
+    depth_image = np.asanyarray(frames.get_depth_frame().get_data())
+    return color_image, depth_image
+
+
+def make_ae_benchmark(width, height, engine=AE):
+    def setup(workdir):
+        color_image, _ = synthetic_frames(width, height)
+        auto_exposure = engine(25, 60, 0.1, color_image)
+        return lambda: auto_exposure.adjust_exposure(color_image, 250)
+    return setup
+
+
+benchmark("ae_adjust_exposure_640x480")(make_ae_benchmark(640, 480))
+benchmark("ae_adjust_exposure_1280x720")(make_ae_benchmark(1280, 720))
+benchmark("adaptive_ae_adjust_exposure_640x480")(make_ae_benchmark(640, 480, AdaptiveAE))
+benchmark("adaptive_ae_adjust_exposure_1280x720")(make_ae_benchmark(1280, 720, AdaptiveAE))
+
+
+@benchmark("depth_preview_640x480")
+def bench_depth_preview(workdir):
+    # same steps as the preview in depth_color_record.py
+    color_image, depth_image = synthetic_frames(640, 480)
+    def run():
+        depth_image_normalized = cv2.normalize(depth_image, None, 0, 255, cv2.NORM_MINMAX)
+        depth_image_8bit = np.uint8(depth_image_normalized)
+        depth_image_colored = cv2.cvtColor(depth_image_8bit, cv2.COLOR_GRAY2BGR)
+        return np.hstack((color_image, depth_image_colored))
+    return run
+
+
+@benchmark("depth_preview_lut_640x480")
+def bench_depth_preview_lut(workdir):
+    # the LUT preview depth_color_record.py uses now
+    color_image, depth_image = synthetic_frames(640, 480)
+    depth_preview = viewer.DepthPreview(0.001)
+    return lambda: depth_preview.render(color_image, depth_image)
+
+
+@benchmark("png_encode_depth_640x480")
+def bench_png_depth(workdir):
+    _, depth_image = synthetic_frames(640, 480)
+    return lambda: cv2.imencode(".png", depth_image)
+
+
+@benchmark("png_encode_color_640x480")
+def bench_png_color(workdir):
+    color_image, _ = synthetic_frames(640, 480)
+    return lambda: cv2.imencode(".png", color_image)
+
+
+@benchmark("png_imwrite_depth_color_640x480")
+def bench_png_imwrite(workdir):
+    # the per-frame file writes of extract_bag.py
+    color_image, depth_image = synthetic_frames(640, 480)
+    depth_path = os.path.join(workdir, "depth.png")
+    rgb_path = os.path.join(workdir, "rgb.png")
+    def run():
+        cv2.imwrite(depth_path, depth_image)
+        cv2.imwrite(rgb_path, color_image)
+    return run
+
+
+@benchmark("metadata_sink_write_line")
+def bench_metadata_sink(workdir):
+    sink = logger.MetadataSink(os.path.join(workdir, "sink", "timestamps.txt"))
+    return lambda: sink.write_line("{:.2f}".format(time.time())), sink.close
+
+
+@benchmark("metadata_sink_write_line_background")
+def bench_metadata_sink_background(workdir):
+    sink = logger.MetadataSink(os.path.join(workdir, "sink_bg", "timestamps.txt"), background=True)
+    return lambda: sink.write_line("{:.2f}".format(time.time())), sink.close
+
+
+# D435 at 848x480 depth aligned to 1280x720 color, the extract_bag.py --align case
+ALIGN_DEPTH = Intrinsics(848, 480, 424.5, 424.5, 423.1, 238.7, "brown_conrady")
+ALIGN_COLOR = Intrinsics(1280, 720, 909.2, 908.7, 648.3, 362.9, "inverse_brown_conrady")
+ALIGN_ROTATION = [0.9999, 0.0046, -0.0107, -0.0046, 1., 0.0011, 0.0107, -0.0011, 0.9999]
+ALIGN_TRANSLATION = [0.0147, 0.0002, 0.0004]
+
+
+def software_frameset(depth_image):
+    # a depth + color frameset of a librealsense software device, what rs.align gets from a bag
+    import pyrealsense2 as rs
+    device = rs.software_device()
+    profiles, sensors, queues = [], [], []
+    for name, stream, intrinsics, fmt, bpp in (("Depth", rs.stream.depth, ALIGN_DEPTH, rs.format.z16, 2),
+                                               ("Color", rs.stream.color, ALIGN_COLOR, rs.format.bgr8, 3)):
+        rs_intrinsics = rs.intrinsics()
+        rs_intrinsics.width, rs_intrinsics.height = intrinsics.width, intrinsics.height
+        rs_intrinsics.fx, rs_intrinsics.fy = intrinsics.fx, intrinsics.fy
+        rs_intrinsics.ppx, rs_intrinsics.ppy = intrinsics.ppx, intrinsics.ppy
+        rs_intrinsics.model = getattr(rs.distortion, intrinsics.model)
+        rs_intrinsics.coeffs = intrinsics.coeffs
+        video_stream = rs.video_stream()
+        video_stream.type, video_stream.index, video_stream.uid = stream, 0, len(profiles)
+        video_stream.width, video_stream.height, video_stream.fps = intrinsics.width, intrinsics.height, 30
+        video_stream.bpp, video_stream.fmt, video_stream.intrinsics = bpp, fmt, rs_intrinsics
+        sensor = device.add_sensor(name)
+        profiles.append(sensor.add_video_stream(video_stream))
+        sensors.append(sensor)
+    sensors[0].add_read_only_option(rs.option.depth_units, 0.001)
+    extrinsics = rs.extrinsics()
+    extrinsics.rotation, extrinsics.translation = ALIGN_ROTATION, ALIGN_TRANSLATION
+    profiles[0].register_extrinsics_to(profiles[1], extrinsics)
+
+    color_image = np.zeros((ALIGN_COLOR.height, ALIGN_COLOR.width, 3), dtype=np.uint8)
+    frames = []
+    for sensor, profile, image, bpp in zip(sensors, profiles, (depth_image, color_image), (2, 3)):
+        queue = rs.frame_queue(1, True)
+        sensor.open(profile)
+        sensor.start(queue)
+        frame = rs.software_video_frame()
+        frame.pixels, frame.bpp, frame.stride = image, bpp, image.shape[1] * bpp
+        frame.timestamp, frame.domain, frame.frame_number = 0., rs.timestamp_domain.hardware_clock, 1
+        frame.profile = profile.as_video_stream_profile()
+        sensor.on_video_frame(frame)
+        frames.append(queue.wait_for_frame(2000))
+        queues.append(queue)
+
+    # the syncer does not pair software frames, a processing block joins them into a frameset
+    output = rs.frame_queue(1, True)
+    block = rs.processing_block(lambda frame, source: source.frame_ready(
+        source.allocate_composite_frame([frame, frames[1]])))
+    block.start(output)
+    block.invoke(frames[0])
+    frameset = output.wait_for_frame(2000).as_frameset()
+
+    # the device, the queues and the pixel buffers have to outlive the frameset
+    resources = [device, queues, frames, block, output, depth_image, color_image]
+    def cleanup():
+        for sensor in sensors:
+            sensor.stop()
+            sensor.close()
+        resources.clear()
+    return frameset, cleanup
+
+
+@benchmark("rs_align_848x480_to_1280x720")
+def bench_rs_align(workdir):
+    import pyrealsense2 as rs
+    _, depth_image = synthetic_frames(848, 480)
+    frameset, cleanup = software_frameset(np.ascontiguousarray(depth_image))
+    rs_align = rs.align(rs.stream.color)
+    # the copy out of the frame keeps it comparable with the aligner, which returns an array
+    return lambda: np.asanyarray(rs_align.process(frameset).get_depth_frame().get_data()).copy(), cleanup
+
+
+@benchmark("align_848x480_to_1280x720")
+def bench_align(workdir):
+    # utils.align.DepthAligner against rs.align above, extract_bag.py uses rs.align until this is faster
+    _, depth_image = synthetic_frames(848, 480)
+    aligner = DepthAligner(ALIGN_DEPTH, ALIGN_COLOR, Extrinsics(ALIGN_ROTATION, ALIGN_TRANSLATION), 0.001)
+    out = np.empty((ALIGN_COLOR.height, ALIGN_COLOR.width), dtype=np.uint16)
+    return lambda: aligner.align(depth_image, out)
+
+
+def extracted_sequence(workdir, frames=64, width=640, height=480):
+    # PNG sequence laid out like extract_bag.py output, written once per run
+    sequence_dir = os.path.join(workdir, "sequence")
+    if os.path.exists(os.path.join(sequence_dir, "rgb.txt")):
+        return sequence_dir
+    os.makedirs(os.path.join(sequence_dir, "rgb"))
+    os.makedirs(os.path.join(sequence_dir, "depth"))
+    color_image, depth_image = synthetic_frames(width, height)
+    rng = np.random.default_rng(0)
+    with open(os.path.join(sequence_dir, "rgb.txt"), "w") as rgb_index, \
+            open(os.path.join(sequence_dir, "depth.txt"), "w") as depth_index:
+        for i in range(frames):
+            timestr = f"{1700000000 + i / 30:.8f}"
+            # noise keeps the PNGs from compressing unrealistically well
+            noise = rng.integers(0, 8, color_image.shape, dtype=np.uint8)
+            cv2.imwrite(os.path.join(sequence_dir, "rgb", timestr + ".png"), color_image + noise)
+            cv2.imwrite(os.path.join(sequence_dir, "depth", timestr + ".png"), depth_image + noise[..., 0])
+            rgb_index.write(f"{timestr} rgb/{timestr}.png\n")
+            depth_index.write(f"{timestr} depth/{timestr}.png\n")
+    return sequence_dir
+
+
+@benchmark("dataset_imread_sequential_batch8")
+def bench_dataset_imread(workdir):
+    # what consumers did before utils.dataset_loader: one index row and one imread pair at a time
+    sequence_dir = extracted_sequence(workdir)
+    with open(os.path.join(sequence_dir, "rgb.txt")) as f:
+        rgb_names = [line.split()[1] for line in f]
+    with open(os.path.join(sequence_dir, "depth.txt")) as f:
+        depth_names = [line.split()[1] for line in f]
+    position = [0]
+    def run():
+        colors, depths = [], []
+        for _ in range(8):
+            i = position[0] % len(rgb_names)
+            colors.append(cv2.imread(os.path.join(sequence_dir, rgb_names[i]), cv2.IMREAD_COLOR))
+            depths.append(cv2.imread(os.path.join(sequence_dir, depth_names[i]), cv2.IMREAD_UNCHANGED))
+            position[0] += 1
+        return np.stack(colors), np.stack(depths)
+    return run
+
+
+def make_loader_benchmark(executor, cache_mb=0):
+    def setup(workdir):
+        loader = dataset_loader.DatasetLoader(extracted_sequence(workdir), batch_size=8, workers=4,
+                                              executor=executor, cache_mb=cache_mb)
+        def epochs():
+            while True:
+                yield from loader
+        batches = epochs()
+        def cleanup():
+            batches.close()
+            loader.close()
+        return (lambda: next(batches)), cleanup
+    return setup
+
+
+benchmark("dataset_loader_threads_batch8")(make_loader_benchmark("thread"))
+benchmark("dataset_loader_processes_batch8")(make_loader_benchmark("process"))
+# the 64 frames (94 MB decoded) fit the cache, every epoch after the first is served from memory
+benchmark("dataset_loader_cached_batch8")(make_loader_benchmark("thread", cache_mb=128))
+
+
+def run_benchmark(run, iterations, warmup):
+    for _ in range(warmup):
+        run()
+    samples = np.empty(iterations, dtype=np.float64)
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        run()
+        samples[i] = time.perf_counter() - t0
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1e3
+    return {"iterations": iterations,
+            "mean_ms": float(samples.mean() * 1e3),
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "max_ms": float(samples.max() * 1e3),
+            "throughput_per_sec": float(iterations / elapsed) if elapsed > 0 else 0.}
+
+
+def compare_results(results, baseline, tolerance):
+    # a benchmark regresses when its median latency grows by more than tolerance
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        ratio = result["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] > 0 else 1.
+        result["baseline_p50_ms"] = previous["p50_ms"]
+        result["ratio"] = ratio
+        if ratio > 1. + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the capture and extraction hot paths.")
+    parser.add_argument("-n", "--iterations", type=int, default=200, help="Timed calls per benchmark")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed calls before measuring")
+    parser.add_argument("-k", "--filter", type=str, default="", help="Only run benchmarks containing this string")
+    parser.add_argument("--save", type=str, help="Write results to this JSON baseline")
+    parser.add_argument("--compare", type=str, help="Compare against a previously saved JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative p50 slowdown before flagging a regression")
+    parser.add_argument("--list", action="store_true", help="List benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, setup in BENCHMARKS.items():
+            if args.filter not in name:
+                continue
+            run = setup(workdir)
+            cleanup = None
+            if isinstance(run, tuple):
+                run, cleanup = run
+            try:
+                results[name] = run_benchmark(run, args.iterations, args.warmup)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            r = results[name]
+            print(f"{name:40s} p50 {r['p50_ms']:8.3f} ms  p95 {r['p95_ms']:8.3f} ms  "
+                  f"p99 {r['p99_ms']:8.3f} ms  {r['throughput_per_sec']:10.1f} /sec")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for name, r in results.items():
+            if "ratio" in r:
+                flag = "REGRESSION" if name in regressions else "ok"
+                print(f"[INFO] {name}: {r['baseline_p50_ms']:.3f} -> {r['p50_ms']:.3f} ms "
+                      f"({r['ratio']:.2f}x) {flag}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "opencv": cv2.__version__,
+                       "machine": platform.machine(),
+                       "results": results}, f, indent=2)
+        print("[INFO] Saved benchmark results to", args.save)
+
+    if regressions:
+        print("[ERROR] Regressions:", ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
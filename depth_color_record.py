@@ -1,103 +1,157 @@
 import os
-import cv2
+import argparse
 import numpy as np
 import pyrealsense2 as rs
 
 from utils import viewer
 from utils import logger
+from utils import device_profile
+from utils import frame_source
+from utils import telemetry
+from utils import segment_writer
+from utils import buffer_pool
+from utils import session_config
+from utils import align
 from auto_exposure import AE
 from colorama import Fore, Style, init
 
 if __name__ == "__main__":
-    pipeline = rs.pipeline()
-    config = rs.config()
-
-    # setting for streams
-    framerate = 30
-    image_resolution = [640, 480]
-    config.enable_stream(rs.stream.color, image_resolution[0], image_resolution[1], rs.format.bgr8, framerate)
-    config.enable_stream(rs.stream.depth, image_resolution[0], image_resolution[1], rs.format.z16, framerate)
-    
-    # config
-    pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-    pipeline_profile = config.resolve(pipeline_wrapper)
-    device = pipeline_profile.get_device()
-    device_product_line = str(device.get_info(rs.camera_info.product_line))
-    print("[INFO] Device type:",device_product_line)
-
-    # check sensor
-    found_rgb = False
-    found_depth = False
-    found_imu = False
-    rgb_sensor_index = None
-    depth_sensor_index = None
-    imu_sensor_index = None
-    for i, s in enumerate(device.query_sensors()):
-        print("[INFO] Sensor name:", s)
-        if s.get_info(rs.camera_info.name) == 'RGB Camera':
-            found_rgb = True
-            rgb_sensor_index = i
-            print("[INFO] RGB camera sensor is sucessfully detected!")
-        if s.get_info(rs.camera_info.name) == 'Stereo Module':
-            found_depth = True
-            depth_sensor_index = i
-            print("[INFO] Depth camera sensor is sucessfully detected!")
-        if s.get_info(rs.camera_info.name) == 'Motion Module':
-            found_imu = True
-            imu_sensor_index = i
-            print("[INFO] Motion sensor is sucessfully detected!")
-        else:
-            pass
-    if not found_rgb:
-        print("[ERROR] Can't find RGB camera sensor!")
-        exit(0)
-    if not found_depth:
-        print("[ERROR] Can't find Depth camera sensor!")
-        exit(0)
-    if not found_imu:
-        print("[ERROR] Can't find motion sensor!")
-        exit(0)
+    parser = argparse.ArgumentParser(description="Record aligned depth and color streams.")
+    parser.add_argument("--source", choices=["camera", "synthetic"], default="camera",
+                        help="Frame source, synthetic runs without a camera")
+    parser.add_argument("--align", choices=["rs", "numpy", "deferred"],
+                        help="Depth-to-color alignment with rs.align (the reference) or the vectorized NumPy aligner, "
+                             "which agrees with it up to float rounding (check a bag with python -m utils.align), "
+                             "deferred records unaligned depth and leaves alignment to extract_bag.py")
+    parser.add_argument("--preview-fps", type=float, help="Preview refresh rate, 0 shows every frame")
+    parser.add_argument("--preview-scale", type=float, help="Downscale factor of the preview")
+    parser.add_argument("--headless", action="store_true", help="No preview window, stop with Ctrl+C")
+    parser.add_argument("--record", choices=["bag", "segments"],
+                        help="data.bag written by librealsense, or buffered segment files from a writer thread")
+    parser.add_argument("--ring-frames", type=int, help="Frames the segment writer buffers in memory")
+    parser.add_argument("--drop-policy", choices=list(segment_writer.DROP_POLICIES),
+                        help="Frame dropped when the segment writer falls behind and the buffer is full")
+    parser.add_argument("--segment-mb", type=float, help="Start a new segment after this many MB")
+    parser.add_argument("--segment-sec", type=float, help="Start a new segment after this many seconds")
+    parser.add_argument("--refresh-profile", action="store_true",
+                        help="Query the camera again instead of loading the cached device profile")
+    parser.add_argument("--min-depth", type=float, help="Depth preview range start in meters")
+    parser.add_argument("--max-depth", type=float, help="Depth preview range end in meters")
+    parser.add_argument("--colormap", choices=list(viewer.DEPTH_COLORMAPS), help="Depth preview colormap")
+    session_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    # stream profiles, exposures and output location, flags left out keep the configured values
+    config = session_config.from_args(args, session_config.defaults(
+        streams={"color": {"width": 640, "height": 480, "fps": 30}, "depth": {"enabled": True}}), {
+        "preview_fps": "preview.fps", "preview_scale": "preview.scale", "min_depth": "preview.min_depth",
+        "max_depth": "preview.max_depth", "colormap": "preview.colormap",
+        "record": "record.format", "ring_frames": "record.ring_frames", "drop_policy": "record.drop_policy",
+        "segment_mb": "record.segment_mb", "segment_sec": "record.segment_sec"})
+    if args.align == "deferred":
+        config.set("stages.align", "deferred")
+    elif args.align is not None:
+        config.set("align.method", args.align)
+    if args.headless:
+        config.set("stages.preview", "off")
+    config.set("streams.depth.enabled", True)
+    color_stream, depth_stream = config.stream("color"), config.stream("depth")
+    framerate = color_stream[4]
+    record = config["record"]
+    preview_options = config["preview"]
+
+    if args.dry_run:
+        valid = session_config.dry_run(config, frame_source.find_device() if args.source == "camera" else None,
+                                       args.refresh_profile)
+        raise SystemExit(0 if valid else 1)
+    # a bad stage mode, format or drop policy from a config file fails here, not deep in the run
+    errors = config.errors()
+    if errors:
+        for error in errors:
+            print("[ERROR] " + error)
+        raise SystemExit(1)
+    logger.set_work_dir(config.work_dir())
+    config.save()
+
+    aligner = None
+    if args.source == "synthetic":
+        # camera-free run with generated color and depth frames, already aligned
+        source = frame_source.SyntheticSource(color_stream[1], color_stream[2], framerate, realtime=True)
+        color_sensor = source.get_color_sensor()
+        depth_sensor = source.get_depth_sensor()
+        depth_scale = depth_sensor.get_depth_scale()
+    else:
+        # sensor indices, depth scale, intrinsics and extrinsics come from the per-device profile cache
+        device = frame_source.find_device()
+        profile, device_sensors = device_profile.load_device_profile(device, [color_stream, depth_stream],
+                                                                     refresh=args.refresh_profile)
+        print("[INFO] Device type:", profile.product_line)
+
+        source = frame_source.LiveCameraSource(serial=profile.serial)
+        source.enable_stream(*color_stream)
+        source.enable_stream(*depth_stream)
+
+        color_key, depth_key = device_profile.stream_key(*color_stream), device_profile.stream_key(*depth_stream)
+        if record["format"] == "bag":
+            logger.set_record_to_bag_file(source.config)
+        logger.save_device_profile(profile, color_key, depth_key)
+        if config.live("align") and config["align"]["method"] == "numpy":
+            aligner = align.DepthAligner.from_device_profile(profile.data, color_key, depth_key)
+        color_sensor = device_sensors[profile.rgb_index]
+        depth_sensor = device_sensors[profile.depth_index].as_depth_sensor()
+        depth_scale = profile.depth_scale
 
     # Initialize logger
-    timestamps_saver = logger.TimeStampSaver()
-    logger.set_record_to_bag_file(config)
-    logger.save_sensor_intrinsics(pipeline_profile, rs.stream.color)
-    logger.save_sensor_intrinsics(pipeline_profile, rs.stream.depth)
+    timestamps_saver = logger.TimeStampSaver(background=True)
+    # preview window, created once and throttled to --preview-fps
+    preview = viewer.Viewer('Depth frame and color frame', preview_options["fps"], preview_options["scale"],
+                            not config.live("preview"))
+    # drops, latency and stage timings, summarized next to data.bag
+    capture_telemetry = telemetry.CaptureTelemetry(framerate, os.path.join(logger.WORK_DIR, telemetry.SUMMARY_FILE))
+    # buffered recording, frames are copied into a ring and written by a background thread
+    frame_writer = None
+    if record["format"] == "segments":
+        frame_writer = segment_writer.SegmentWriter(os.path.join(logger.WORK_DIR, "segments"), record["ring_frames"],
+                                                    record["drop_policy"], max_segment_bytes=int(record["segment_mb"] * 1e6),
+                                                    max_segment_sec=record["segment_sec"], telemetry=capture_telemetry)
 
     # set sensor option
-    color_sensor = pipeline_profile.get_device().query_sensors()[rgb_sensor_index]
     color_sensor.set_option(rs.option.enable_auto_exposure, False)
     color_sensor.set_option(rs.option.enable_auto_white_balance, False)
     color_sensor.set_option(rs.option.power_line_frequency, 1)
     color_sensor.set_option(rs.option.global_time_enabled, 1)
-    color_sensor.set_option(rs.option.exposure, 300)
+    color_sensor.set_option(rs.option.exposure, config["exposure"]["color"])
 
-    depth_sensor = pipeline_profile.get_device().first_depth_sensor()
     depth_sensor.set_option(rs.option.enable_auto_exposure, False)
     # depth_sensor.set_option(rs.option.enable_auto_white_balance, False)
     # depth_sensor.set_option(rs.option.power_line_frequency, 1)
     depth_sensor.set_option(rs.option.global_time_enabled, 1)
-    depth_sensor.set_option(rs.option.exposure, 300)
+    depth_sensor.set_option(rs.option.exposure, config["exposure"]["depth"])
 
     #depth scale
-    depth_scale = depth_sensor.get_depth_scale()
     print("Depth Scale is: " , depth_scale)
-
-    #align depth frame to color frame
-    align_to = rs.stream.color
-    align = rs.align(align_to)
+    depth_preview = viewer.DepthPreview(depth_scale, preview_options["min_depth"], preview_options["max_depth"],
+                                        preview_options["colormap"])
 
     # start pipeline
-    pipeline.start(config)
+    source.start()
+
+    # aligned depth is written and shown before the next frame, so one buffer is reused
+    aligned_depth = None
 
     # loop collect data
     try:
         while True:
             # Wait for a frames metadata
-            frames = pipeline.wait_for_frames()
-
-            # Get aligned frames
-            aligned_frames = align.process(frames)
+            with capture_telemetry.stage("wait"):
+                frames = source.wait_for_frames()
+
+            # Get aligned frames, deferred alignment keeps the raw depth for extract_bag.py
+            if aligner is None and config.live("align"):
+                with capture_telemetry.stage("align"):
+                    aligned_frames = source.align_frames(frames)
+            else:
+                aligned_frames = frames
             aligned_depth_frame = aligned_frames.get_depth_frame()
             color_frame = frames.get_color_frame()
 
@@ -108,27 +162,44 @@ if __name__ == "__main__":
             # Convert depth/color images to numpy arrays
             color_image = np.asanyarray(color_frame.get_data())
             depth_image = np.asanyarray(aligned_depth_frame.get_data())
+            if aligner is not None:
+                with capture_telemetry.stage("align"):
+                    if aligned_depth is None:
+                        aligned_depth = buffer_pool.default_pool.get(color_image.shape[:2], np.uint16)
+                    depth_image = aligner.align(depth_image, aligned_depth)
 
             # get timestamp
             color_sensor_timestamp_domain = color_frame.get_frame_timestamp_domain()
             color_sensor_timestamp = color_frame.get_timestamp() / 1000
-            timestamps_saver.save_timestamps(color_sensor_timestamp)
-
-            # Show images
-            depth_image_normalized = cv2.normalize(depth_image, None, 0, 255, cv2.NORM_MINMAX)
-            depth_image_8bit = np.uint8(depth_image_normalized)
-            depth_image_colored = cv2.cvtColor(depth_image_8bit, cv2.COLOR_GRAY2BGR)
-            combined_image = np.hstack((color_image, depth_image_colored))
-
-            cv2.namedWindow('Depth frame and color frame', cv2.WINDOW_AUTOSIZE)
-            cv2.imshow('Depth frame and color frame', combined_image)
-            
-            key = cv2.waitKey(1)
-            if key & 0xFF == ord('q') or key == 27:
-                cv2.destroyAllWindows()
-                break
+            capture_telemetry.frame(color_frame.get_frame_number(), color_sensor_timestamp)
+            with capture_telemetry.stage("logging"):
+                timestamps_saver.save_timestamps(color_sensor_timestamp)
+                if frame_writer is not None:
+                    frame_writer.push(color_image, depth_image, color_sensor_timestamp,
+                                      frame_number=color_frame.get_frame_number())
+
+            # Show images, only when a preview is due
+            if preview.due():
+                with capture_telemetry.stage("display"):
+                    # fixed metric range through a cached LUT into a reused side-by-side buffer
+                    combined_image = depth_preview.render(color_image, depth_image)
+                    overlay = capture_telemetry.overlay_lines()
+                    if frame_writer is not None:
+                        overlay += frame_writer.overlay_lines()
+                    key = preview.show(combined_image, overlay, font_scale=0.6, thickness=1, copy=False)
+                if key & 0xFF == ord('q') or key == 27:
+                    preview.close()
+                    break
+    except KeyboardInterrupt:
+        print("[INFO] Stopped")
     except Exception as e:
         print("[ERROR] ",e)
     finally:
         # Stop streaming
-        pipeline.stop()
\ No newline at end of file
+        source.stop()
+        # Flush buffered metadata
+        timestamps_saver.close()
+        if frame_writer is not None:
+            frame_writer.close()
+        capture_telemetry.report()
+        print("[INFO] " + buffer_pool.default_pool.summary())
\ No newline at end of file
@@ -1,138 +1,539 @@
-import cv2
 import os
 import sys
+import time
+import queue
+import glob
+import json
+import argparse
+import threading
+import traceback
+import concurrent.futures
 from pathlib import Path
 import pyrealsense2 as rs
 import numpy as np
-print("Environment Ready")
 
-bag_path = Path(sys.argv[1])
-assert bag_path.exists()
+from utils import frame_source
+from utils import frame_codec
+from utils import frame_archive
+from utils import checkpoint
+from utils import index_writer
+from utils import buffer_pool
 
-output_dir = bag_path.with_suffix("")
-output_dir.mkdir(parents=True, exist_ok=True)
+# marks the end of the stream in the stage queues
+_END = None
 
-depth_t_path = output_dir / "depth.txt"
-rgb_t_path = output_dir / "rgb.txt"
+# a resume seeks this many seconds before the checkpointed position: playback reads ahead, so
+# the position saved with a checkpoint can be past frames that were not written yet
+RESUME_SEEK_MARGIN = 1.0
 
-depth_path = output_dir / "depth"
-rgb_path = output_dir / "rgb"
 
-depth_path.mkdir(parents=True, exist_ok=True)
-rgb_path.mkdir(parents=True, exist_ok=True)
+class FrameTask:
+    def __init__(self, index, timestr, depth_image, color_image, stamp_sensor, exposure_t, position,
+                 frame_number=None):
+        self.index = index
+        self.frame_number = frame_number
+        self.timestr = timestr
+        # playback position in seconds, where a resumed run seeks to
+        self.position = position
+        # relative paths of the written frames, set by the output codec
+        self.depth_name = None
+        self.rgb_name = None
+        self.depth_image = depth_image
+        self.color_image = color_image
+        self.stamp_sensor = stamp_sensor
+        self.exposure_t = exposure_t
 
-exposure_time_file = output_dir / "exposure_time.txt"
-sensor_time_file = output_dir / "sensor_timestamp.txt"
-depth_scale_file = output_dir / "depth_scale.txt"
 
-# Setup:
-pipe = rs.pipeline()
-cfg = rs.config()
-cfg.enable_device_from_file(str(bag_path), repeat_playback=False)
-profile = pipe.start(cfg)
+class ExtractionPipeline:
+    def __init__(self, bag_path: Path, workers=os.cpu_count(), queue_size=16, skip_frames=10,
+                 source=None, output_dir=None, codec=None, archive=False,
+                 resume=True, start=None, end=None, checkpoint_every=100, verbose=True, frame_table=True):
+        self.bag_path = bag_path
+        self.workers = max(1, workers or 1)
+        self.skip_frames = skip_frames
+        # any frame source works, e.g. a synthetic one for benchmarking
+        self.source = source if source is not None else frame_source.BagSource(bag_path)
+        self.codec = codec if codec is not None else frame_codec.PngCodec()
+        self.archive = archive
+        self.archive_writer = None
+        # buffered index rows and the optional binary frame table (utils.index_writer)
+        self.frame_table = frame_table
+        self.index_writer = None
+        self.progress = None
+        # frame copies and aligned depth come from a shared pool and go back once written
+        self.pool = buffer_pool.default_pool
+        # --start/--end range in seconds from the start of the bag
+        self.start = start
+        self.end = end
+        self.resume = resume
+        self.checkpoint_every = checkpoint_every
+        self.verbose = verbose
+        self.resumed_frames = 0
+        self.resume_position = None
+        self.resume_after = None
 
-# Getting the depth sensor's depth scale (see rs-align example for explanation)
-depth_sensor = profile.get_device().first_depth_sensor()
-depth_scale = 1. / depth_sensor.get_depth_scale()
-print("Depth Scale is: " , depth_scale)
-with open(depth_scale_file, 'w') as f:
-    f.write(f"{depth_scale}\n")
+        self.output_dir = Path(output_dir) if output_dir is not None else bag_path.with_suffix("")
+        self.depth_t_path = self.output_dir / "depth.txt"
+        self.rgb_t_path = self.output_dir / "rgb.txt"
+        self.exposure_time_file = self.output_dir / "exposure_time.txt"
+        self.sensor_time_file = self.output_dir / "sensor_timestamp.txt"
+        self.depth_scale_file = self.output_dir / "depth_scale.txt"
 
-# Skip first 10 frames
-for x in range(10):
-    pipe.wait_for_frames()
+        # bounded queues between the stages so a slow disk throttles the reader
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.done_queue = queue.Queue()
 
-# # We will be removing the background of objects more than
-# #  clipping_distance_in_meters meters away
-# clipping_distance_in_meters = 1
-# clipping_distance = clipping_distance_in_meters / depth_scale
+        self.frame_count = 0
+        self.last_task = None
+        self.errors = []
+        # per-run statistics for summaries
+        self.dropped_frames = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.elapsed = 0.
 
-# Create an align object
-# rs.align allows us to perform alignment of depth frames to others frames
-# The "align_to" is the stream type to which we plan to align depth frames.
-align_to = rs.stream.color
-align = rs.align(align_to)
+        self.manifest = checkpoint.ExtractionManifest(self.output_dir, {
+            "source": checkpoint.source_identity(bag_path),
+            "codec": self.codec.manifest(),
+            "archive": archive,
+            "start": start,
+            "end": end,
+            "skip_frames": skip_frames,
+            # depth is always aligned with rs.align, kept so earlier checkpoints still match
+            "align": "rs"})
 
+    def _prepare_output(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.codec.configure(self.output_dir)
 
-# Streaming loop
-try:
-    while True:
-        # Get frameset of color and depth
-        frames = pipe.wait_for_frames()
-        # frames.get_depth_frame() is a 640x360 depth image
+    def _verify_checkpoint(self, previous):
+        # keep only rows whose data is on disk, in frame order
+        self.manifest.truncate_indexes(previous["frames"])
+        timestamps, depth_names = frame_codec.read_index(self.depth_t_path)
+        rgb_timestamps, rgb_names = frame_codec.read_index(self.rgb_t_path)
+        # the four indexes are flushed separately, only rows all of them have are trusted
+        columns = [rgb_timestamps, frame_codec.read_index(self.sensor_time_file)[0],
+                   frame_codec.read_index(self.exposure_time_file)[0]]
+        rows = min([len(timestamps)] + [len(column) for column in columns])
+        agree = np.all([column[:rows] == timestamps[:rows] for column in columns], axis=0)
+        if not agree.all():
+            rows = int(np.argmin(agree))
+        verified = 0
+        for depth_name, rgb_name in zip(depth_names[:rows], rgb_names[:rows]):
+            if not (self.codec.verify(depth_name) and self.codec.verify(rgb_name)):
+                break
+            verified += 1
+        # a resume can only start at a chunk boundary of a chunked codec, the frames after it are redone
+        resumable = self.codec.resumable(verified)
+        if resumable < verified:
+            print(f"[INFO] Resuming at the chunk boundary after {resumable} frames, {verified - resumable} are extracted again")
+            verified = resumable
 
-        # Align the depth frame to color frame
-        aligned_frames = align.process(frames)
+        if verified == previous["frames"]:
+            self.resume_position = previous["position"]
+        else:
+            # the position of the last good frame is unknown, filter by timestamp instead
+            print(f"[INFO] Only {verified} of {previous['frames']} checkpointed frames verified")
+            self.manifest.truncate_indexes(verified)
+        if verified:
+            self.resume_after = float(timestamps[verified - 1])
+        return verified
 
-        # Get aligned frames
-        aligned_depth_frame = aligned_frames.get_depth_frame() # aligned_depth_frame is a 640x480 depth image
-        color_frame = aligned_frames.get_color_frame()
+    def _restore(self):
+        previous = self.manifest.load() if self.resume else None
+        if previous is not None and previous["complete"]:
+            return previous
+        if previous is not None and previous["frames"]:
+            self.resumed_frames = self._verify_checkpoint(previous)
+            self.codec.resume(self.resumed_frames)
+            print(f"[INFO] Resuming after {self.resumed_frames} frames")
+        else:
+            self.manifest.reset()
+        if self.archive:
+            self.archive_writer = frame_archive.FrameArchiveWriter(self.output_dir, self.resumed_frames)
+        self.index_writer = index_writer.IndexWriter(self.output_dir, frame_table=self.frame_table,
+                                                     resume_count=self.resumed_frames)
+        self.manifest.save(frames=self.resumed_frames, complete=False)
+        return None
 
-        # Validate that both frames are valid
-        if not aligned_depth_frame or not color_frame:
+    def _checkpoint(self, task, complete=False):
+        # a complete archive has already been closed
+        if self.archive_writer is not None and not complete:
+            self.archive_writer.checkpoint()
+        if not complete:
+            self.index_writer.flush()
+        self.manifest.save(frames=self.resumed_frames + self.frame_count, position=task.position,
+                           last_timestamp=task.timestr, complete=complete)
+
+    def _start_playback(self):
+        # bag sources decode as fast as possible instead of at the recorded rate
+        pipe = self.source
+        pipe.start()
+
+        # Getting the depth sensor's depth scale (see rs-align example for explanation)
+        depth_scale = 1. / pipe.get_depth_scale()
+        print("Depth Scale is: " , depth_scale)
+        with open(self.depth_scale_file, 'w') as f:
+            f.write(f"{depth_scale}\n")
+        return pipe
+
+    def _run_stage(self, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            self.errors.append(e)
+
+    def _read_frames(self, pipe):
+        start_position = self.start or 0
+        if self.resume_position is not None:
+            # frames between here and the checkpoint are dropped again by the resume_after filter
+            start_position = max(self.resume_position - RESUME_SEEK_MARGIN, start_position)
+        if start_position > 0:
+            pipe.seek(start_position)
+        elif self.resume_after is None:
+            # Skip first 10 frames
+            for x in range(self.skip_frames):
+                if not pipe.try_wait_for_frames()[0]:
+                    break
+
+        try:
+            while not self.errors:
+                # Get frameset of color and depth
+                ok, frames = pipe.try_wait_for_frames()
+                if not ok:
+                    break
+                position = pipe.get_position()
+                if self.end is not None and position > self.end:
+                    break
+                if self.start is not None and position < self.start:
+                    continue
+                # keep the frameset alive outside of the librealsense frame pool
+                frames.keep()
+                self.frame_queue.put((frames, position))
+        finally:
+            self.frame_queue.put(_END)
+
+    def _align_frames(self):
+        index = 0
+        try:
+            while True:
+                item = self.frame_queue.get()
+                if item is _END:
+                    break
+                frames, position = item
+
+                # Align the depth frame to color frame (rs.align for bag sources). utils.align is
+                # about 3x slower per frame and holds the GIL, so it is not offered here
+                aligned_frames = self.source.align_frames(frames)
+
+                # Get aligned frames
+                aligned_depth_frame = aligned_frames.get_depth_frame() # aligned_depth_frame is a 640x480 depth image
+                color_frame = aligned_frames.get_color_frame()
+
+                # Validate that both frames are valid
+                if not aligned_depth_frame or not color_frame:
+                    continue
+
+                # copy out of the frame buffers so the frameset can be released
+                depth_image = self.pool.copy(np.asanyarray(aligned_depth_frame.get_data()))
+                color_image = self.pool.copy(np.asanyarray(color_frame.get_data()))
+
+                ######### Timestamps ########
+                # Sensor(optical)_timestamp is a Firmware-generated timestamp that marks middle of sensor exposure.
+                # Frame_timestamp - Generated in FW; designates the beginning of UVC frame transmission. (the first USB chunk sent towards host).
+                # Sensor_timestamp and Frame_timestamp share the same clock and require the kernel patch for Video4Linux and registry patch for Windows OS.
+                #
+                # Backend_timestamp - Host clock applied to kernel-space buffers (URB) when the data from USB controller is copied to OS kernel. (HW->Kernel transition)
+                # Time_of_arrival - Host clock for the time when the frame buffer reaches Librealsense (kernel->user space transition).
+                #
+                # The relations hold:
+                # Sensor_timestamp << Frame_timestamp.
+                # Backend_timestamp << Time_of_arrival.
+                #
+                # The clocks of the first pair of timestamps and the second pairs are not related.
+                # Ref: https://github.com/IntelRealSense/librealsense/issues/12058
+                stamp_sensor = frames.get_frame_metadata(rs.frame_metadata_value.sensor_timestamp) / 1e6
+                stamp_frame = frames.get_frame_metadata(rs.frame_metadata_value.backend_timestamp) / 1e3
+                exposure_t = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+
+                # already extracted by the run we are resuming
+                if self.resume_after is not None and float(f"{stamp_frame:.8f}") <= self.resume_after:
+                    continue
+
+                self.encode_queue.put(FrameTask(index, f"{stamp_frame:.8f}", depth_image, color_image,
+                                                stamp_sensor, exposure_t, position, color_frame.get_frame_number()))
+                index += 1
+        finally:
+            for _ in range(self.workers):
+                self.encode_queue.put(_END)
+
+    def _encode_frames(self):
+        try:
+            while True:
+                task = self.encode_queue.get()
+                if task is _END:
+                    break
+                # OpenCV encoders release the GIL, so the encodes run in parallel
+                self.codec.encode(task)
+                # the images are encoded, drop the pixel data before handing over
+                # unless the ordered stage still has to copy it into the archive
+                if self.archive_writer is None:
+                    self._release_images(task)
+                self.done_queue.put(task)
+        finally:
+            self.done_queue.put(_END)
+
+    def _release_images(self, task):
+        # a codec that keeps the arrays until a later flush gets to keep them
+        if not self.codec.retains_frames:
+            self.pool.put(task.depth_image)
+            self.pool.put(task.color_image)
+        task.depth_image = None
+        task.color_image = None
+
+    def _write_index(self, task):
+        self.index_writer.write(task)
+        if self.progress is not None:
+            self.progress.update(self.frame_count + 1, task.position)
+
+    def _update_stats(self, task):
+        # gaps in the color frame counter are frames the recording dropped
+        if self.last_task is not None and task.frame_number is not None and self.last_task.frame_number is not None:
+            self.dropped_frames += max(task.frame_number - self.last_task.frame_number - 1, 0)
+        if self.first_timestamp is None:
+            self.first_timestamp = float(task.timestr)
+        self.last_timestamp = float(task.timestr)
+
+    def summary(self):
+        duration = self.last_timestamp - self.first_timestamp if self.first_timestamp is not None else 0.
+        return {"bag": str(self.bag_path),
+                "output_dir": str(self.output_dir),
+                "frames": self.resumed_frames + self.frame_count,
+                "extracted_frames": self.frame_count,
+                "resumed_frames": self.resumed_frames,
+                "dropped_frames": self.dropped_frames,
+                "duration_sec": duration,
+                "elapsed_sec": self.elapsed,
+                "frames_per_sec": self.frame_count / self.elapsed if self.elapsed > 0 else 0.,
+                "buffer_pool": self.pool.stats()}
+
+    def _collect_results(self):
+        # workers finish out of order, index rows are written in frame order
+        pending = {}
+        next_index = 0
+        finished_workers = 0
+        since_checkpoint = 0
+        while finished_workers < self.workers:
+            task = self.done_queue.get()
+            if task is _END:
+                finished_workers += 1
+                continue
+            pending[task.index] = task
+            while next_index in pending:
+                task = pending.pop(next_index)
+                self.codec.commit(task)
+                if self.archive_writer is not None:
+                    self.archive_writer.append(float(task.timestr), task.depth_image, task.color_image,
+                                               task.stamp_sensor, task.exposure_t)
+                    self._release_images(task)
+                self._write_index(task)
+                self._update_stats(task)
+                next_index += 1
+                self.frame_count += 1
+                since_checkpoint += 1
+                # only checkpoint once everything up to this frame is on disk
+                if since_checkpoint >= self.checkpoint_every and self.codec.pending_count() == 0:
+                    self._checkpoint(task)
+                    since_checkpoint = 0
+                self.last_task = task
+
+    def run(self):
+        self._prepare_output()
+        previous = self._restore()
+        if previous is not None:
+            print(f"[INFO] {self.output_dir} is already extracted ({previous['frames']} frames), use --restart to redo it")
+            self.resumed_frames = previous["frames"]
+            return previous["frames"]
+        pipe = self._start_playback()
+        if self.verbose:
+            self.progress = index_writer.ProgressLine(self.end or getattr(pipe, "get_duration", lambda: None)())
+
+        stages = [threading.Thread(target=self._run_stage, args=(self._read_frames, pipe), daemon=True),
+                  threading.Thread(target=self._run_stage, args=(self._align_frames,), daemon=True)]
+        stages += [threading.Thread(target=self._run_stage, args=(self._encode_frames,), daemon=True)
+                   for _ in range(self.workers)]
+
+        start_time = time.perf_counter()
+        try:
+            for stage in stages:
+                stage.start()
+            self._collect_results()
+            # a failed stage can leave its neighbours blocked on a full queue
+            if not self.errors:
+                for stage in stages:
+                    stage.join()
+                self.codec.close()
+                if self.archive_writer is not None:
+                    self.archive_writer.close()
+                self.index_writer.close()
+                if self.last_task is not None:
+                    self._checkpoint(self.last_task, complete=True)
+                else:
+                    self.manifest.save(complete=True)
+        finally:
+            pipe.stop()
+            # rows after the last checkpoint are kept for inspection, a resume truncates them
+            self.index_writer.close()
+            if self.progress is not None:
+                self.progress.close()
+        elapsed = time.perf_counter() - start_time
+        self.elapsed = elapsed
+
+        if self.errors:
+            raise self.errors[0]
+
+        fps = self.frame_count / elapsed if elapsed > 0 else 0.
+        print(f"[INFO] Extracted {self.frame_count} frames in {elapsed:.1f} sec ({fps:.1f} frames/sec, {self.workers} workers)")
+        if self.resumed_frames:
+            print(f"[INFO] {self.resumed_frames} frames were kept from the previous run")
+        if self.verbose:
+            print("[INFO] " + self.pool.summary())
+        return self.resumed_frames + self.frame_count
+
+
+def find_bags(pattern):
+    # a directory is searched recursively for .bag files, anything else is a glob
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(path.rglob("*.bag"))
+    return sorted(Path(p) for p in glob.glob(pattern, recursive=True) if p.endswith(".bag"))
+
+
+def extract_one(bag_path, options):
+    # runs in a worker process, failures are reported instead of raised
+    try:
+        codec = frame_codec.create_codec(**options["codec"])
+        pipeline = ExtractionPipeline(bag_path, workers=options["workers"], codec=codec,
+                                      archive=options["archive"], resume=options["resume"],
+                                      start=options["start"], end=options["end"], verbose=False,
+                                      frame_table=options["frame_table"])
+        pipeline.run()
+        return dict(pipeline.summary(), status="ok")
+    except Exception as e:
+        return {"bag": str(bag_path), "status": "failed", "error": repr(e),
+                "traceback": traceback.format_exc()}
+
+
+def extract_batch(bag_paths, options, jobs, summary_path):
+    print(f"[INFO] Extracting {len(bag_paths)} bags with {jobs} processes")
+    summaries = []
+    total_frames = 0
+    start_time = time.perf_counter()
+
+    def report(summary):
+        nonlocal total_frames
+        summaries.append(summary)
+        elapsed = time.perf_counter() - start_time
+        if summary["status"] == "ok":
+            total_frames += summary["extracted_frames"]
+            print(f"[INFO] [{len(summaries)}/{len(bag_paths)}] {summary['bag']}: {summary['frames']} frames, "
+                  f"{summary['dropped_frames']} dropped, {summary['duration_sec']:.1f} sec "
+                  f"| total {total_frames} frames, {total_frames / elapsed:.1f} frames/sec")
+        else:
+            print(f"[ERROR] [{len(summaries)}/{len(bag_paths)}] {summary['bag']}: {summary['error']}")
+
+    # extract_one catches Python errors, but a worker that dies (a librealsense segfault on a
+    # corrupt bag, an OOM kill) breaks the whole pool and fails every bag still in it. The
+    # unfinished bags then run again one at a time, where the first one to break the pool is
+    # the culprit; it is reported as failed and the rest carry on in a fresh pool.
+    remaining = list(bag_paths)
+    workers = jobs
+    while remaining:
+        broken = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(extract_one, bag_path, options): bag_path for bag_path in remaining}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    report(future.result())
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    broken.append((futures[future], e))
+        if not broken:
+            break
+        broken.sort(key=lambda item: remaining.index(item[0]))
+        if workers > 1:
+            print(f"[ERROR] A worker process died, retrying {len(broken)} unfinished bags one at a time")
+            workers = 1
+            remaining = [bag_path for bag_path, _ in broken]
             continue
+        bag_path, error = broken[0]
+        report({"bag": str(bag_path), "status": "failed", "error": f"worker process died: {error!r}",
+                "traceback": None})
+        workers = jobs
+        remaining = [bag_path for bag_path, _ in broken[1:]]
+
+    summaries.sort(key=lambda s: s["bag"])
+    failed = [s for s in summaries if s["status"] != "ok"]
+    with open(summary_path, "w") as f:
+        json.dump({"bags": len(summaries), "failed": len(failed), "frames": total_frames,
+                   "elapsed_sec": time.perf_counter() - start_time, "summaries": summaries}, f, indent=2)
+    print(f"[INFO] {len(summaries) - len(failed)} bags extracted, {len(failed)} failed, summary in {summary_path}")
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract aligned depth and color images from a recorded bag file.")
+    parser.add_argument("bag_path", type=str,
+                        help="Path to the bag file, or a directory / glob of bags for batch extraction")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of encoder/writer workers per bag")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="Bags extracted in parallel in batch mode")
+    parser.add_argument("--summary", type=str, help="Batch summary JSON path (default: batch_summary.json in the directory)")
+    parser.add_argument("--codec", choices=frame_codec.CODECS, default="png",
+                        help="Output format: png, tiff or pnm files per frame, or chunked .npz archives")
+    parser.add_argument("--png-compression", type=int, default=3,
+                        help="PNG compression level 0-9, lower is faster")
+    parser.add_argument("--tiff-compression", choices=list(frame_codec.TIFF_COMPRESSION), default="lzw",
+                        help="TIFF compression scheme")
+    parser.add_argument("--chunk-size", type=int, default=300, help="Frames per chunk for the chunk codec")
+    parser.add_argument("--chunk-color", choices=["jpeg", "raw"], default="jpeg",
+                        help="Color storage for the chunk codec")
+    parser.add_argument("--jpeg-quality", type=int, default=95, help="JPEG quality for chunked color")
+    parser.add_argument("--chunk-compression", type=int, default=1,
+                        help="zlib level 0-9 of the chunk codec, 0 stores the arrays uncompressed")
+    parser.add_argument("--archive", action="store_true",
+                        help="Also write a memory-mapped raw frame archive for fast repeated reads")
+    parser.add_argument("--start", type=float, help="Start of the extracted range, seconds from the start of the bag")
+    parser.add_argument("--end", type=float, help="End of the extracted range, seconds from the start of the bag")
+    parser.add_argument("--no-frame-table", action="store_true",
+                        help="Only write the text indexes, not the binary frames.bin table")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the checkpoint manifest and extract from scratch")
+    args = parser.parse_args()
+    print("Environment Ready")
+
+    codec_options = dict(name=args.codec, png_compression=args.png_compression,
+                         tiff_compression=args.tiff_compression, chunk_size=args.chunk_size,
+                         color_format=args.chunk_color, jpeg_quality=args.jpeg_quality,
+                         chunk_compression=args.chunk_compression)
 
-        depth_image = np.asanyarray(aligned_depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
-        # color_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB)
-
-        # # Remove background - Set pixels further than clipping_distance to 0
-        # bg_color = 0
-        # depth_image_3d = np.dstack((depth_image,depth_image,depth_image)) #depth image is 1 channel, color is 3 channels
-        # bg_removed = np.where((depth_image_3d > clipping_distance) | (depth_image_3d <= 0), bg_color, color_image)
-
-        # # Render images:
-        # #   depth align to color on left
-        # #   depth on right
-        # depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-        # images = np.hstack((bg_removed, depth_colormap))
-
-        # cv2.namedWindow('Align Example', cv2.WINDOW_NORMAL)
-        # cv2.imshow('Align Example', images)
-        # key = cv2.waitKey(1)
-        # # Press esc or 'q' to close the image window
-        # if key & 0xFF == ord('q') or key == 27:
-        #     cv2.destroyAllWindows()
-        #     break
-        
-        ######### Timestamps ########
-        # Sensor(optical)_timestamp is a Firmware-generated timestamp that marks middle of sensor exposure.
-        # Frame_timestamp - Generated in FW; designates the beginning of UVC frame transmission. (the first USB chunk sent towards host).
-        # Sensor_timestamp and Frame_timestamp share the same clock and require the kernel patch for Video4Linux and registry patch for Windows OS.
-        #
-        # Backend_timestamp - Host clock applied to kernel-space buffers (URB) when the data from USB controller is copied to OS kernel. (HW->Kernel transition)
-        # Time_of_arrival - Host clock for the time when the frame buffer reaches Librealsense (kernel->user space transition).
-        #
-        # The relations hold:
-        # Sensor_timestamp << Frame_timestamp.
-        # Backend_timestamp << Time_of_arrival.
-        #
-        # The clocks of the first pair of timestamps and the second pairs are not related.
-        # Ref: https://github.com/IntelRealSense/librealsense/issues/12058
-
-        stamp_sensor = frames.get_frame_metadata(rs.frame_metadata_value.sensor_timestamp) / 1e6
-        stamp_frame = frames.get_frame_metadata(rs.frame_metadata_value.backend_timestamp) / 1e3
-        timestr = f"{stamp_frame:.8f}"
-        image_name = f"{timestr}.png"
-
-        with open(depth_t_path,'a') as file:
-            file.write(f"{timestr} depth/{image_name}\n")
-        cv2.imwrite(str(depth_path / image_name), depth_image)
-        print(depth_path / image_name)
-
-        with open(rgb_t_path,'a') as file:
-            file.write(f"{timestr} rgb/{image_name}\n")
-        cv2.imwrite(str(rgb_path / image_name), color_image)
-        print(rgb_path / image_name)
-
-        ###### sensor timestamp #####
-        with open(sensor_time_file, 'a') as file:
-            file.write(f"{timestr} {stamp_sensor:.8f}\n")
-
-        ###### exposure time #####
-        exposure_t = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
-        with open(exposure_time_file, 'a') as file:
-            file.write(f"{timestr} {exposure_t}\n")
-
-finally:
-    pipe.stop()
\ No newline at end of file
+    bag_path = Path(args.bag_path)
+    if bag_path.is_file():
+        codec = frame_codec.create_codec(**codec_options)
+        ExtractionPipeline(bag_path, workers=args.workers or os.cpu_count(), codec=codec, archive=args.archive,
+                           resume=not args.restart, start=args.start, end=args.end,
+                           frame_table=not args.no_frame_table).run()
+    else:
+        bag_paths = find_bags(args.bag_path)
+        assert bag_paths, f"No bag files found in {args.bag_path}"
+        # split the cores between the bags running at the same time
+        workers = args.workers or max(1, (os.cpu_count() or 1) // args.jobs)
+        options = dict(codec=codec_options, workers=workers, archive=args.archive,
+                       resume=not args.restart, start=args.start, end=args.end,
+                       frame_table=not args.no_frame_table)
+        summary_path = args.summary
+        if summary_path is None:
+            base = bag_path if bag_path.is_dir() else Path(os.path.commonpath([str(p.parent) for p in bag_paths]))
+            summary_path = base / "batch_summary.json"
+        summaries = extract_batch(bag_paths, options, args.jobs, summary_path)
+        sys.exit(1 if any(s["status"] != "ok" for s in summaries) else 0)
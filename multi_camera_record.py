@@ -0,0 +1,290 @@
+import os
+import time
+import json
+import signal
+import argparse
+import multiprocessing
+import numpy as np
+import pyrealsense2 as rs
+
+from utils import logger
+from utils import device_profile
+from utils import telemetry
+from utils import frame_source
+from auto_exposure import AE_ALGORITHMS, create_ae, next_exposure
+
+# Records every connected camera at once. Each device runs its own capture
+# loop and AE instance in a separate process, so the GIL never serializes
+# them, and writes its bag and metadata to <session>/<serial>/. Synthetic
+# sources or recorded bags can stand in for the cameras. After recording the
+# per-frame timestamps of all devices are matched against the first device
+# and summarized in <session>/alignment_report.json.
+
+FRAME_LOG = "frame_timestamps.txt"
+
+
+def device_specs(args):
+    if args.source == "synthetic":
+        return [{"name": f"synthetic{i}", "source": "synthetic"} for i in range(args.devices)]
+    if args.source == "bag":
+        return [{"name": os.path.splitext(os.path.basename(bag))[0] + f"_{i}", "source": "bag", "bag": bag}
+                for i, bag in enumerate(args.bags)]
+    devices = frame_source.list_devices()
+    if args.serials:
+        devices = [d for d in devices if d[0] in args.serials]
+    for serial, name, firmware in devices:
+        print(f"[INFO] Found {name} {serial} (firmware {firmware})")
+    return [{"name": serial, "source": "camera", "serial": serial} for serial, _, _ in devices]
+
+
+def open_device(spec, index, device_dir, options):
+    width, height, framerate = options["width"], options["height"], options["framerate"]
+    if spec["source"] == "synthetic":
+        # different scenes per device so the AE instances do not move in lockstep
+        source = frame_source.SyntheticSource(width, height, framerate, depth=options["depth"], realtime=True,
+                                              seed=index, scene_gain=1.0 + 0.2 * index)
+        color_sensor = source.get_color_sensor()
+        return source, color_sensor, color_sensor.get_option_range(rs.option.exposure)
+    if spec["source"] == "bag":
+        # playback sensors are read-only, AE runs but cannot change the exposure
+        return frame_source.BagSource(spec["bag"], realtime=True), None, None
+
+    streams = [(rs.stream.color, width, height, rs.format.bgr8, framerate)]
+    if options["depth"]:
+        streams.append((rs.stream.depth, width, height, rs.format.z16, framerate))
+    # sensor indices and option ranges come from the per-device profile cache
+    profile, device_sensors = device_profile.load_device_profile(frame_source.find_device(spec["serial"]), streams,
+                                                                 refresh=options["refresh_profile"])
+    source = frame_source.LiveCameraSource(os.path.join(device_dir, "data.bag"), spec["serial"])
+    for stream in streams:
+        source.enable_stream(*stream)
+    logger.save_device_profile(profile, *[device_profile.stream_key(*stream) for stream in streams],
+                               dir_path=device_dir)
+    if options["hw_sync"]:
+        # first camera drives the sync cable, the others follow
+        device_sensors[profile.depth_index].set_option(rs.option.inter_cam_sync_mode, 1 if index == 0 else 2)
+    return source, device_sensors[profile.rgb_index], profile.option_range("rgb", "exposure")
+
+
+def record_device(spec, index, session_dir, options, barrier, stop_event, results):
+    # runs in its own process, Ctrl+C is handled by the parent through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    name = spec["name"]
+    device_dir = os.path.join(session_dir, name)
+    os.makedirs(device_dir, exist_ok=True)
+    summary = {"device": name, "source": spec["source"], "dir": device_dir, "status": "ok"}
+    source = None
+    savers = []
+    try:
+        source, color_sensor, exposure_range = open_device(spec, index, device_dir, options)
+        framerate = options["framerate"]
+
+        exposure_time_saver = logger.ExposureTimeSaver(background=True, dir_path=device_dir)
+        timestamps_saver = logger.TimeStampSaver(background=True, dir_path=device_dir)
+        # full precision timestamps for the cross-device alignment report
+        frame_log = logger.MetadataSink(os.path.join(device_dir, FRAME_LOG), background=True)
+        savers = [exposure_time_saver, timestamps_saver, frame_log]
+        capture_telemetry = telemetry.CaptureTelemetry(framerate, os.path.join(device_dir, telemetry.SUMMARY_FILE))
+
+        intial_exposure_time = 25
+        max_exposure_time = min_exposure_time = intial_exposure_time
+        if color_sensor is not None:
+            color_sensor.set_option(rs.option.enable_auto_exposure, False)
+            color_sensor.set_option(rs.option.enable_auto_white_balance, False)
+            color_sensor.set_option(rs.option.power_line_frequency, 1)
+            color_sensor.set_option(rs.option.global_time_enabled, 1)
+            max_exposure_time = min(1 / framerate * 1e3, exposure_range.max * 0.1) - 2
+            min_exposure_time = exposure_range.min
+            color_sensor.set_option(rs.option.exposure, intial_exposure_time * 10)
+
+        source.start()
+        # start all loops together so the first frames are comparable
+        try:
+            barrier.wait(timeout=30)
+        except Exception:
+            print(f"[ERROR] {name}: not all devices started, recording anyway")
+
+        frames = source.wait_for_frames()
+        auto_exposure = create_ae(options["ae"], intial_exposure_time, max_exposure_time, min_exposure_time,
+                                  np.asanyarray(frames.get_color_frame().get_data()))
+        print(f"[INFO] {name}: recording, initial brightness {auto_exposure.w_avg_bright:.1f}")
+
+        next_exposure_time = intial_exposure_time * 10
+        start_time = time.monotonic()
+        while not stop_event.is_set():
+            if options["duration"] and time.monotonic() - start_time >= options["duration"]:
+                break
+            # set exposure time
+            manual_exposure_time = next_exposure_time
+            if color_sensor is not None:
+                color_sensor.set_option(rs.option.exposure, manual_exposure_time)
+
+            # Wait for a frames metadata
+            with capture_telemetry.stage("wait"):
+                ok, frames = source.try_wait_for_frames()
+            if not ok:
+                break
+            arrival = time.time()
+            color_frame = frames.get_color_frame()
+            if not color_frame:
+                continue
+
+            color_image = np.asanyarray(color_frame.get_data())
+            actual_exp_time = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+            color_sensor_timestamp = color_frame.get_timestamp() / 1000
+            frame_number = color_frame.get_frame_number()
+            capture_telemetry.frame(frame_number, color_sensor_timestamp)
+
+            with capture_telemetry.stage("logging"):
+                exposure_time_saver.save_exposure_time(actual_exp_time / 10)
+                timestamps_saver.save_timestamps(color_sensor_timestamp)
+                frame_log.write_line(f"{frame_number} {color_sensor_timestamp:.6f} {arrival:.6f}")
+
+            # calculate exposure time for next frame
+            with capture_telemetry.stage("ae"):
+                next_exposure_time = next_exposure(auto_exposure, color_image, manual_exposure_time, actual_exp_time)
+
+        summary.update(capture_telemetry.write_summary())
+    except Exception as e:
+        summary.update(status="failed", error=repr(e))
+        print(f"[ERROR] {name}: {e!r}")
+        # a device that failed before the barrier would keep the others waiting for the full
+        # timeout, aborting breaks it for them at once (a no-op once everyone passed it)
+        barrier.abort()
+    finally:
+        if source is not None:
+            try:
+                source.stop()
+            except Exception:
+                pass
+        for saver in savers:
+            saver.close()
+        results.put(summary)
+
+
+def load_frame_log(path):
+    # (frame_number, sensor_timestamp, host_arrival) columns
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros((0, 3))
+    return np.loadtxt(path, ndmin=2)
+
+
+def alignment_report(session_dir, names, framerate):
+    # match every frame of the reference device to the nearest frame of each other device
+    period = 1. / framerate
+    logs = {name: load_frame_log(os.path.join(session_dir, name, FRAME_LOG)) for name in names}
+    reference = names[0]
+    ref_times = logs[reference][:, 1]
+    report = {"reference": reference, "framerate": framerate, "frames": {n: len(l) for n, l in logs.items()},
+              "devices": {}}
+    for name in names[1:]:
+        times = logs[name][:, 1]
+        if not len(ref_times) or not len(times):
+            report["devices"][name] = {"matched": 0}
+            continue
+        if len(times) == 1:
+            i = np.zeros(len(ref_times), dtype=int)
+        else:
+            # nearest of the two neighbours
+            i = np.clip(np.searchsorted(times, ref_times), 1, len(times) - 1)
+            i -= (ref_times - times[i - 1]) < (times[i] - ref_times)
+        offsets = times[i] - ref_times
+        matched = np.abs(offsets) <= period / 2
+        entry = {"matched": int(matched.sum()), "unmatched": int((~matched).sum()),
+                 "matched_fraction": float(matched.mean())}
+        if matched.any():
+            abs_offsets = np.abs(offsets[matched]) * 1e3
+            entry.update(median_offset_ms=float(np.median(offsets[matched]) * 1e3),
+                         p95_abs_offset_ms=float(np.percentile(abs_offsets, 95)),
+                         max_abs_offset_ms=float(abs_offsets.max()))
+        if matched.sum() >= 2:
+            # clock drift as the slope of the offset over the recording
+            slope = np.polyfit(ref_times[matched] - ref_times[0], offsets[matched], 1)[0]
+            entry["drift_ms_per_min"] = float(slope * 60e3)
+        report["devices"][name] = entry
+
+    with open(os.path.join(session_dir, "alignment_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    for name, entry in report["devices"].items():
+        if "median_offset_ms" in entry:
+            print(f"[INFO] {name} vs {reference}: {entry['matched']} matched frames "
+                  f"({entry['matched_fraction'] * 100:.1f}%), median offset {entry['median_offset_ms']:.2f} ms, "
+                  f"p95 {entry['p95_abs_offset_ms']:.2f} ms, drift {entry.get('drift_ms_per_min', 0.):.3f} ms/min")
+        else:
+            print(f"[ERROR] {name} vs {reference}: no matching frames")
+    return report
+
+
+def record_session(specs, session_dir, options):
+    os.makedirs(session_dir, exist_ok=True)
+    # spawn, librealsense contexts do not survive a fork
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(len(specs))
+    stop_event = ctx.Event()
+    results = ctx.Queue()
+    processes = [ctx.Process(target=record_device, args=(spec, i, session_dir, options, barrier, stop_event, results))
+                 for i, spec in enumerate(specs)]
+    for process in processes:
+        process.start()
+
+    summaries = []
+    try:
+        while len(summaries) < len(processes):
+            try:
+                summaries.append(results.get(timeout=0.5))
+            except Exception:
+                if not any(p.is_alive() for p in processes) and results.empty():
+                    break
+    except KeyboardInterrupt:
+        print("[INFO] Stopping all devices")
+        stop_event.set()
+        while len(summaries) < len(processes):
+            try:
+                summaries.append(results.get(timeout=10))
+            except Exception:
+                break
+    for process in processes:
+        process.join()
+
+    summaries.sort(key=lambda s: [spec["name"] for spec in specs].index(s["device"]))
+    names = [s["device"] for s in summaries if s["status"] == "ok"]
+    report = alignment_report(session_dir, names, options["framerate"]) if len(names) > 1 else None
+    with open(os.path.join(session_dir, "session.json"), "w") as f:
+        json.dump({"options": options, "devices": summaries, "alignment": report}, f, indent=2)
+    for s in summaries:
+        if s["status"] == "ok":
+            print(f"[INFO] {s['device']}: {s['frames']} frames, {s['dropped_frames']} dropped")
+        else:
+            print(f"[ERROR] {s['device']}: {s['error']}")
+    return summaries, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record several cameras at once, one process per device.")
+    parser.add_argument("--source", choices=["camera", "synthetic", "bag"], default="camera",
+                        help="Real cameras, synthetic stand-ins or recorded bags played back as devices")
+    parser.add_argument("--devices", type=int, default=2, help="Number of synthetic devices")
+    parser.add_argument("--bags", nargs="+", default=[], help="Bag files standing in for the devices")
+    parser.add_argument("--serials", nargs="+", help="Only record these camera serial numbers")
+    parser.add_argument("--session", type=str, help="Session directory (default ./bags/multi_<time>)")
+    parser.add_argument("--duration", type=float, default=0, help="Seconds to record, 0 records until Ctrl+C")
+    parser.add_argument("--framerate", type=int, default=15)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--depth", action="store_true", help="Also record the depth stream")
+    parser.add_argument("--ae", choices=list(AE_ALGORITHMS), default="baseline",
+                        help="Auto exposure engine, baseline is the original closed-form controller")
+    parser.add_argument("--hw-sync", action="store_true",
+                        help="Hardware sync over the sync cable, the first camera is the master")
+    parser.add_argument("--refresh-profile", action="store_true",
+                        help="Query the cameras again instead of loading the cached device profiles")
+    args = parser.parse_args()
+
+    specs = device_specs(args)
+    assert specs, "No devices to record"
+    session_dir = args.session or os.path.expanduser("./bags/multi_" + time.strftime("%Y%m%d-%H%M%S"))
+    options = dict(width=args.width, height=args.height, framerate=args.framerate, depth=args.depth,
+                   duration=args.duration, hw_sync=args.hw_sync,
+                   refresh_profile=args.refresh_profile, ae=args.ae)
+    print(f"[INFO] Recording {len(specs)} devices to {session_dir}")
+    record_session(specs, session_dir, options)
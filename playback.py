@@ -1,64 +1,271 @@
 import cv2
+import time
+import queue
 import os.path
 import argparse
+import threading
 import numpy as np
-import pyrealsense2 as rs
-
-# Create object for parsing command-line options
-parser = argparse.ArgumentParser(description="Read recorded bag file and display depth stream in jet colormap.\
-                                Remember to change the stream fps and format to match the recorded.")
-# Add argument which takes path to a bag file as an input
-parser.add_argument("-i", "--input", type=str, help="Path to the bag file")
-# Parse the command line arguments to an object
-args = parser.parse_args()
-# Safety if no parameter have been given
-if not args.input:
-    print("No input paramater have been given.")
-    print("For help type --help")
-    exit()
-# Check if the given file have bag extension
-if os.path.splitext(args.input)[1] != ".bag":
-    print("The given file is not of correct file format.")
-    print("Only .bag files are accepted")
-    exit()
-try:
-    # Create pipeline
-    pipeline = rs.pipeline()
-
-    # Create a config object
-    config = rs.config()
-
-    # Tell config that we will use a recorded device from file to be used by the pipeline through playback.
-    rs.config.enable_device_from_file(config, args.input)
-
-    # Configure the pipeline to stream the depth stream
-    # Change this parameters according to the recorded bag file resolution
-    framerate = 30
-    config.enable_stream(rs.stream.color, rs.format.bgr8, framerate)
-    config.enable_stream(rs.stream.depth, rs.format.z16, framerate)
-
-    # Start streaming from file
-    pipeline.start(config)
-
-    # Create opencv window to render image in
-    cv2.namedWindow("Color Stream", cv2.WINDOW_AUTOSIZE)
-
-    # Streaming loop
-    while True:
-        # Get frameset of depth
-        frames = pipeline.wait_for_frames()
-
-        # Get depth frame
-        color_frame = frames.get_color_frame()
-        color_image = np.asanyarray(color_frame.get_data())
-
-        # Render image in opencv window
-        cv2.imshow("Color Stream", color_image)
-        key = cv2.waitKey(1)
-        # if pressed escape exit program
-        if key & 0xFF == ord('q') or key == 27:
-            cv2.destroyAllWindows()
-            break
-
-finally:
-    pass
\ No newline at end of file
+
+from utils import frame_source
+from utils import bag_index
+from utils import viewer
+
+# marks the end of the recording in the prefetch queue
+_END = None
+
+
+class Player:
+    # Plays any seekable frame source (bags, synthetic) against a playback
+    # clock running at speed times real time. A prefetch thread decodes ahead
+    # into a bounded queue; when it falls more than max_lag seconds behind the
+    # clock it seeks forward instead of decoding every frame in between, and
+    # the display side drops frames that are already late. speed 0 plays as
+    # fast as decoding allows. Every seek bumps a generation number so frames
+    # decoded before it are never shown, and stops the clock until the first
+    # frame after the seek arrives so slow seeks do not count as lag.
+    def __init__(self, source, index=None, speed=1.0, queue_size=8, max_lag=1.0, loop=False):
+        self.source = source
+        self.index = index
+        self.speed = speed
+        self.max_lag = max_lag
+        self.loop = loop
+        self.duration = index.duration if index is not None else source.get_duration()
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.seek_to = None
+        self.generation = 0
+        self.paused = False
+        # the clock reads clock_position at wall time clock_start, None while it waits for a frame
+        self.clock_position = 0.
+        self.clock_start = None
+        self.decoded = 0
+        self.skipped = 0
+        self.seeks = 0
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+
+    def start(self, position=0.):
+        self.source.start()
+        if position > 0:
+            self.seek(position)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        # unblock the prefetch thread if it waits on a full queue
+        self._drain()
+        self.thread.join(timeout=2)
+        self.source.stop()
+
+    def position(self):
+        # playback clock in seconds from the start of the recording
+        with self.lock:
+            return self._position()
+
+    def _position(self):
+        if self.paused or self.clock_start is None or self.speed <= 0:
+            return self.clock_position
+        return self.clock_position + self.speed * (time.perf_counter() - self.clock_start)
+
+    def _set_clock(self, position):
+        self.clock_position = position
+        self.clock_start = time.perf_counter()
+
+    def _drain(self):
+        try:
+            while True:
+                self.frames.get_nowait()
+        except queue.Empty:
+            pass
+
+    def seek(self, position):
+        position = min(max(position, 0.), self.duration)
+        with self.lock:
+            self.seek_to = position
+            self.generation += 1
+            self.clock_position = position
+            self.clock_start = None
+        self._drain()
+
+    def set_speed(self, speed):
+        with self.lock:
+            self._set_clock(self._position())
+            self.speed = speed
+
+    def toggle_pause(self):
+        with self.lock:
+            self._set_clock(self._position())
+            self.paused = not self.paused
+
+    def frame_index(self, position):
+        return self.index.index_at(position) if self.index is not None else None
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _prefetch(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                seek_to, self.seek_to = self.seek_to, None
+                generation = self.generation
+            if seek_to is not None:
+                self.source.seek(seek_to)
+                self.seeks += 1
+
+            ok, frames = self.source.try_wait_for_frames()
+            if not ok:
+                if self.loop:
+                    self.seek(0.)
+                    continue
+                self._put(_END)
+                return
+            position = self.source.get_position()
+            with self.lock:
+                behind = self.speed > 0 and self._position() - position > self.max_lag
+                if behind and self.seek_to is None:
+                    # jump to the clock, frames in between would only be dropped
+                    self.seek_to = self._position()
+            if behind:
+                self.skipped += 1
+                continue
+
+            color_frame = frames.get_color_frame()
+            depth_frame = frames.get_depth_frame()
+            # copy out of the frame buffers so the frameset can be released
+            color_image = np.asanyarray(color_frame.get_data()).copy() if color_frame else None
+            depth_image = np.asanyarray(depth_frame.get_data()).copy() if depth_frame else None
+            self.decoded += 1
+            self._put((generation, position, color_image, depth_image))
+
+    def next_frame(self):
+        # (position, color, depth) of the next frame due, None at the end of the recording
+        while not self.stopped.is_set():
+            try:
+                item = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return None
+            generation, position, color_image, depth_image = item
+            if generation != self.generation:
+                continue
+            with self.lock:
+                if self.clock_start is None:
+                    self._set_clock(position)
+            if self.speed > 0:
+                # late by more than a tenth of a second of wall time: drop it
+                if self.position() - position > 0.1 * self.speed:
+                    self.skipped += 1
+                    continue
+                wait = (position - self.position()) / self.speed
+                if wait > 0:
+                    time.sleep(min(wait, 1.))
+            return position, color_image, depth_image
+        return None
+
+
+def side_by_side(depth_preview, color_image, depth_image):
+    if depth_image is None:
+        return color_image
+    if color_image is None:
+        return depth_preview.colorize(depth_image)
+    if depth_image.shape[0] != color_image.shape[0]:
+        # unaligned depth of another resolution, matched to the color height
+        width = int(round(depth_image.shape[1] * color_image.shape[0] / depth_image.shape[0]))
+        depth_image = cv2.resize(depth_image, (width, color_image.shape[0]), interpolation=cv2.INTER_NEAREST)
+    return depth_preview.render(color_image, depth_image)
+
+
+if __name__ == "__main__":
+    # Create object for parsing command-line options
+    parser = argparse.ArgumentParser(description="Play a recorded bag file with color and depth side by side. "
+                                                 "Keys: space pause, a/d seek -/+5 sec, s/w half/double speed, "
+                                                 "q or Esc quit.")
+    # Add argument which takes path to a bag file as an input
+    parser.add_argument("-i", "--input", type=str, help="Path to the bag file")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Playback speed, 0 plays as fast as decoding allows")
+    parser.add_argument("--start", type=float, default=0., help="Start position in seconds")
+    parser.add_argument("--loop", action="store_true", help="Start over at the end of the recording")
+    parser.add_argument("--preview-fps", type=float, default=0,
+                        help="Display refresh limit, frames in between are decoded but not shown")
+    parser.add_argument("--min-depth", type=float, default=0.3, help="Depth preview range start in meters")
+    parser.add_argument("--max-depth", type=float, default=5.0, help="Depth preview range end in meters")
+    parser.add_argument("--colormap", choices=list(viewer.DEPTH_COLORMAPS), default="jet",
+                        help="Depth preview colormap")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the cached timestamp index")
+    # Parse the command line arguments to an object
+    args = parser.parse_args()
+    # Safety if no parameter have been given
+    if not args.input:
+        print("No input paramater have been given.")
+        print("For help type --help")
+        exit()
+    # Check if the given file have bag extension
+    if os.path.splitext(args.input)[1] != ".bag":
+        print("The given file is not of correct file format.")
+        print("Only .bag files are accepted")
+        exit()
+
+    # timestamp index cached next to the bag, on the first open it is built in the background
+    # while playback starts and frame numbers are shown once it is done
+    index = None if args.reindex else bag_index.load_cached(args.input)
+    indexer = None
+    if index is None:
+        print(f"[INFO] Indexing {args.input} in the background")
+        indexer = bag_index.BackgroundIndexer(args.input)
+    else:
+        print(f"[INFO] {len(index)} frames, {index.duration:.1f} sec")
+
+    # the player keeps time itself, the bag is decoded as fast as it is consumed
+    source = frame_source.BagSource(args.input, realtime=False)
+    player = Player(source, index, args.speed, loop=args.loop)
+    player.start(args.start)
+    depth_preview = viewer.DepthPreview(source.get_depth_scale(), args.min_depth, args.max_depth, args.colormap)
+    preview = viewer.Viewer("Playback", args.preview_fps)
+
+    image = None
+    try:
+        while True:
+            if indexer is not None and indexer.index is not None:
+                index = player.index = indexer.index
+                indexer = None
+            if not player.paused:
+                item = player.next_frame()
+                if item is None:
+                    break
+                position, color_image, depth_image = item
+                if not preview.due():
+                    preview.skipped += 1
+                    continue
+                image = side_by_side(depth_preview, color_image, depth_image)
+                frame_text = f"frame {player.frame_index(position) + 1} / {len(index)}" if index is not None else "indexing"
+                lines = [f"{position:.2f} / {player.duration:.2f} sec  {frame_text}  {player.speed:g}x",
+                         f"skipped {player.skipped + preview.skipped}  seeks {player.seeks}"]
+                key = preview.show(image, lines, font_scale=0.6, thickness=1)
+            else:
+                key = cv2.waitKey(30)
+
+            if key & 0xFF == ord('q') or key == 27:
+                break
+            elif key & 0xFF == ord(' '):
+                player.toggle_pause()
+            elif key & 0xFF == ord('d'):
+                player.seek(player.position() + 5)
+            elif key & 0xFF == ord('a'):
+                player.seek(player.position() - 5)
+            elif key & 0xFF == ord('w'):
+                player.set_speed(player.speed * 2 if player.speed > 0 else 1.)
+            elif key & 0xFF == ord('s'):
+                player.set_speed(player.speed / 2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        player.stop()
+        preview.close()
+        print(f"[INFO] {preview.shown} frames shown, {player.skipped + preview.skipped} skipped, {player.seeks} seeks")
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from utils.align import DepthAligner, Extrinsics, Intrinsics
+
+# Reference for utils.align: a per-pixel port of the align_images loop of
+# librealsense in float32, with the camera models as rs.align applies them.
+# Only inverse_brown_conrady is undistorted when deprojecting depth and only
+# modified_brown_conrady is distorted when projecting into color, brown_conrady
+# is ignored on both sides (checked against rs.align of librealsense 2.59
+# through a software device).
+
+f32 = np.float32
+DEPTH_SCALE = 0.001
+
+
+def deproject(intrinsics, u, v, depth):
+    x = (f32(u) - f32(intrinsics.ppx)) / f32(intrinsics.fx)
+    y = (f32(v) - f32(intrinsics.ppy)) / f32(intrinsics.fy)
+    if intrinsics.model == "inverse_brown_conrady":
+        c = [f32(k) for k in intrinsics.coeffs]
+        r2 = x * x + y * y
+        f = f32(1) + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+        ux = x * f + f32(2) * c[2] * x * y + c[3] * (r2 + f32(2) * x * x)
+        uy = y * f + f32(2) * c[3] * x * y + c[2] * (r2 + f32(2) * y * y)
+        x, y = ux, uy
+    return [depth * x, depth * y, depth]
+
+
+def transform(extrinsics, point):
+    rotation = extrinsics.rotation.astype(np.float32)
+    return [sum((rotation[i, j] * point[j] for j in range(3)), f32(0)) + f32(extrinsics.translation[i])
+            for i in range(3)]
+
+
+def project(intrinsics, point):
+    x = point[0] / point[2]
+    y = point[1] / point[2]
+    if intrinsics.model == "modified_brown_conrady":
+        c = [f32(k) for k in intrinsics.coeffs]
+        r2 = x * x + y * y
+        f = f32(1) + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+        x = x * f
+        y = y * f
+        dx = x + f32(2) * c[2] * x * y + c[3] * (r2 + f32(2) * x * x)
+        dy = y + f32(2) * c[3] * x * y + c[2] * (r2 + f32(2) * y * y)
+        x, y = dx, dy
+    return x * f32(intrinsics.fx) + f32(intrinsics.ppx), y * f32(intrinsics.fy) + f32(intrinsics.ppy)
+
+
+def reference_align(depth_image, depth_intrinsics, color_intrinsics, depth_to_color):
+    out = np.zeros((color_intrinsics.height, color_intrinsics.width), dtype=np.uint16)
+    for v in range(depth_intrinsics.height):
+        for u in range(depth_intrinsics.width):
+            raw = int(depth_image[v, u])
+            if raw == 0:
+                continue
+            depth = f32(raw) * f32(DEPTH_SCALE)
+            # the pixel's top left and bottom right corners, rounded the way rs.align does
+            corners = []
+            for offset in (-0.5, 0.5):
+                point = transform(depth_to_color, deproject(depth_intrinsics, u + offset, v + offset, depth))
+                x, y = project(color_intrinsics, point)
+                corners.append((int(x + f32(0.5)), int(y + f32(0.5))))
+            (x0, y0), (x1, y1) = corners
+            for y in range(max(y0, 0), min(y1, color_intrinsics.height - 1) + 1):
+                for x in range(max(x0, 0), min(x1, color_intrinsics.width - 1) + 1):
+                    if not out[y, x] or raw < out[y, x]:
+                        out[y, x] = raw
+    return out
+
+
+def scene(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    depth = (700 + 1500 * y / height + 200 * np.sin(x / 3.)).astype(np.uint16)
+    depth[height // 3:height // 2, width // 3:width // 2] = 450
+    depth[rng.random(depth.shape) < 0.05] = 0
+    return depth
+
+
+def rotation_about_y(degrees):
+    a = np.radians(degrees)
+    rotation = np.array([[np.cos(a), 0, np.sin(a)], [0, 1, 0], [-np.sin(a), 0, np.cos(a)]])
+    # column-major like rs.extrinsics
+    return rotation.T.reshape(-1)
+
+
+DEPTH_COEFFS = [0.11, -0.21, 0.003, -0.002, 0.05]
+COLOR_COEFFS = [0.09, -0.17, 0.002, -0.001, 0.04]
+
+
+@pytest.mark.parametrize("depth_model,color_model", [
+    ("none", "none"),
+    ("brown_conrady", "brown_conrady"),
+    ("inverse_brown_conrady", "inverse_brown_conrady"),
+    ("brown_conrady", "inverse_brown_conrady"),
+    ("inverse_brown_conrady", "modified_brown_conrady"),
+])
+def test_splat_matches_rs_align_loop(depth_model, color_model):
+    # a small depth camera seen by a wider color camera with a baseline, so rectangles cover
+    # one to three pixels and the ones near the left border are clipped
+    depth_intrinsics = Intrinsics(40, 30, 30., 30.5, 20.3, 14.6, depth_model, DEPTH_COEFFS)
+    color_intrinsics = Intrinsics(64, 48, 47., 46.5, 32.8, 24.9, color_model, COLOR_COEFFS)
+    depth_to_color = Extrinsics(rotation_about_y(1.5), [-0.059, 0.0002, 0.0004])
+    depth = scene(40, 30)
+
+    expected = reference_align(depth, depth_intrinsics, color_intrinsics, depth_to_color)
+    aligner = DepthAligner(depth_intrinsics, color_intrinsics, depth_to_color, DEPTH_SCALE)
+    actual = aligner.align(depth)
+
+    # the aligner deprojects in float64 before rounding its rays to float32, a corner that lands
+    # within rounding of a pixel boundary may round the other way
+    assert np.count_nonzero(expected) > 0.5 * expected.size
+    assert np.count_nonzero(actual != expected) <= 0.002 * expected.size
+
+
+def test_align_batch_matches_align():
+    depth_intrinsics = Intrinsics(40, 30, 30., 30.5, 20.3, 14.6, "inverse_brown_conrady", DEPTH_COEFFS)
+    color_intrinsics = Intrinsics(64, 48, 47., 46.5, 32.8, 24.9, "modified_brown_conrady", COLOR_COEFFS)
+    aligner = DepthAligner(depth_intrinsics, color_intrinsics,
+                           Extrinsics(rotation_about_y(-1.), [0.015, 0., 0.]), DEPTH_SCALE)
+    frames = np.stack([scene(40, 30, seed) for seed in range(3)])
+    frames[1] = 0
+    batch = aligner.align_batch(frames)
+    for frame, aligned in zip(frames, batch):
+        np.testing.assert_array_equal(aligned, aligner.align(frame))
+    assert not batch[1].any()
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+# the synthetic source only borrows librealsense enums, no camera is needed,
+# but the module also fails to import without its shared libraries (libusb)
+try:
+    import pyrealsense2 as rs
+except ImportError as e:
+    pytest.skip(f"pyrealsense2 is not importable: {e}", allow_module_level=True)
+
+from utils import viewer
+from utils.frame_source import SyntheticSource
+from utils.recorder import ConcurrentRecorder
+from utils.telemetry import CaptureTelemetry
+from auto_exposure import AE_ALGORITHMS, create_ae, next_exposure
+
+FPS = 30
+# exposure limits of ae_color_record.py for the synthetic sensor at 30 fps, msec
+MAX_EXPOSURE = 1 / FPS * 1e3 - 2
+MIN_EXPOSURE = 1
+TARGET = 128
+TOLERANCE = 8
+
+
+class DroppingSource(SyntheticSource):
+    # skips every drop_every-th frame number and timestamp, like frames lost in the librealsense queue
+    def __init__(self, drop_every, **kwargs):
+        super().__init__(**kwargs)
+        self.drop_every = drop_every
+        self.skipped = 0
+
+    def try_wait_for_frames(self, timeout_ms=5000):
+        if self.frame_number and self.frame_number % self.drop_every == 0:
+            self.frame_number += 1
+            self.skipped += 1
+        return super().try_wait_for_frames(timeout_ms)
+
+
+def first_image(source):
+    return np.asanyarray(source.wait_for_frames().get_color_frame().get_data())
+
+
+@pytest.mark.parametrize("algorithm", list(AE_ALGORITHMS))
+@pytest.mark.parametrize("scene_gain", [0.8, 1.0, 1.5])
+def test_ae_converges_closed_loop(algorithm, scene_gain):
+    # starts at 4 msec, far too dark, and has to settle on the target like the recorder loop
+    source = SyntheticSource(depth=False, exposure=40, scene_gain=scene_gain)
+    sensor = source.get_color_sensor()
+    auto_exposure = create_ae(algorithm, 4, MAX_EXPOSURE, MIN_EXPOSURE, first_image(source),
+                              target_brightness=TARGET)
+    exposure = 40
+    brightness = []
+    for _ in range(60):
+        sensor.set_option(rs.option.exposure, exposure)
+        color_frame = source.wait_for_frames().get_color_frame()
+        actual_exposure = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+        exposure = next_exposure(auto_exposure, np.asanyarray(color_frame.get_data()), exposure, actual_exposure)
+        brightness.append(auto_exposure.w_avg_bright)
+    assert all(abs(b - TARGET) <= TOLERANCE for b in brightness[-10:])
+    assert MIN_EXPOSURE * 10 <= exposure <= MAX_EXPOSURE * 10
+
+
+@pytest.mark.parametrize("algorithm", list(AE_ALGORITHMS))
+def test_concurrent_recorder_converges_and_counts_drops(algorithm):
+    # paced at 30 fps with every 10th frame lost, AE and capture on their own threads
+    source = DroppingSource(10, depth=False, exposure=40, realtime=True, fps=FPS)
+    auto_exposure = create_ae(algorithm, 4, MAX_EXPOSURE, MIN_EXPOSURE, first_image(source),
+                              target_brightness=TARGET)
+    telemetry = CaptureTelemetry(FPS)
+    recorder = ConcurrentRecorder(source, source.get_color_sensor(), auto_exposure, 40, display=False,
+                                  telemetry=telemetry, preview=viewer.Viewer(headless=True))
+    recorder.run(duration=3.0)
+
+    summary = telemetry.summary()
+    assert recorder.errors == []
+    assert summary["frames"] == recorder.frame_count > 30
+    # every skipped frame shows up once, in the frame counter and in the sensor timestamps
+    assert summary["dropped_frames"] == source.skipped > 0
+    assert summary["dropped_by_frame_number"] == source.skipped
+    assert summary["dropped_by_timestamp"] == source.skipped
+    assert abs(auto_exposure.w_avg_bright - TARGET) <= TOLERANCE
+
+
+def test_concurrent_recorder_applies_exposure_within_a_frame():
+    # the AE worker sets the exposure itself, a command must not wait for the next frame to arrive
+    fps = 15
+    source = SyntheticSource(depth=False, exposure=40, realtime=True, fps=fps)
+    auto_exposure = create_ae("baseline", 4, 1 / fps * 1e3 - 2, MIN_EXPOSURE, first_image(source),
+                              target_brightness=TARGET)
+    recorder = ConcurrentRecorder(source, source.get_color_sensor(), auto_exposure, 40, display=False,
+                                  preview=viewer.Viewer(headless=True))
+    recorder.run(duration=2.0)
+
+    assert recorder.errors == []
+    delays = recorder.apply_stats.values()
+    assert delays.size > 10
+    assert np.median(delays) < 0.25 * 1e3 / fps
@@ -0,0 +1,54 @@
+import json
+import numpy as np
+import pytest
+
+# extract_bag.py and the synthetic source import pyrealsense2, which also
+# fails to import without its shared libraries (libusb)
+try:
+    import pyrealsense2 as rs
+except ImportError as e:
+    pytest.skip(f"pyrealsense2 is not importable: {e}", allow_module_level=True)
+
+from extract_bag import ExtractionPipeline
+from utils import checkpoint
+from utils import frame_codec
+from utils.frame_source import SyntheticSource
+
+CHUNK_SIZE = 4
+
+
+def extract(output_dir):
+    source = SyntheticSource(64, 48, max_frames=40, base_timestamp_ms=1.7e12)
+    pipeline = ExtractionPipeline(None, workers=2, source=source, output_dir=output_dir,
+                                  codec=frame_codec.ChunkCodec(CHUNK_SIZE, color_format="raw"),
+                                  checkpoint_every=CHUNK_SIZE, verbose=False)
+    return pipeline.run()
+
+
+def check_indexes(output_dir):
+    # every row has to resolve to the frame with its own timestamp
+    reader = frame_codec.FrameReader(output_dir)
+    timestamps, names = frame_codec.read_index(output_dir / "depth.txt")
+    assert len(timestamps) and np.all(np.diff(timestamps) > 0)
+    for timestamp, name in zip(timestamps, names):
+        chunk, slot = name.rsplit(":", 1)
+        with np.load(output_dir / chunk) as data:
+            assert data["timestamps"][int(slot)] == timestamp
+        assert reader.read_name(name, "depth") is not None
+    return len(timestamps)
+
+
+def test_resume_from_a_checkpoint_inside_a_chunk(tmp_path):
+    frames = extract(tmp_path)
+    assert check_indexes(tmp_path) == frames
+
+    # a run interrupted with one index shorter than the checkpoint, 10 rows is not a chunk boundary
+    with open(tmp_path / checkpoint.MANIFEST_FILE) as f:
+        state = json.load(f)
+    state.update(complete=False, frames=frames - 2)
+    with open(tmp_path / checkpoint.MANIFEST_FILE, "w") as f:
+        json.dump(state, f)
+    checkpoint.truncate_lines(tmp_path / "exposure_time.txt", 10)
+
+    assert extract(tmp_path) == frames
+    assert check_indexes(tmp_path) == frames
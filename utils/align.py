@@ -0,0 +1,323 @@
+import ast
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+
+from utils import buffer_pool
+
+# Depth-to-color alignment without rs.align. The per-pixel rays of the depth
+# camera are computed once (distortion included) and pre-rotated into the
+# color camera, so aligning a frame is a scale, a translation, a pinhole
+# projection and a z-buffered scatter over NumPy arrays. Like rs.align, each
+# depth pixel is splatted over the color pixels between the projections of
+# its two corners, clipped to the image, and the nearest depth wins.
+# tests/test_align.py compares it with a per-pixel port of the rs.align loop
+# and compare_with_rs_align() with rs.align itself on a bag. Per frame it is
+# about 3x slower than rs.align (benchmark.py), so it serves batches of
+# recorded depth (align_batch) and point clouds, not bag extraction.
+
+
+class Intrinsics:
+    def __init__(self, width, height, fx, fy, ppx, ppy, model="none", coeffs=(0., 0., 0., 0., 0.)):
+        self.width = int(width)
+        self.height = int(height)
+        self.fx = float(fx)
+        self.fy = float(fy)
+        self.ppx = float(ppx)
+        self.ppy = float(ppy)
+        # "distortion.brown_conrady" and plain "brown_conrady" are both accepted
+        self.model = str(model).strip('"').split(".")[-1]
+        self.coeffs = [float(c) for c in coeffs]
+
+    @classmethod
+    def from_rs(cls, intrinsics):
+        return cls(intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy,
+                   intrinsics.ppx, intrinsics.ppy, intrinsics.model, intrinsics.coeffs)
+
+    @classmethod
+    def from_file(cls, path):
+        # the *_sensor_intrinsics.txt files of sessions recorded before device_profile.json
+        values = read_key_values(path)
+        return cls(values["width"], values["height"], values["fx"], values["fy"], values["cx"], values["cy"],
+                   values.get("distortion_model", "none"), values.get("distortion_coeffs", [0.] * 5))
+
+
+class Extrinsics:
+    def __init__(self, rotation, translation):
+        # rotation is the column-major 3x3 of rs.extrinsics
+        self.rotation = np.asarray(rotation, dtype=np.float64).reshape(3, 3).T
+        self.translation = np.asarray(translation, dtype=np.float64)
+
+    @classmethod
+    def from_rs(cls, extrinsics):
+        return cls(extrinsics.rotation, extrinsics.translation)
+
+    @classmethod
+    def from_file(cls, path):
+        # the *_extrinsics.txt files of sessions recorded before device_profile.json
+        values = read_key_values(path)
+        return cls(values["rotation"], values["translation"])
+
+
+def read_key_values(path):
+    values = {}
+    with open(path) as f:
+        for line in f:
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            value = value.strip()
+            try:
+                values[key.strip()] = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                values[key.strip()] = value.strip('"')
+    return values
+
+
+def undistort(x, y, intrinsics):
+    # normalized image coordinates to rays, as rs2_deproject_pixel_to_point
+    c = intrinsics.coeffs
+    if intrinsics.model == "inverse_brown_conrady":
+        r2 = x * x + y * y
+        f = 1 + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+        ux = x * f + 2 * c[2] * x * y + c[3] * (r2 + 2 * x * x)
+        uy = y * f + 2 * c[3] * x * y + c[2] * (r2 + 2 * y * y)
+        return ux, uy
+    if intrinsics.model == "brown_conrady" and any(c):
+        xo, yo = x, y
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1 / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+            xq = x / icdist
+            yq = y / icdist
+            delta_x = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+            delta_y = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+            x = (xo - delta_x) * icdist
+            y = (yo - delta_y) * icdist
+        return x, y
+    return x, y
+
+
+def distort(x, y, intrinsics):
+    # rays to distorted normalized coordinates, as rs2_project_point_to_pixel
+    c = intrinsics.coeffs
+    if intrinsics.model in ("modified_brown_conrady", "brown_conrady") and any(c):
+        r2 = x * x + y * y
+        f = 1 + c[0] * r2 + c[1] * r2 * r2 + c[4] * r2 * r2 * r2
+        if intrinsics.model == "modified_brown_conrady":
+            x = x * f
+            y = y * f
+            xf, yf = x, y
+        else:
+            xf, yf = x * f, y * f
+        dx = xf + 2 * c[2] * x * y + c[3] * (r2 + 2 * x * x)
+        dy = yf + 2 * c[3] * x * y + c[2] * (r2 + 2 * y * y)
+        return dx, dy
+    return x, y
+
+
+def align_intrinsics(intrinsics, model):
+    # the intrinsics as rs.align applies them, a pinhole unless the model is the one it handles
+    if intrinsics.model == model:
+        return intrinsics
+    return Intrinsics(intrinsics.width, intrinsics.height, intrinsics.fx, intrinsics.fy,
+                      intrinsics.ppx, intrinsics.ppy)
+
+
+def pixel_rays(intrinsics, offset=0.):
+    # (H, W, 3) rays with z = 1 for pixel centers shifted by offset
+    u = np.arange(intrinsics.width, dtype=np.float64) + offset
+    v = np.arange(intrinsics.height, dtype=np.float64) + offset
+    u, v = np.meshgrid(u, v)
+    x, y = undistort((u - intrinsics.ppx) / intrinsics.fx, (v - intrinsics.ppy) / intrinsics.fy, intrinsics)
+    return np.stack([x, y, np.ones_like(x)], axis=-1)
+
+
+class DepthAligner:
+    def __init__(self, depth_intrinsics, color_intrinsics, depth_to_color, depth_scale, pool=None):
+        self.pool = pool if pool is not None else buffer_pool.default_pool
+        self.depth_intrinsics = depth_intrinsics
+        self.color_intrinsics = color_intrinsics
+        self.depth_to_color = depth_to_color
+        self.depth_scale = float(depth_scale)
+
+        # rs.align does not use the full rs2 camera models: depth pixels are only undistorted for
+        # inverse_brown_conrady and points are only distorted for modified_brown_conrady, any other
+        # model is treated as a pinhole (checked against librealsense 2.59, see tests/test_align.py)
+        self.deproject_intrinsics = align_intrinsics(depth_intrinsics, "inverse_brown_conrady")
+        self.project_intrinsics = align_intrinsics(color_intrinsics, "modified_brown_conrady")
+
+        # corner rays pre-rotated into the color camera, one (3, pixels) float32 row per axis like
+        # the float math of rs.align, so a frame gathers three flat arrays
+        rotation = depth_to_color.rotation
+        self.rays_tl = np.ascontiguousarray((pixel_rays(self.deproject_intrinsics, -0.5) @ rotation.T)
+                                            .reshape(-1, 3).T, dtype=np.float32)
+        self.rays_br = np.ascontiguousarray((pixel_rays(self.deproject_intrinsics, 0.5) @ rotation.T)
+                                            .reshape(-1, 3).T, dtype=np.float32)
+        self.translation = depth_to_color.translation.astype(np.float32)
+        self.color_rays = None
+
+    @classmethod
+    def from_profile(cls, profile):
+        import pyrealsense2 as rs
+        depth_profile = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        color_profile = profile.get_stream(rs.stream.color).as_video_stream_profile()
+        depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+        return cls(Intrinsics.from_rs(depth_profile.get_intrinsics()),
+                   Intrinsics.from_rs(color_profile.get_intrinsics()),
+                   Extrinsics.from_rs(depth_profile.get_extrinsics_to(color_profile)), depth_scale)
+
+    @classmethod
+    def from_device_profile(cls, data, color_key=None, depth_key=None):
+        # data of a utils.device_profile profile, a session copy knows its recorded streams
+        color_key = color_key or data["session"]["color"]
+        depth_key = depth_key or data["session"]["depth"]
+        return cls(Intrinsics(**data["streams"][depth_key]["intrinsics"]),
+                   Intrinsics(**data["streams"][color_key]["intrinsics"]),
+                   Extrinsics(**data["extrinsics"][f"{depth_key}->{color_key}"]), data["depth_scale"])
+
+    @classmethod
+    def from_files(cls, directory, depth_scale=0.001):
+        directory = Path(directory)
+        if (directory / "device_profile.json").exists():
+            with open(directory / "device_profile.json") as f:
+                return cls.from_device_profile(json.load(f))
+        return cls(Intrinsics.from_file(directory / "depth_sensor_intrinsics.txt"),
+                   Intrinsics.from_file(directory / "color_sensor_intrinsics.txt"),
+                   Extrinsics.from_file(directory / "depth_to_color_extrinsics.txt"), depth_scale)
+
+    def _project(self, rays, pixel, z):
+        tx, ty, tz = self.translation
+        pz = rays[2].take(pixel) * z + tz
+        x, y = distort((rays[0].take(pixel) * z + tx) / pz, (rays[1].take(pixel) * z + ty) / pz,
+                       self.project_intrinsics)
+        # truncating +0.5 like rs.align
+        intrinsics = self.project_intrinsics
+        half = np.float32(0.5)
+        px = (x * np.float32(intrinsics.fx) + np.float32(intrinsics.ppx) + half).astype(np.int32)
+        py = (y * np.float32(intrinsics.fy) + np.float32(intrinsics.ppy) + half).astype(np.int32)
+        return px, py
+
+    def _splat(self, depth_images, out=None):
+        n = depth_images.shape[0]
+        frame_size = depth_images[0].size
+        flat = depth_images.reshape(-1)
+        index = np.flatnonzero(flat)
+        raw = flat.take(index)
+        frame, pixel = np.divmod(index, frame_size)
+        z = raw.astype(np.float32) * np.float32(self.depth_scale)
+
+        x0, y0 = self._project(self.rays_tl, pixel, z)
+        x1, y1 = self._project(self.rays_br, pixel, z)
+        width, height = self.color_intrinsics.width, self.color_intrinsics.height
+        # rs.align clips the rectangle to the color image instead of dropping pixels near the border
+        x0 = np.maximum(x0, 0)
+        y0 = np.maximum(y0, 0)
+        x1 = np.minimum(x1, width - 1)
+        y1 = np.minimum(y1, height - 1)
+        valid = np.flatnonzero((x1 >= x0) & (y1 >= y0))
+        frame, x0, y0, x1, y1 = frame.take(valid), x0.take(valid), y0.take(valid), x1.take(valid), y1.take(valid)
+        # same dtype as the buffer keeps np.minimum.at on its fast path
+        raw = raw.take(valid).astype(np.uint32)
+
+        # pixels grouped by the size of their rectangle, so each offset of a group is one
+        # np.minimum.at over a contiguous slice instead of a masked pass over every pixel
+        span_x = x1 - x0
+        span_y = y1 - y0
+        shape = span_y * (int(span_x.max(initial=0)) + 1) + span_x
+        # a stable sort of a small unsigned key is a radix sort
+        order = np.argsort(shape.astype(np.uint16 if shape.max(initial=0) < 1 << 16 else np.int64), kind="stable")
+        shape = shape.take(order)
+        start = (frame * (height * width) + y0.astype(np.int64) * width + x0).take(order)
+        raw = raw.take(order)
+        firsts = np.flatnonzero(np.diff(shape, prepend=-1))
+
+        # zero means no depth, so keep the minimum over a buffer initialized above any depth
+        work = self.pool.get((n * height * width,), np.uint32)
+        work.fill(np.iinfo(np.uint32).max)
+        for first, last in zip(firsts, np.r_[firsts[1:], shape.size]):
+            group_x = int(span_x[order[first]])
+            group_y = int(span_y[order[first]])
+            for dy in range(group_y + 1):
+                for dx in range(group_x + 1):
+                    np.minimum.at(work, start[first:last] + (dy * width + dx), raw[first:last])
+        work[work == np.iinfo(np.uint32).max] = 0
+        if out is None:
+            out = np.empty((n, height, width), dtype=np.uint16)
+        np.copyto(out.reshape(n, height, width), work.reshape(n, height, width), casting="unsafe")
+        self.pool.put(work)
+        return out
+
+    def align(self, depth_image, out=None):
+        # uint16 depth in the depth camera -> uint16 depth in the color camera, written to out when given
+        if out is None:
+            out = np.empty((self.color_intrinsics.height, self.color_intrinsics.width), dtype=np.uint16)
+        self._splat(np.asarray(depth_image)[None], out[None])
+        return out
+
+    def align_batch(self, depth_images):
+        # (N, H, W) depth frames aligned in one pass
+        return self._splat(np.asarray(depth_images))
+
+    def point_cloud(self, aligned_depth, color_image=None):
+        # (N, 3) points in meters in the color camera, plus their BGR colors
+        if self.color_rays is None:
+            self.color_rays = pixel_rays(self.color_intrinsics).reshape(-1, 3).astype(np.float32)
+        flat = np.asarray(aligned_depth).reshape(-1)
+        pixel = np.flatnonzero(flat)
+        points = self.color_rays[pixel] * (flat[pixel].astype(np.float32) * np.float32(self.depth_scale))[:, None]
+        if color_image is None:
+            return points
+        return points, np.asarray(color_image).reshape(-1, 3)[pixel]
+
+
+def compare_with_rs_align(bag_path, frames=100):
+    # align the same framesets with rs.align and the NumPy aligner and report the differences
+    import pyrealsense2 as rs
+    pipe = rs.pipeline()
+    cfg = rs.config()
+    cfg.enable_device_from_file(str(bag_path), repeat_playback=False)
+    profile = pipe.start(cfg)
+    profile.get_device().as_playback().set_real_time(False)
+    rs_align = rs.align(rs.stream.color)
+    aligner = DepthAligner.from_profile(profile)
+
+    equal = covered_rs = covered_np = total = 0
+    abs_diff = []
+    try:
+        for _ in range(frames):
+            ok, frameset = pipe.try_wait_for_frames()
+            if not ok:
+                break
+            depth = np.asanyarray(frameset.get_depth_frame().get_data())
+            expected = np.asanyarray(rs_align.process(frameset).get_depth_frame().get_data())
+            actual = aligner.align(depth)
+            both = (expected > 0) & (actual > 0)
+            equal += int(np.count_nonzero(expected == actual))
+            covered_rs += int(np.count_nonzero(expected))
+            covered_np += int(np.count_nonzero(actual))
+            total += expected.size
+            abs_diff.append(np.abs(expected[both].astype(np.int32) - actual[both]))
+    finally:
+        pipe.stop()
+
+    abs_diff = np.concatenate(abs_diff) if abs_diff else np.zeros(0)
+    report = {"pixels": total,
+              "identical_fraction": equal / total if total else 0.,
+              "rs_valid_pixels": covered_rs,
+              "numpy_valid_pixels": covered_np,
+              "mean_abs_diff": float(abs_diff.mean()) if abs_diff.size else 0.,
+              "max_abs_diff": int(abs_diff.max()) if abs_diff.size else 0}
+    for key, value in report.items():
+        print(f"[INFO] {key}: {value}")
+    return report
+
+
+# run from the repository root as a module, utils is a package: python -m utils.align <bag>
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m utils.align", description="Check the NumPy depth aligner against rs.align on a recorded bag.")
+    parser.add_argument("bag_path", type=str, help="Path to the bag file")
+    parser.add_argument("-n", "--frames", type=int, default=100, help="Framesets to compare")
+    args = parser.parse_args()
+    compare_with_rs_align(args.bag_path, args.frames)
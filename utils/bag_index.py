@@ -0,0 +1,139 @@
+import os
+import json
+import threading
+from pathlib import Path
+import numpy as np
+
+from utils import frame_source
+from utils import checkpoint
+from utils import index_writer
+
+# Timestamp index of a recorded bag: playback position, frame timestamp and
+# color frame number of every frameset. Building it decodes the bag once as
+# fast as possible, after that it is cached next to the bag as
+# <name>.index.npz and reused as long as the bag file is unchanged, so a
+# player can map times to frames and seek without scanning again. On the
+# first open BackgroundIndexer builds it on a thread while playback starts.
+
+INDEX_SUFFIX = ".index.npz"
+
+
+class BagIndex:
+    def __init__(self, positions, timestamps, frame_numbers):
+        # positions in seconds from the start of the bag, timestamps in ms
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def duration(self):
+        return float(self.positions[-1]) if len(self) else 0.
+
+    def index_at(self, position):
+        # last frame at or before position
+        i = int(np.searchsorted(self.positions, position, side="right")) - 1
+        return min(max(i, 0), len(self) - 1)
+
+    def save(self, path, identity):
+        tmp_path = str(path) + ".tmp.npz"
+        np.savez(tmp_path, positions=self.positions, timestamps=self.timestamps,
+                 frame_numbers=self.frame_numbers, identity=np.array(json.dumps(identity)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, identity):
+        # None when the cache belongs to another version of the bag
+        try:
+            with np.load(path) as data:
+                if json.loads(str(data["identity"])) != identity:
+                    return None
+                return cls(data["positions"], data["timestamps"], data["frame_numbers"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def build(cls, bag_path, verbose=True):
+        source = frame_source.BagSource(bag_path, realtime=False)
+        source.start()
+        progress = index_writer.ProgressLine(source.get_duration()) if verbose else None
+        positions, timestamps, frame_numbers = [], [], []
+        try:
+            while True:
+                ok, frames = source.try_wait_for_frames()
+                if not ok:
+                    break
+                position = source.get_position()
+                # looping bags start over, the first repeat ends the scan
+                if positions and position < positions[-1]:
+                    break
+                color_frame = frames.get_color_frame()
+                positions.append(position)
+                timestamps.append(frames.get_timestamp())
+                frame_numbers.append(color_frame.get_frame_number() if color_frame else -1)
+                if progress is not None:
+                    progress.update(len(positions), position)
+        finally:
+            source.stop()
+            if progress is not None:
+                progress.close()
+        return cls(positions, timestamps, frame_numbers)
+
+
+def index_path(bag_path):
+    bag_path = Path(bag_path)
+    return bag_path.with_name(bag_path.name + INDEX_SUFFIX)
+
+
+def load_cached(bag_path, verbose=True):
+    # None when there is no index for this version of the bag yet
+    path = index_path(bag_path)
+    index = BagIndex.load(path, checkpoint.source_identity(bag_path)) if path.exists() else None
+    if index is not None and verbose:
+        print(f"[INFO] Loaded the index of {len(index)} frames from {path}")
+    return index
+
+
+def build_and_save(bag_path, verbose=True):
+    path = index_path(bag_path)
+    identity = checkpoint.source_identity(bag_path)
+    index = BagIndex.build(bag_path, verbose)
+    try:
+        index.save(path, identity)
+    except OSError as e:
+        # read-only recordings still play, they are indexed again next time
+        print(f"[ERROR] Could not cache the index: {e}")
+    return index
+
+
+def load_or_build(bag_path, rebuild=False, verbose=True):
+    index = None if rebuild else load_cached(bag_path, verbose)
+    if index is not None:
+        return index
+    if verbose:
+        print(f"[INFO] Indexing {bag_path}")
+    return build_and_save(bag_path, verbose)
+
+
+class BackgroundIndexer:
+    # builds and caches the index on a daemon thread with its own reader of the bag,
+    # index stays None until it is done
+    def __init__(self, bag_path):
+        self.bag_path = bag_path
+        self.index = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.index = build_and_save(self.bag_path, verbose=False)
+        except Exception as e:
+            self.error = e
+            print(f"[ERROR] Indexing {self.bag_path} failed: {e!r}")
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        return self.index
@@ -0,0 +1,83 @@
+import threading
+import collections
+import contextlib
+import numpy as np
+
+# Reusable frame buffers keyed by shape and dtype. Stages that need a
+# scratch or output array per frame get() one and put() it back when the
+# frame is done, so a long capture or extraction allocates each size once
+# instead of once per frame and the allocator/GC never sees the churn.
+# Arrays from get() are uninitialized, like np.empty. The counters show how
+# many requests were served from the free lists.
+
+# free arrays kept per (shape, dtype), more than this are left to the GC
+MAX_FREE_PER_KEY = 32
+
+
+class BufferPool:
+    def __init__(self, max_free_per_key=MAX_FREE_PER_KEY):
+        self.max_free_per_key = max_free_per_key
+        self.lock = threading.Lock()
+        self.free = collections.defaultdict(list)
+        self.allocated = 0
+        self.allocated_bytes = 0
+        self.reused = 0
+        self.returned = 0
+        self.discarded = 0
+
+    def get(self, shape, dtype=np.uint8):
+        dtype = np.dtype(dtype)
+        key = (tuple(shape), dtype.str)
+        with self.lock:
+            free = self.free.get(key)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+            array = np.empty(shape, dtype=dtype)
+            self.allocated_bytes += array.nbytes
+            return array
+
+    def put(self, array):
+        # only whole arrays go back, views would alias a buffer someone else borrows
+        if array is None or array.base is not None or not array.flags.c_contiguous:
+            return
+        key = (array.shape, array.dtype.str)
+        with self.lock:
+            free = self.free[key]
+            if len(free) >= self.max_free_per_key:
+                self.discarded += 1
+                return
+            self.returned += 1
+            free.append(array)
+
+    @contextlib.contextmanager
+    def borrow(self, shape, dtype=np.uint8):
+        array = self.get(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.put(array)
+
+    def copy(self, array):
+        # pooled equivalent of array.copy()
+        out = self.get(array.shape, array.dtype)
+        np.copyto(out, array)
+        return out
+
+    def stats(self):
+        with self.lock:
+            requests = self.allocated + self.reused
+            return {"requests": requests, "allocated": self.allocated, "reused": self.reused,
+                    "reuse_rate": self.reused / requests if requests else 0., "returned": self.returned,
+                    "discarded": self.discarded, "allocated_mb": self.allocated_bytes / 1e6,
+                    "free_buffers": sum(len(free) for free in self.free.values())}
+
+    def summary(self):
+        stats = self.stats()
+        return (f"buffer pool: {stats['requests']} requests, {stats['allocated']} allocated "
+                f"({stats['allocated_mb']:.1f} MB), {stats['reuse_rate'] * 100:.1f}% reused")
+
+
+# shared by the AE, viewer, aligner and extraction stages unless they are given their own
+default_pool = BufferPool()
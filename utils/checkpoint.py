@@ -0,0 +1,78 @@
+import os
+import json
+from pathlib import Path
+
+# Checkpoint manifest for resumable bag extraction. The manifest records how
+# many frames are durable (index rows written and image data on disk) and
+# where in the bag the last of them was, so a rerun can truncate the text
+# indexes back to that point, seek the bag and carry on.
+
+MANIFEST_FILE = "extract_manifest.json"
+INDEX_FILES = ("depth.txt", "rgb.txt", "sensor_timestamp.txt", "exposure_time.txt")
+
+
+def source_identity(bag_path):
+    # a rerun only resumes when it reads the very same bag
+    if bag_path is None:
+        return {}
+    stat = os.stat(bag_path)
+    return {"bag": str(Path(bag_path).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def truncate_lines(path, count):
+    # keep the first count lines of a text file
+    if not path.exists():
+        return 0
+    with open(path, "r+b") as f:
+        kept = 0
+        offset = 0
+        for line in iter(f.readline, b""):
+            if kept == count:
+                break
+            offset = f.tell()
+            kept += 1
+        f.truncate(offset if kept else 0)
+    return kept
+
+
+class ExtractionManifest:
+    def __init__(self, output_dir, settings):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / MANIFEST_FILE
+        # source identity, codec and options a checkpoint is only valid for
+        self.settings = settings
+        self.state = {"settings": settings, "frames": 0, "position": None,
+                      "last_timestamp": None, "complete": False}
+
+    def load(self):
+        # previous state if it belongs to the same bag and settings
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("settings") != self.settings:
+            return None
+        self.state = state
+        return state
+
+    def reset(self):
+        for name in INDEX_FILES:
+            path = self.output_dir / name
+            if path.exists():
+                path.unlink()
+        self.state.update(frames=0, position=None, last_timestamp=None, complete=False)
+        self.save()
+
+    def truncate_indexes(self, count):
+        # drop rows written after the checkpoint, they may point at missing data
+        return min(truncate_lines(self.output_dir / name, count) for name in INDEX_FILES)
+
+    def save(self, **updates):
+        self.state.update(updates)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
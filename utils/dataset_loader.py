@@ -0,0 +1,223 @@
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+from pathlib import Path
+import numpy as np
+
+from utils import frame_codec
+
+# Batched reading of sequences extracted by extract_bag.py, for training and
+# evaluation jobs. rgb.txt and depth.txt are parsed once and every color
+# frame is paired with the nearest depth frame by a vectorized search. The
+# frames are decoded in a thread or process pool (OpenCV decoders release
+# the GIL, so threads usually suffice) a few batches ahead of the consumer.
+# With cache_mb decoded pairs are kept in an LRU cache of that size, so later
+# epochs over a sequence that fits skip the decoder. Any codec FrameReader
+# reads works.
+#
+#   with DatasetLoader("bags/seq", batch_size=16, workers=8) as loader:
+#       for batch in loader:
+#           batch["color"]   # (B, H, W, 3) uint8
+#           batch["depth"]   # (B, H, W) uint16
+
+
+def associate(first, second, max_difference=0.02, unique=True):
+    # (i, j) index arrays pairing first[i] with the nearest second[j] within max_difference,
+    # both sorted. unique keeps only the closest pair when several frames pick the same partner,
+    # the others are dropped, not matched to their next nearest frame as the greedy pass of the
+    # TUM associate.py would
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+    if len(first) == 0 or len(second) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    j = np.clip(np.searchsorted(second, first), 1, max(len(second) - 1, 1))
+    if len(second) == 1:
+        j = np.zeros(len(first), dtype=np.intp)
+    else:
+        j = np.where(first - second[j - 1] <= second[j] - first, j - 1, j)
+    difference = np.abs(second[j] - first)
+    i = np.flatnonzero(difference <= max_difference)
+    j, difference = j[i], difference[i]
+    if unique and len(i):
+        # group by partner, closest first, and keep the first of every group
+        order = np.lexsort((difference, j))
+        keep = order[np.r_[True, j[order][1:] != j[order][:-1]]]
+        keep.sort()
+        i, j = i[keep], j[keep]
+    return i, j
+
+
+# per worker (thread or process) reader, the chunk cache of FrameReader is not thread-safe
+_local = threading.local()
+
+
+def _open_reader(sequence_dir):
+    _local.reader = frame_codec.FrameReader(sequence_dir, read_indexes=False)
+
+
+def _decode_pair(rgb_name, depth_name):
+    reader = _local.reader
+    return reader.read_name(rgb_name, "color"), reader.read_name(depth_name, "depth")
+
+
+class SequenceDataset:
+    # color/depth pairs of one extracted sequence, indexable like a list
+    def __init__(self, sequence_dir, max_difference=0.02):
+        self.sequence_dir = Path(sequence_dir)
+        rgb_timestamps, rgb_names = frame_codec.read_index(self.sequence_dir / "rgb.txt")
+        depth_timestamps, depth_names = frame_codec.read_index(self.sequence_dir / "depth.txt")
+        # extract_bag.py writes both in frame order, sort anyway for hand-made indexes
+        rgb_order = np.argsort(rgb_timestamps, kind="stable")
+        depth_order = np.argsort(depth_timestamps, kind="stable")
+        i, j = associate(rgb_timestamps[rgb_order], depth_timestamps[depth_order], max_difference)
+        self.timestamps = rgb_timestamps[rgb_order][i]
+        self.depth_timestamps = depth_timestamps[depth_order][j]
+        self.rgb_names = [rgb_names[k] for k in rgb_order[i]]
+        self.depth_names = [depth_names[k] for k in depth_order[j]]
+        self.unmatched = len(rgb_timestamps) - len(i)
+
+    def __len__(self):
+        return len(self.rgb_names)
+
+    def __getitem__(self, index):
+        # sequential read on the calling thread, DatasetLoader decodes in parallel
+        if getattr(_local, "reader", None) is None or _local.reader.sequence_dir != self.sequence_dir:
+            _open_reader(self.sequence_dir)
+        return _decode_pair(self.rgb_names[index], self.depth_names[index])
+
+
+class FrameCache:
+    # LRU of decoded (color, depth) pairs by dataset index, bounded by the bytes of the arrays
+    def __init__(self, capacity_bytes=0):
+        self.capacity_bytes = capacity_bytes
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index):
+        with self.lock:
+            item = self.items.get(index)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(index)
+            self.hits += 1
+            return item
+
+    def put(self, index, item):
+        nbytes = sum(array.nbytes for array in item)
+        if nbytes > self.capacity_bytes:
+            return
+        with self.lock:
+            if index in self.items:
+                self.size -= sum(array.nbytes for array in self.items.pop(index))
+            self.items[index] = item
+            self.size += nbytes
+            while self.size > self.capacity_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= sum(array.nbytes for array in evicted)
+
+
+class DatasetLoader:
+    # Yields batches as dicts of stacked arrays: index, timestamp, depth_timestamp, color, depth.
+    # prefetch batches are decoding while the consumer works on the current one.
+    # cache_mb bounds the decoded frames kept for later epochs, off by default: a 1280x720
+    # pair is 4.6 MB, so caching only pays when the whole sequence fits.
+    def __init__(self, dataset, batch_size=8, shuffle=False, drop_last=False, workers=4, prefetch=2,
+                 executor="thread", cache_mb=0, seed=0):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.dataset = dataset if isinstance(dataset, SequenceDataset) else SequenceDataset(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.workers = max(1, workers)
+        self.prefetch = max(0, prefetch)
+        self.executor_type = executor
+        self.cache = FrameCache(int(cache_mb * (1 << 20)))
+        self.rng = np.random.default_rng(seed)
+        self.executor = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self):
+        if self.executor is not None:
+            return
+        initargs = (self.dataset.sequence_dir,)
+        if self.executor_type == "process":
+            # spawn like the other pools here, librealsense state does not survive a fork
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_open_reader, initargs=initargs)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, initializer=_open_reader,
+                                                                  initargs=initargs)
+
+    def _submit(self, index):
+        item = self.cache.get(index)
+        if item is not None:
+            future = concurrent.futures.Future()
+            future.set_result(item)
+            return future
+        return self.executor.submit(_decode_pair, self.dataset.rgb_names[index], self.dataset.depth_names[index])
+
+    def _collect(self, indices, futures):
+        colors = []
+        depths = []
+        for index, future in zip(indices, futures):
+            color, depth = future.result()
+            if color is None or depth is None:
+                raise IOError(f"Failed to decode frame {index} of {self.dataset.sequence_dir}")
+            self.cache.put(index, (color, depth))
+            colors.append(color)
+            depths.append(depth)
+        return {"index": indices,
+                "timestamp": self.dataset.timestamps[indices],
+                "depth_timestamp": self.dataset.depth_timestamps[indices],
+                "color": np.stack(colors),
+                "depth": np.stack(depths)}
+
+    def batches(self):
+        order = self.rng.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        end = len(self) * self.batch_size if self.drop_last else len(order)
+        return [order[k:k + self.batch_size] for k in range(0, end, self.batch_size)]
+
+    def __iter__(self):
+        self._start()
+        pending = collections.deque()
+        try:
+            for indices in self.batches():
+                pending.append((indices, [self._submit(int(index)) for index in indices]))
+                if len(pending) > self.prefetch:
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+        finally:
+            # a consumer that stops early leaves nothing decoding in the background
+            for _, futures in pending:
+                for future in futures:
+                    future.cancel()
+
+    def stats(self):
+        requests = self.cache.hits + self.cache.misses
+        return {"frames": len(self.dataset), "unmatched_color_frames": self.dataset.unmatched,
+                "cache_hits": self.cache.hits, "cache_misses": self.cache.misses,
+                "cache_frames": len(self.cache.items), "cache_mb": self.cache.size / (1 << 20),
+                "cache_hit_rate": self.cache.hits / requests if requests else 0.}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
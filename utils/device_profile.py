@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import pyrealsense2 as rs
+
+from utils import sensors
+
+# Per-device profile cache. Everything the recorders used to query at every
+# startup (sensor indices, option ranges, depth scale, stream intrinsics and
+# the depth-to-color extrinsics) is stored in one JSON file per serial number
+# and firmware version. Startup loads the file, checks it against the
+# connected device with a few cheap get_info calls and only queries the
+# device again when the check fails, a stream is missing or refresh is set.
+# Sessions get a copy of the profile as device_profile.json next to
+# data.bag, replacing the old *_sensor_intrinsics.txt files.
+
+PROFILE_FILE = "device_profile.json"
+PROFILE_VERSION = 1
+CACHE_DIR = os.path.expanduser("~/.cache/realsense-data-collector/profiles")
+
+# option ranges cached per sensor, when the sensor supports them
+CACHED_OPTIONS = ("exposure", "gain", "white_balance", "power_line_frequency", "enable_auto_exposure")
+
+
+class OptionRange:
+    # same fields as rs.option_range
+    def __init__(self, min, max, step, default):
+        self.min = min
+        self.max = max
+        self.step = step
+        self.default = default
+
+
+def stream_key(stream, width, height, format, fps):
+    # e.g. "color_1280x720_bgr8_15"
+    return f"{str(stream).split('.')[-1]}_{width}x{height}_{str(format).split('.')[-1]}_{fps}"
+
+
+def intrinsics_dict(intrinsics):
+    return {"width": intrinsics.width, "height": intrinsics.height,
+            "fx": intrinsics.fx, "fy": intrinsics.fy, "ppx": intrinsics.ppx, "ppy": intrinsics.ppy,
+            "model": str(intrinsics.model), "coeffs": list(intrinsics.coeffs)}
+
+
+def extrinsics_dict(extrinsics):
+    # rotation is column-major like rs.extrinsics
+    return {"rotation": list(extrinsics.rotation), "translation": list(extrinsics.translation)}
+
+
+class DeviceProfile:
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def serial(self):
+        return self.data["serial"]
+
+    @property
+    def firmware(self):
+        return self.data["firmware"]
+
+    @property
+    def product_line(self):
+        return self.data["product_line"]
+
+    @property
+    def rgb_index(self):
+        return self.data["sensors"]["rgb"]["index"]
+
+    @property
+    def depth_index(self):
+        return self.data["sensors"]["depth"]["index"]
+
+    @property
+    def imu_index(self):
+        return self.data["sensors"]["imu"]["index"]
+
+    @property
+    def depth_scale(self):
+        return self.data["depth_scale"]
+
+    def option_range(self, sensor, option):
+        # sensor is "rgb" or "depth", option a CACHED_OPTIONS name
+        return OptionRange(**self.data["sensors"][sensor]["options"][option])
+
+    def intrinsics(self, key):
+        return self.data["streams"][key]["intrinsics"]
+
+    def extrinsics(self, from_key, to_key):
+        return self.data["extrinsics"][f"{from_key}->{to_key}"]
+
+    def has_streams(self, keys):
+        return all(key in self.data["streams"] for key in keys)
+
+    def validate(self, device, device_sensors):
+        # cheap checks that the cache still describes the connected device
+        if self.data.get("version") != PROFILE_VERSION:
+            return False
+        if device.get_info(rs.camera_info.serial_number) != self.serial:
+            return False
+        if device.get_info(rs.camera_info.firmware_version) != self.firmware:
+            return False
+        for entry in self.data["sensors"].values():
+            index = entry["index"]
+            if index >= len(device_sensors) or device_sensors[index].get_info(rs.camera_info.name) != entry["name"]:
+                return False
+        return True
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = str(path) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+def query_sensor(sensor, index):
+    options = {}
+    for name in CACHED_OPTIONS:
+        option = getattr(rs.option, name)
+        if sensor.supports(option):
+            r = sensor.get_option_range(option)
+            options[name] = {"min": r.min, "max": r.max, "step": r.step, "default": r.default}
+    return {"index": index, "name": sensor.get_info(rs.camera_info.name), "options": options}
+
+
+def find_stream_profile(sensor, stream, width, height, format, fps):
+    for profile in sensor.get_stream_profiles():
+        if profile.stream_type() != stream or profile.format() != format or profile.fps() != fps:
+            continue
+        video_profile = profile.as_video_stream_profile()
+        if video_profile.width() == width and video_profile.height() == height:
+            return video_profile
+    raise ValueError(f"{stream_key(stream, width, height, format, fps)} is not supported by the device")
+
+
+def query_profile(device, device_sensors, streams, data=None):
+    # streams are (rs.stream, width, height, rs.format, fps) tuples like enable_stream takes
+    if data is None:
+        rgb_sensor_index, depth_sensor_index, imu_sensor_index = sensors.find_sensors(device)
+        depth_sensor = device_sensors[depth_sensor_index].as_depth_sensor()
+        data = {"version": PROFILE_VERSION,
+                "serial": device.get_info(rs.camera_info.serial_number),
+                "firmware": device.get_info(rs.camera_info.firmware_version),
+                "name": device.get_info(rs.camera_info.name),
+                "product_line": device.get_info(rs.camera_info.product_line),
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "sensors": {"rgb": query_sensor(device_sensors[rgb_sensor_index], rgb_sensor_index),
+                            "depth": query_sensor(device_sensors[depth_sensor_index], depth_sensor_index),
+                            "imu": {"index": imu_sensor_index,
+                                    "name": device_sensors[imu_sensor_index].get_info(rs.camera_info.name),
+                                    "options": {}}},
+                "depth_scale": depth_sensor.get_depth_scale(),
+                "streams": {},
+                "extrinsics": {}}
+
+    stream_sensors = {rs.stream.color: device_sensors[data["sensors"]["rgb"]["index"]],
+                      rs.stream.depth: device_sensors[data["sensors"]["depth"]["index"]]}
+    profiles = {}
+    for stream, width, height, format, fps in streams:
+        key = stream_key(stream, width, height, format, fps)
+        profiles[key] = find_stream_profile(stream_sensors[stream], stream, width, height, format, fps)
+        data["streams"][key] = {"intrinsics": intrinsics_dict(profiles[key].get_intrinsics())}
+    # extrinsics between every pair of the requested streams
+    for from_key, from_profile in profiles.items():
+        for to_key, to_profile in profiles.items():
+            if from_key != to_key:
+                data["extrinsics"][f"{from_key}->{to_key}"] = extrinsics_dict(from_profile.get_extrinsics_to(to_profile))
+    return DeviceProfile(data)
+
+
+def load_device_profile(device, streams, cache_dir=CACHE_DIR, refresh=False):
+    # returns the profile and the device sensors, queried once
+    serial = device.get_info(rs.camera_info.serial_number)
+    firmware = device.get_info(rs.camera_info.firmware_version)
+    path = os.path.join(cache_dir, f"{serial}_{firmware}.json")
+    device_sensors = device.query_sensors()
+    keys = [stream_key(*s) for s in streams]
+
+    profile = None
+    if not refresh and os.path.exists(path):
+        try:
+            profile = DeviceProfile.load(path)
+        except (OSError, ValueError):
+            profile = None
+        if profile is not None and not profile.validate(device, device_sensors):
+            print("[INFO] Cached device profile does not match the device, refreshing it")
+            profile = None
+
+    if profile is None:
+        profile = query_profile(device, device_sensors, streams)
+        profile.save(path)
+        print("[INFO] Saved device profile to", path)
+    elif not profile.has_streams(keys):
+        # new stream configuration, keep the cached sensors and add the streams
+        profile = query_profile(device, device_sensors, streams, profile.data)
+        profile.save(path)
+        print("[INFO] Added the new streams to the device profile", path)
+    else:
+        print("[INFO] Loaded device profile from", path)
+    return profile, device_sensors
@@ -0,0 +1,150 @@
+import os
+import json
+from pathlib import Path
+import numpy as np
+
+# Memory-mapped frame archive: fixed-stride raw blocks for depth (uint16) and
+# color (uint8 BGR) plus a compact index of timestamps and byte offsets.
+# Readers get zero-copy NumPy views, so repeated passes over a sequence cost
+# page-cache reads instead of image decodes.
+#
+#   archive/meta.json   frame shapes, dtypes and count
+#   archive/index.npy   structured array, one row per frame
+#   archive/depth.u16   count * height * width uint16
+#   archive/color.u8    count * height * width * 3 uint8
+
+ARCHIVE_DIR = "archive"
+
+INDEX_DTYPE = np.dtype([("timestamp", np.float64),
+                        ("sensor_timestamp", np.float64),
+                        ("exposure", np.float32),
+                        ("depth_offset", np.int64),
+                        ("color_offset", np.int64)])
+
+
+class FrameArchiveWriter:
+    # resume_count keeps the first frames of a checkpointed archive and appends after them
+    def __init__(self, output_dir, resume_count=0):
+        self.archive_dir = Path(output_dir) / ARCHIVE_DIR
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.rows = []
+        self.depth_shape = None
+        self.color_shape = None
+
+        depth_end = color_end = 0
+        if resume_count:
+            with open(self.archive_dir / "meta.json") as f:
+                meta = json.load(f)
+            index = np.load(self.archive_dir / "index.npy")
+            if len(index) < resume_count:
+                raise ValueError(f"Archive has {len(index)} frames, cannot resume at {resume_count}")
+            self.rows = index[:resume_count].tolist()
+            self.depth_shape = tuple(meta["depth_shape"])
+            self.color_shape = tuple(meta["color_shape"])
+            depth_end = resume_count * int(np.prod(self.depth_shape)) * 2
+            color_end = resume_count * int(np.prod(self.color_shape))
+
+        self.depth_file = self._open_truncated(self.archive_dir / "depth.u16", depth_end)
+        self.color_file = self._open_truncated(self.archive_dir / "color.u8", color_end)
+
+    def _open_truncated(self, path, size):
+        if not size:
+            return open(path, "wb")
+        file = open(path, "r+b")
+        file.truncate(size)
+        file.seek(size)
+        return file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, timestamp, depth_image, color_image, sensor_timestamp=np.nan, exposure=np.nan):
+        depth_image = np.ascontiguousarray(depth_image, dtype=np.uint16)
+        color_image = np.ascontiguousarray(color_image, dtype=np.uint8)
+        if self.depth_shape is None:
+            self.depth_shape = depth_image.shape
+            self.color_shape = color_image.shape
+        elif depth_image.shape != self.depth_shape or color_image.shape != self.color_shape:
+            raise ValueError(f"Frame shape changed from {self.depth_shape}/{self.color_shape} "
+                             f"to {depth_image.shape}/{color_image.shape}")
+
+        self.rows.append((timestamp, sensor_timestamp, exposure,
+                          self.depth_file.tell(), self.color_file.tell()))
+        self.depth_file.write(memoryview(depth_image).cast("B"))
+        self.color_file.write(memoryview(color_image).cast("B"))
+
+    def checkpoint(self, complete=False):
+        self.depth_file.flush()
+        self.color_file.flush()
+        index = np.array(self.rows, dtype=INDEX_DTYPE)
+        tmp_path = self.archive_dir / "index.tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.archive_dir / "index.npy")
+        meta = {"count": len(index),
+                "depth_shape": list(self.depth_shape or ()),
+                "color_shape": list(self.color_shape or ()),
+                "depth_dtype": "uint16",
+                "color_dtype": "uint8",
+                "complete": complete}
+        # meta.json goes last, it never counts frames the index does not have
+        tmp_path = self.archive_dir / "meta.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self.archive_dir / "meta.json")
+
+    def close(self):
+        if self.depth_file is None:
+            return
+        self.checkpoint(complete=True)
+        self.depth_file.close()
+        self.color_file.close()
+        self.depth_file = self.color_file = None
+
+
+class FrameArchive:
+    def __init__(self, path):
+        path = Path(path)
+        self.archive_dir = path if (path / "meta.json").exists() else path / ARCHIVE_DIR
+        with open(self.archive_dir / "meta.json") as f:
+            self.meta = json.load(f)
+        self.index = np.load(self.archive_dir / "index.npy")
+        count = self.meta["count"]
+        self.depth_frames = None
+        self.color_frames = None
+        if count:
+            self.depth_frames = np.memmap(self.archive_dir / "depth.u16", dtype=np.uint16, mode="r",
+                                          shape=(count, *self.meta["depth_shape"]))
+            self.color_frames = np.memmap(self.archive_dir / "color.u8", dtype=np.uint8, mode="r",
+                                          shape=(count, *self.meta["color_shape"]))
+
+    def __len__(self):
+        return int(self.meta["count"])
+
+    @property
+    def timestamps(self):
+        return self.index["timestamp"]
+
+    def index_of(self, timestamp):
+        # nearest frame to timestamp
+        timestamps = self.timestamps
+        i = int(np.searchsorted(timestamps, timestamp))
+        if i == 0:
+            return 0
+        if i >= len(timestamps):
+            return len(timestamps) - 1
+        return i if timestamps[i] - timestamp < timestamp - timestamps[i - 1] else i - 1
+
+    def depth(self, index):
+        return self.depth_frames[index]
+
+    def color(self, index):
+        return self.color_frames[index]
+
+    def read(self, index):
+        return self.color_frames[index], self.depth_frames[index]
+
+    def read_at(self, timestamp):
+        return self.read(self.index_of(timestamp))
@@ -0,0 +1,303 @@
+import os
+import json
+import zipfile
+import collections
+from pathlib import Path
+import cv2
+import numpy as np
+
+# Output codecs for extracted sequences. encode() runs in the extraction
+# worker threads in any order, commit() is called in frame order and sets
+# task.depth_name / task.rgb_name, the paths written to depth.txt and rgb.txt.
+# The codec settings are stored in codec.json so FrameReader can decode them.
+# pending_count(), verify() and resume() support resumable extraction.
+# retains_frames tells the extractor whether encode()/commit() keep references
+# to the task images, pooled buffers are only recycled when they do not.
+
+CODEC_FILE = "codec.json"
+CODECS = ("png", "tiff", "pnm", "chunk")
+
+TIFF_COMPRESSION = {"none": 1, "lzw": 5, "deflate": 8}
+
+
+class ImageCodec:
+    # one image file per frame and stream
+    retains_frames = False
+
+    def __init__(self, name, depth_ext, color_ext, params=(), **settings):
+        self.name = name
+        self.depth_ext = depth_ext
+        self.color_ext = color_ext
+        self.params = list(params)
+        self.settings = settings
+        self.output_dir = None
+
+    def configure(self, output_dir):
+        self.output_dir = Path(output_dir)
+        (self.output_dir / "depth").mkdir(parents=True, exist_ok=True)
+        (self.output_dir / "rgb").mkdir(parents=True, exist_ok=True)
+        with open(self.output_dir / CODEC_FILE, "w") as f:
+            json.dump(self.manifest(), f, indent=2)
+
+    def manifest(self):
+        return dict(codec=self.name, depth_ext=self.depth_ext, color_ext=self.color_ext, **self.settings)
+
+    def frame_names(self, timestr):
+        return f"depth/{timestr}{self.depth_ext}", f"rgb/{timestr}{self.color_ext}"
+
+    def encode(self, task):
+        task.depth_name, task.rgb_name = self.frame_names(task.timestr)
+        if not cv2.imwrite(str(self.output_dir / task.depth_name), task.depth_image, self.params):
+            raise IOError(f"Failed to write {task.depth_name}")
+        if not cv2.imwrite(str(self.output_dir / task.rgb_name), task.color_image, self.params):
+            raise IOError(f"Failed to write {task.rgb_name}")
+
+    def commit(self, task):
+        pass
+
+    def pending_count(self):
+        # frames committed to the index but not yet durable on disk
+        return 0
+
+    def verify(self, name):
+        path = self.output_dir / name
+        return path.exists() and path.stat().st_size > 0
+
+    def resumable(self, frame_count):
+        # largest frame count a resume can keep, every frame is its own file here
+        return frame_count
+
+    def resume(self, frame_count):
+        pass
+
+    def close(self):
+        pass
+
+
+def PngCodec(compression=3):
+    # OpenCV defaults to level 3, level 1 encodes much faster for a slightly larger file
+    return ImageCodec("png", ".png", ".png", [cv2.IMWRITE_PNG_COMPRESSION, compression],
+                      compression=compression)
+
+
+def TiffCodec(compression="lzw"):
+    return ImageCodec("tiff", ".tiff", ".tiff", [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION[compression]],
+                      compression=compression)
+
+
+def PnmCodec():
+    # raw binary PGM/PPM, no compression at all but practically free to encode
+    return ImageCodec("pnm", ".pgm", ".ppm", [cv2.IMWRITE_PXM_BINARY, 1])
+
+
+class ChunkCodec:
+    # Packs chunk_size frames per .npz file: depth as a uint16 (N, H, W) array
+    # and color either as raw (N, H, W, 3) uint8 or as concatenated JPEG bytes
+    # with an offset table. Rows in the text indexes point at chunk:slot.
+    # The arrays are deflated at the given zlib level (0 stores them like
+    # np.savez); level 1 makes depth about as small as PNG in less than half
+    # the encode time, np.savez_compressed always uses the slower level 6.
+    name = "chunk"
+    # depth (and raw color) payloads are held until the chunk is flushed
+    retains_frames = True
+
+    def __init__(self, chunk_size=300, color_format="jpeg", jpeg_quality=95, compression=1):
+        if color_format not in ("jpeg", "raw"):
+            raise ValueError(f"Unknown chunk color format: {color_format}")
+        if not 0 <= compression <= 9:
+            raise ValueError(f"Chunk compression must be a zlib level 0-9, not {compression}")
+        self.chunk_size = chunk_size
+        self.color_format = color_format
+        self.jpeg_quality = jpeg_quality
+        self.compression = compression
+        self.output_dir = None
+        self.chunk_index = 0
+        self.pending = []
+
+    def configure(self, output_dir):
+        self.output_dir = Path(output_dir)
+        (self.output_dir / "chunks").mkdir(parents=True, exist_ok=True)
+        with open(self.output_dir / CODEC_FILE, "w") as f:
+            json.dump(self.manifest(), f, indent=2)
+
+    def manifest(self):
+        return dict(codec=self.name, chunk_size=self.chunk_size, color_format=self.color_format,
+                    jpeg_quality=self.jpeg_quality, compression=self.compression)
+
+    def chunk_name(self, chunk_index):
+        return f"chunks/{chunk_index:06d}.npz"
+
+    def encode(self, task):
+        if self.color_format == "jpeg":
+            ok, buffer = cv2.imencode(".jpg", task.color_image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                raise IOError(f"Failed to encode color frame {task.timestr}")
+            task.color_payload = buffer.ravel()
+        else:
+            task.color_payload = task.color_image
+        task.depth_payload = task.depth_image
+
+    def commit(self, task):
+        name = self.chunk_name(self.chunk_index)
+        task.depth_name = task.rgb_name = f"{name}:{len(self.pending)}"
+        self.pending.append((task.timestr, task.depth_payload, task.color_payload))
+        task.depth_payload = task.color_payload = None
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def verify(self, name):
+        return (self.output_dir / name.rsplit(":", 1)[0]).exists()
+
+    def resumable(self, frame_count):
+        # the chunk after the last full one is rewritten from slot 0, rows pointing into it can not be kept
+        return frame_count // self.chunk_size * self.chunk_size
+
+    def resume(self, frame_count):
+        # frame_count is a chunk boundary, see resumable()
+        self.chunk_index = frame_count // self.chunk_size
+        self.pending = []
+
+    def flush(self):
+        if not self.pending:
+            return
+        timestrs, depth, color = zip(*self.pending)
+        arrays = {"timestamps": np.array([float(t) for t in timestrs], dtype=np.float64),
+                  "depth": np.stack(depth)}
+        if self.color_format == "jpeg":
+            sizes = [len(c) for c in color]
+            arrays["color_jpeg"] = np.concatenate(color)
+            arrays["color_offsets"] = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        else:
+            arrays["color"] = np.stack(color)
+
+        # write to a temporary file first so a chunk is either complete or absent
+        path = self.output_dir / self.chunk_name(self.chunk_index)
+        tmp_path = path.with_suffix(".tmp.npz")
+        self._write_npz(tmp_path, arrays)
+        os.replace(tmp_path, path)
+        self.chunk_index += 1
+        self.pending = []
+
+    def _write_npz(self, path, arrays):
+        # the .npz layout of np.savez, np.load reads stored and deflated members alike
+        if self.compression:
+            archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=self.compression)
+        else:
+            archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        with archive:
+            for key, array in arrays.items():
+                with archive.open(key + ".npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+    def close(self):
+        self.flush()
+
+
+def create_codec(name, png_compression=3, tiff_compression="lzw", chunk_size=300,
+                 color_format="jpeg", jpeg_quality=95, chunk_compression=1):
+    if name == "png":
+        return PngCodec(png_compression)
+    if name == "tiff":
+        return TiffCodec(tiff_compression)
+    if name == "pnm":
+        return PnmCodec()
+    if name == "chunk":
+        return ChunkCodec(chunk_size, color_format, jpeg_quality, chunk_compression)
+    raise ValueError(f"Unknown codec: {name}")
+
+
+def read_index(path):
+    # TUM style "timestamp relative_path" rows
+    timestamps = []
+    names = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            timestr, name = line.split()[:2]
+            timestamps.append(float(timestr))
+            names.append(name)
+    return np.array(timestamps, dtype=np.float64), names
+
+
+class FrameReader:
+    # Random access to an extracted sequence written with any of the codecs.
+    # read_indexes=False skips parsing rgb.txt/depth.txt for callers that
+    # already have the names and only use read_name().
+    def __init__(self, sequence_dir, cache_chunks=2, read_indexes=True):
+        self.sequence_dir = Path(sequence_dir)
+        manifest_path = self.sequence_dir / CODEC_FILE
+        self.manifest = {"codec": "png"}
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        self.depth_timestamps, self.depth_names = np.zeros(0), []
+        self.rgb_timestamps, self.rgb_names = np.zeros(0), []
+        if read_indexes:
+            self.depth_timestamps, self.depth_names = read_index(self.sequence_dir / "depth.txt")
+            self.rgb_timestamps, self.rgb_names = read_index(self.sequence_dir / "rgb.txt")
+        self.cache_chunks = cache_chunks
+        self.chunks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.rgb_names)
+
+    @property
+    def timestamps(self):
+        return self.rgb_timestamps
+
+    def index_of(self, timestamp):
+        # nearest frame to timestamp
+        timestamps = self.rgb_timestamps
+        i = int(np.searchsorted(timestamps, timestamp))
+        if i == 0:
+            return 0
+        if i >= len(timestamps):
+            return len(timestamps) - 1
+        return i if timestamps[i] - timestamp < timestamp - timestamps[i - 1] else i - 1
+
+    def _load_chunk(self, name):
+        # np.load inflates the members of deflated chunks (manifest "compression" > 0) itself
+        chunk = self.chunks.get(name)
+        if chunk is None:
+            with np.load(self.sequence_dir / name) as data:
+                chunk = {key: data[key] for key in data.files}
+            self.chunks[name] = chunk
+            if len(self.chunks) > self.cache_chunks:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(name)
+        return chunk
+
+    def _read_chunk_entry(self, name, stream):
+        chunk_name, slot = name.rsplit(":", 1)
+        chunk = self._load_chunk(chunk_name)
+        slot = int(slot)
+        if stream == "depth":
+            return chunk["depth"][slot]
+        if "color" in chunk:
+            return chunk["color"][slot]
+        offsets = chunk["color_offsets"]
+        return cv2.imdecode(chunk["color_jpeg"][offsets[slot]:offsets[slot + 1]], cv2.IMREAD_COLOR)
+
+    def read_name(self, name, stream):
+        # one frame by its depth.txt/rgb.txt path, stream is "depth" or "color"
+        if self.manifest["codec"] == "chunk":
+            return self._read_chunk_entry(name, stream)
+        flags = cv2.IMREAD_UNCHANGED if stream == "depth" else cv2.IMREAD_COLOR
+        return cv2.imread(str(self.sequence_dir / name), flags)
+
+    def read_depth(self, index):
+        return self.read_name(self.depth_names[index], "depth")
+
+    def read_color(self, index):
+        return self.read_name(self.rgb_names[index], "color")
+
+    def read(self, index):
+        return self.read_color(index), self.read_depth(index)
+
+    def read_at(self, timestamp):
+        return self.read(self.index_of(timestamp))
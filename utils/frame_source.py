@@ -0,0 +1,346 @@
+import time
+import datetime
+import cv2
+import numpy as np
+import pyrealsense2 as rs
+
+# Frame sources share the subset of the rs.pipeline API the scripts use:
+# start(), wait_for_frames(), try_wait_for_frames(), stop(), plus
+# get_color_sensor(), get_depth_sensor(), get_depth_scale() and align_frames().
+# Bag and synthetic sources can also seek(), get_position() and get_duration(),
+# all in seconds from the start of the recording. Framesets and
+# frames only need get_color_frame()/get_depth_frame(), get_data(),
+# get_timestamp() and get_frame_metadata(), so the synthetic frames below can
+# replace real ones anywhere in the capture, AE, alignment and extraction code.
+
+SOURCE_TYPES = ("camera", "bag", "synthetic")
+
+
+class PipelineSource:
+    def __init__(self):
+        self.pipeline = rs.pipeline()
+        self.config = rs.config()
+        self.profile = None
+        self.align = None
+
+    def enable_stream(self, *args):
+        self.config.enable_stream(*args)
+
+    def resolve(self):
+        # resolve the profile before start so sensors can be configured
+        pipeline_wrapper = rs.pipeline_wrapper(self.pipeline)
+        self.profile = self.config.resolve(pipeline_wrapper)
+        return self.profile
+
+    def start(self):
+        self.profile = self.pipeline.start(self.config)
+        return self.profile
+
+    def wait_for_frames(self):
+        return self.pipeline.wait_for_frames()
+
+    def try_wait_for_frames(self, timeout_ms=5000):
+        return self.pipeline.try_wait_for_frames(timeout_ms)
+
+    def stop(self):
+        self.pipeline.stop()
+
+    def get_device(self):
+        profile = self.profile if self.profile is not None else self.resolve()
+        return profile.get_device()
+
+    def get_color_sensor(self):
+        return self.get_device().first_color_sensor()
+
+    def get_depth_sensor(self):
+        return self.get_device().first_depth_sensor()
+
+    def get_depth_scale(self):
+        return self.get_depth_sensor().get_depth_scale()
+
+    def align_frames(self, frames):
+        # align depth to color with librealsense
+        if self.align is None:
+            self.align = rs.align(rs.stream.color)
+        return self.align.process(frames)
+
+
+class LiveCameraSource(PipelineSource):
+    def __init__(self, record_path=None, serial=None):
+        super().__init__()
+        # with several cameras connected each source picks its device by serial number
+        if serial is not None:
+            self.config.enable_device(serial)
+        if record_path is not None:
+            self.config.enable_record_to_file(str(record_path))
+
+
+class BagSource(PipelineSource):
+    def __init__(self, bag_path, realtime=False, repeat_playback=False):
+        super().__init__()
+        self.realtime = realtime
+        self.playback = None
+        self.config.enable_device_from_file(str(bag_path), repeat_playback=repeat_playback)
+
+    def start(self):
+        super().start()
+        # without real time playback frames are decoded as fast as they are consumed
+        self.playback = self.profile.get_device().as_playback()
+        self.playback.set_real_time(self.realtime)
+        return self.profile
+
+    def seek(self, seconds):
+        # position relative to the start of the bag
+        self.playback.seek(datetime.timedelta(seconds=seconds))
+
+    def get_position(self):
+        return self.playback.get_position() / 1e9
+
+    def get_duration(self):
+        # known before start too, the resolved profile has the playback device
+        playback = self.playback if self.playback is not None else self.get_device().as_playback()
+        return playback.get_duration().total_seconds()
+
+
+class SyntheticOptionRange:
+    def __init__(self, min, max, step, default):
+        self.min = min
+        self.max = max
+        self.step = step
+        self.default = default
+
+
+class SyntheticSensor:
+    # stands in for the color sensor, exposure is in 100 usec units like the D455
+    def __init__(self, exposure=250):
+        self.options = {rs.option.exposure: exposure,
+                        rs.option.enable_auto_exposure: 0,
+                        rs.option.enable_auto_white_balance: 0,
+                        rs.option.power_line_frequency: 1,
+                        rs.option.global_time_enabled: 1}
+        self.ranges = {rs.option.exposure: SyntheticOptionRange(1, 10000, 1, 156)}
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def get_option(self, option):
+        return self.options[option]
+
+    def get_option_range(self, option):
+        return self.ranges[option]
+
+    def supports(self, option):
+        return option in self.options
+
+    def get_depth_scale(self):
+        return 0.001
+
+
+class SyntheticFrame:
+    def __init__(self, data, frame_number, timestamp_ms, metadata):
+        self.data = data
+        self.frame_number = frame_number
+        self.timestamp_ms = timestamp_ms
+        self.metadata = metadata
+
+    def __bool__(self):
+        return True
+
+    def get_data(self):
+        return self.data
+
+    def get_frame_number(self):
+        return self.frame_number
+
+    def get_timestamp(self):
+        return self.timestamp_ms
+
+    def get_frame_timestamp_domain(self):
+        return rs.timestamp_domain.global_time
+
+    def supports_frame_metadata(self, key):
+        return key in self.metadata
+
+    def get_frame_metadata(self, key):
+        return self.metadata[key]
+
+    def keep(self):
+        pass
+
+
+class SyntheticFrameset(SyntheticFrame):
+    def __init__(self, color_frame, depth_frame):
+        super().__init__(None, color_frame.frame_number, color_frame.timestamp_ms, color_frame.metadata)
+        self.color_frame = color_frame
+        self.depth_frame = depth_frame
+
+    def get_color_frame(self):
+        return self.color_frame
+
+    def get_depth_frame(self):
+        return self.depth_frame
+
+
+class SyntheticSource:
+    # Generates color and depth frames without a camera. The color image is a
+    # fixed scene radiance map scaled by the exposure that was set on the
+    # sensor for the previous frame, so the AE loop runs closed-loop. The
+    # scene gain can follow a schedule to simulate lighting changes, and
+    # realtime paces frames at fps (otherwise frames come as fast as consumed).
+    def __init__(self, width=640, height=480, fps=30, depth=True, realtime=False,
+                 exposure=250, scene_gain=1.0, noise=0.0, max_frames=None, seed=0, base_timestamp_ms=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.depth = depth
+        self.realtime = realtime
+        self.scene_gain = scene_gain
+        self.noise = noise
+        self.max_frames = max_frames
+        self.rng = np.random.default_rng(seed)
+        self.color_sensor = SyntheticSensor(exposure)
+        self.depth_sensor = SyntheticSensor(exposure)
+
+        self.radiance = self._make_radiance()
+        self.depth_image = self._make_depth() if depth else None
+        self.frame_number = 0
+        self.start_time = None
+        self.pending_exposure = exposure
+        # fixed base timestamp makes runs reproducible, default is the wall clock at start
+        self.base_timestamp_ms = base_timestamp_ms
+
+    def _make_radiance(self):
+        # smooth gradient with a checkerboard so brightness and texture are both visible,
+        # normalized so a 25 msec exposure at unit gain lands near mid-gray
+        y, x = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+        gradient = 0.5 + 0.5 * (x / max(self.width - 1, 1))
+        checker = (((x // 40) + (y // 40)) % 2).astype(np.float32) * 0.4 + 0.6
+        radiance = gradient * checker
+        radiance *= 0.5 / radiance.mean()
+        channels = np.stack([radiance * 0.9, radiance, radiance * 1.1], axis=-1)
+        return channels.astype(np.float32)
+
+    def _make_depth(self):
+        # tilted plane with a sphere in front, in millimeters (depth scale 0.001)
+        y, x = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+        plane = 1500. + 1000. * (y / max(self.height - 1, 1))
+        cx, cy, r = self.width / 2, self.height / 2, min(self.width, self.height) / 4
+        d2 = (x - cx) ** 2 + (y - cy) ** 2
+        sphere = 800. - np.sqrt(np.maximum(r * r - d2, 0)) * 2
+        depth = np.where(d2 < r * r, sphere, plane)
+        return depth.astype(np.uint16)
+
+    def _gain(self, t):
+        if callable(self.scene_gain):
+            return float(self.scene_gain(t))
+        return float(self.scene_gain)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.base_timestamp_ms is None:
+            self.base_timestamp_ms = time.time() * 1e3
+        self.frame_number = 0
+        return None
+
+    def stop(self):
+        pass
+
+    def seek(self, seconds):
+        if self.start_time is None:
+            self.start()
+        self.frame_number = int(round(seconds * self.fps))
+        self.start_time = time.perf_counter() - seconds
+
+    def get_position(self):
+        return max(self.frame_number - 1, 0) / self.fps
+
+    def get_duration(self):
+        return self.max_frames / self.fps if self.max_frames is not None else float("inf")
+
+    def get_color_sensor(self):
+        return self.color_sensor
+
+    def get_depth_sensor(self):
+        return self.depth_sensor
+
+    def get_depth_scale(self):
+        return self.depth_sensor.get_depth_scale()
+
+    def align_frames(self, frames):
+        # synthetic depth is generated in the color frame already
+        return frames
+
+    def render_color(self, exposure, t):
+        # exposure in 100 usec units, 250 (25 msec) is the reference exposure
+        scale = exposure / 250. * self._gain(t) * 255.
+        image = cv2.convertScaleAbs(self.radiance, alpha=scale)
+        if self.noise > 0:
+            noise = self.rng.normal(0, self.noise, image.shape).astype(np.int16)
+            image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        return image
+
+    def wait_for_frames(self):
+        ok, frames = self.try_wait_for_frames()
+        if not ok:
+            raise RuntimeError("Synthetic source reached max_frames")
+        return frames
+
+    def try_wait_for_frames(self, timeout_ms=5000):
+        if self.start_time is None:
+            self.start()
+        if self.max_frames is not None and self.frame_number >= self.max_frames:
+            return False, None
+
+        t = self.frame_number / self.fps
+        if self.realtime:
+            delay = self.start_time + t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        # the exposure set during the previous frame applies to this one
+        exposure = self.pending_exposure
+        self.pending_exposure = self.color_sensor.get_option(rs.option.exposure)
+
+        timestamp_ms = self.base_timestamp_ms + t * 1e3
+        metadata = {rs.frame_metadata_value.actual_exposure: int(round(exposure)),
+                    rs.frame_metadata_value.frame_counter: self.frame_number,
+                    rs.frame_metadata_value.sensor_timestamp: int(timestamp_ms * 1e3),
+                    rs.frame_metadata_value.frame_timestamp: int(timestamp_ms * 1e3),
+                    rs.frame_metadata_value.backend_timestamp: int(timestamp_ms),
+                    rs.frame_metadata_value.time_of_arrival: int(timestamp_ms)}
+        color_frame = SyntheticFrame(self.render_color(exposure, t),
+                                     self.frame_number, timestamp_ms, metadata)
+        depth_frame = None
+        if self.depth:
+            depth_frame = SyntheticFrame(self.depth_image, self.frame_number, timestamp_ms, metadata)
+        self.frame_number += 1
+        return True, SyntheticFrameset(color_frame, depth_frame)
+
+
+def list_devices():
+    # (serial number, name, firmware version) of every connected camera
+    devices = []
+    for device in rs.context().query_devices():
+        devices.append((device.get_info(rs.camera_info.serial_number),
+                        device.get_info(rs.camera_info.name),
+                        device.get_info(rs.camera_info.firmware_version)))
+    return devices
+
+
+def find_device(serial=None):
+    # rs.device of the camera with this serial number (any camera for None), no pipeline needed
+    for device in rs.context().query_devices():
+        if serial is None or device.get_info(rs.camera_info.serial_number) == serial:
+            return device
+    raise RuntimeError(f"No RealSense device {serial or ''} connected")
+
+
+def create_source(source_type, width=640, height=480, fps=30, bag_path=None, record_path=None,
+                  realtime=True, depth=True, serial=None):
+    if source_type == "camera":
+        return LiveCameraSource(record_path, serial)
+    if source_type == "bag":
+        return BagSource(bag_path, realtime=realtime)
+    if source_type == "synthetic":
+        return SyntheticSource(width, height, fps, depth=depth, realtime=realtime)
+    raise ValueError(f"Unknown frame source: {source_type}")
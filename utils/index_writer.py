@@ -0,0 +1,140 @@
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+# Streaming writer for the per-frame index files of an extracted sequence.
+# The four text indexes stay open with large buffers and rows are written in
+# batches instead of opening every file once per frame, which is what made
+# extraction slow on networked storage. Next to them frames.bin holds the
+# same per-frame values as fixed-size binary records, so a whole sequence
+# loads with one np.fromfile and every field is a NumPy column.
+
+FRAME_TABLE = "frames.bin"
+
+FRAME_TABLE_DTYPE = np.dtype([("timestamp", np.float64),
+                              ("sensor_timestamp", np.float64),
+                              ("exposure", np.float32),
+                              ("frame_number", np.int64)])
+
+
+def load_frame_table(sequence_dir, mmap=False):
+    # structured array, table["timestamp"] etc. are the columns
+    path = Path(sequence_dir) / FRAME_TABLE
+    if mmap:
+        return np.memmap(path, dtype=FRAME_TABLE_DTYPE, mode="r")
+    return np.fromfile(path, dtype=FRAME_TABLE_DTYPE)
+
+
+class IndexWriter:
+    # resume_count is the number of rows already in the (truncated) text indexes
+    def __init__(self, output_dir, flush_rows=256, buffer_size=1 << 20, frame_table=True, resume_count=0):
+        self.output_dir = Path(output_dir)
+        self.flush_rows = flush_rows
+        self.files = {name: open(self.output_dir / name, "a", buffering=buffer_size)
+                      for name in ("depth.txt", "rgb.txt", "sensor_timestamp.txt", "exposure_time.txt")}
+        self.lines = {name: [] for name in self.files}
+        self.rows = []
+        self.table = None
+        if frame_table:
+            self.table = self._open_table(self.output_dir / FRAME_TABLE, resume_count, buffer_size)
+
+    def _open_table(self, path, resume_count, buffer_size):
+        size = resume_count * FRAME_TABLE_DTYPE.itemsize
+        if not size:
+            return open(path, "wb", buffering=buffer_size)
+        if not path.exists() or path.stat().st_size < size:
+            # the run we resume did not write the table, a partial one would be misleading
+            print(f"[INFO] {path} does not cover the resumed frames, it is not written")
+            if path.exists():
+                path.unlink()
+            return None
+        table = open(path, "r+b", buffering=buffer_size)
+        table.truncate(size)
+        table.seek(size)
+        return table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, task):
+        self.lines["depth.txt"].append(f"{task.timestr} {task.depth_name}\n")
+        self.lines["rgb.txt"].append(f"{task.timestr} {task.rgb_name}\n")
+        self.lines["sensor_timestamp.txt"].append(f"{task.timestr} {task.stamp_sensor:.8f}\n")
+        self.lines["exposure_time.txt"].append(f"{task.timestr} {task.exposure_t}\n")
+        if self.table is not None:
+            frame_number = task.frame_number if task.frame_number is not None else -1
+            self.rows.append((float(task.timestr), task.stamp_sensor, task.exposure_t, frame_number))
+        if len(self.rows) >= self.flush_rows or len(self.lines["depth.txt"]) >= self.flush_rows:
+            self._write_pending()
+
+    def _write_pending(self):
+        for name, lines in self.lines.items():
+            if lines:
+                self.files[name].write("".join(lines))
+                lines.clear()
+        if self.rows:
+            self.table.write(np.array(self.rows, dtype=FRAME_TABLE_DTYPE).tobytes())
+            self.rows.clear()
+
+    def flush(self):
+        # everything written so far is on disk, called before a checkpoint is saved
+        self._write_pending()
+        for file in self.files.values():
+            file.flush()
+        if self.table is not None:
+            self.table.flush()
+
+    def close(self):
+        if self.files is None:
+            return
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        if self.table is not None:
+            self.table.close()
+        self.files = None
+        self.table = None
+
+
+class ProgressLine:
+    # one status line rewritten at most every interval seconds instead of a print per frame
+    def __init__(self, duration=None, interval=1.0, stream=sys.stdout):
+        self.duration = duration
+        self.interval = interval
+        self.stream = stream
+        self.start_time = time.perf_counter()
+        self.last_update = None
+        self.frames = 0
+        self.position = None
+        self.shown = False
+
+    def update(self, frames, position=None, force=False):
+        self.frames = frames
+        self.position = position
+        now = time.perf_counter()
+        if not force and self.last_update is not None and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        elapsed = now - self.start_time
+        line = f"[INFO] {frames} frames, {frames / elapsed if elapsed > 0 else 0.:.1f} frames/sec"
+        if position is not None:
+            line += f", {position:.1f}"
+            if self.duration:
+                line += f"/{self.duration:.1f} sec ({100. * position / self.duration:.0f}%)"
+            else:
+                line += " sec"
+        self.stream.write("\r" + line.ljust(79))
+        self.stream.flush()
+        self.shown = True
+
+    def close(self):
+        if self.shown:
+            # final counts, the last rate-limited update is usually stale
+            self.update(self.frames, self.position, force=True)
+            self.stream.write("\n")
+            self.stream.flush()
+            self.shown = False
@@ -1,111 +1,157 @@
 import os
 import time
+import atexit
 import threading
 import pyrealsense2 as rs
 
-timestr = time.strftime("%Y%m%d-%H%M%S")
-WORK_DIR = os.path.expanduser("./bags/test_mbavo2_10ms_expo" + timestr)
+from utils import device_profile
 
-class ExposureTimeSaver:
-    def __init__(self):
-        self.dir_path = WORK_DIR
-        self.file_path = os.path.join(self.dir_path, "exposure_times.txt")
+# session output directory, set by the recorders from their utils.session_config
+WORK_DIR = None
+
+def set_work_dir(path):
+    global WORK_DIR
+    WORK_DIR = path
+    return path
+
+def work_dir():
+    if WORK_DIR is None:
+        raise RuntimeError("No session directory, call logger.set_work_dir() first")
+    return WORK_DIR
+
+class MetadataSink:
+    # Keeps one metadata file open and batches lines in memory. Lines are
+    # flushed once flush_lines are pending or flush_interval seconds passed,
+    # and on close (context manager or interpreter exit). With background=True
+    # a writer thread does all disk IO so the capture loop never blocks on it.
+    def __init__(self, file_path, flush_lines=256, flush_interval=1.0, background=False):
+        self.file_path = file_path
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.background = background
         self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
         self.file = None
-        if os.path.isfile(self.file_path):
-            os.remove(self.file_path)
+        self.lines = []
+        self.last_flush = time.monotonic()
+        self.closed = False
+
+        self.writer = None
+        if background:
+            self.wakeup = threading.Condition(self.lock)
+            self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+            self.writer.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _open_file(self):
-        # Open the file with append mode
+        # Open the file with append mode on the first flush
         if self.file is None:
-            self.file = open(self.file_path, "a")
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.file = open(self.file_path, "a", buffering=1 << 16)
 
-    def _close_file(self):
-        # Close the file if it's open
-        if self.file is not None:
-            self.file.close()
-            self.file = None
+    def _write_lines(self, lines):
+        if lines:
+            self._open_file()
+            self.file.write("".join(lines))
+            self.file.flush()
 
-    def save_exposure_time(self, ts):
-        # Ensure the directory exists
-        os.makedirs(self.dir_path, exist_ok=True)
+    def _take_lines(self):
+        lines = self.lines
+        self.lines = []
+        self.last_flush = time.monotonic()
+        return lines
 
+    def _writer_loop(self):
+        while True:
+            with self.lock:
+                if not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                break
+
+    def write_line(self, line):
         with self.lock:
-            # Open file
-            self._open_file()
-            # Write the exposure time
-            self.file.write("{:.2f}".format(ts) + "\n")
-            # Ensure the file is properly closed
-            self._close_file()
+            if self.closed:
+                return
+            self.lines.append(line + "\n")
+            due = (len(self.lines) >= self.flush_lines or
+                   time.monotonic() - self.last_flush >= self.flush_interval)
+            if due and self.background:
+                self.wakeup.notify()
+        if due and not self.background:
+            self.flush()
 
-class TimeStampSaver:
-    def __init__(self):
-        self.dir_path = WORK_DIR
-        self.file_path = os.path.join(self.dir_path, "timestamps.txt")
-        self.lock = threading.Lock()
-        self.file = None
+    def flush(self):
+        # io_lock keeps batches in order, lock is only held for the swap
+        with self.io_lock:
+            with self.lock:
+                lines = self._take_lines()
+            self._write_lines(lines)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.background:
+                self.wakeup.notify()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        with self.io_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        atexit.unregister(self.close)
+
+class ExposureTimeSaver:
+    def __init__(self, background=False, dir_path=None):
+        self.dir_path = dir_path if dir_path is not None else work_dir()
+        self.file_path = os.path.join(self.dir_path, "exposure_times.txt")
         if os.path.isfile(self.file_path):
             os.remove(self.file_path)
+        self.sink = MetadataSink(self.file_path, background=background)
 
-    def _open_file(self):
-        # Open the file with append mode
-        if self.file is None:
-            self.file = open(self.file_path, "a")
+    def save_exposure_time(self, ts):
+        # Buffer the exposure time, the sink writes it out in batches
+        self.sink.write_line("{:.2f}".format(ts))
 
-    def _close_file(self):
-        # Close the file if it's open
-        if self.file is not None:
-            self.file.close()
-            self.file = None
+    def close(self):
+        self.sink.close()
 
-    def save_timestamps(self, ts):
-        # Ensure the directory exists
-        os.makedirs(self.dir_path, exist_ok=True)
+class TimeStampSaver:
+    def __init__(self, background=False, dir_path=None):
+        self.dir_path = dir_path if dir_path is not None else work_dir()
+        self.file_path = os.path.join(self.dir_path, "timestamps.txt")
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+        self.sink = MetadataSink(self.file_path, background=background)
 
-        with self.lock:
-            # Open file
-            self._open_file()
-            # Write the exposure time
-            self.file.write("{:.2f}".format(ts) + "\n")
-            # Ensure the file is properly closed
-            self._close_file()
+    def save_timestamps(self, ts):
+        # Buffer the timestamp, the sink writes it out in batches
+        self.sink.write_line("{:.2f}".format(ts))
 
-def save_sensor_intrinsics(pipeline_profile: rs.pipeline_profile, stream_type: rs.stream):
-    stream_profile = pipeline_profile.get_stream(stream_type)
-    video_stream_profile = stream_profile.as_video_stream_profile()
-    sensor_intrinsics = video_stream_profile.get_intrinsics()
+    def close(self):
+        self.sink.close()
 
-    dir = WORK_DIR
-    os.makedirs(dir, exist_ok=True)
+def save_device_profile(profile, color_stream, depth_stream=None, dir_path=None):
+    # copy of the cached device profile plus the stream keys this session recorded
+    dir = dir_path if dir_path is not None else work_dir()
+    session = {"color": color_stream}
+    if depth_stream is not None:
+        session["depth"] = depth_stream
+    device_profile.DeviceProfile(dict(profile.data, session=session)).save(
+        os.path.join(dir, device_profile.PROFILE_FILE))
 
-    if stream_type == rs.stream.color:
-        f = os.path.join(dir, "color_sensor_intrinsics.txt")
-        with open(f, "w") as file:
-            file.write("sensor_type: \"color_sensor\"\n")
-            file.write("distortion_model: " + "\"" + str(sensor_intrinsics.model) + "\"" + "\n")
-            file.write("distortion_coeffs: " + str(sensor_intrinsics.coeffs) + "\n")
-            file.write("width: " + str(sensor_intrinsics.width) + "\n")
-            file.write("height: " + str(sensor_intrinsics.height) + "\n")
-            file.write("fx: " + str(sensor_intrinsics.fx) + "\n")
-            file.write("fy: " + str(sensor_intrinsics.fy) + "\n")
-            file.write("cx: " + str(sensor_intrinsics.ppx) + "\n")
-            file.write("cy: " + str(sensor_intrinsics.ppy) + "\n")
-            file.close()
-    elif stream_type == rs.stream.depth:
-        f = os.path.join(dir, "depth_sensor_intrinsics.txt")
-        with open(f, "w") as file:
-            file.write("sensor_type: \"depth_sensor\"\n")
-            file.write("distortion_model: " + "\"" + str(sensor_intrinsics.model) + "\"" + "\n")
-            file.write("distortion_coeffs: " + str(sensor_intrinsics.coeffs) + "\n")
-            file.write("width: " + str(sensor_intrinsics.width) + "\n")
-            file.write("height: " + str(sensor_intrinsics.height) + "\n")
-            file.write("fx: " + str(sensor_intrinsics.fx) + "\n")
-            file.write("fy: " + str(sensor_intrinsics.fy) + "\n")
-            file.write("cx: " + str(sensor_intrinsics.ppx) + "\n")
-            file.write("cy: " + str(sensor_intrinsics.ppy) + "\n")
-            file.close()
-
-def set_record_to_bag_file(config: rs.config):
-    dir = WORK_DIR
+def set_record_to_bag_file(config: rs.config, dir_path=None):
+    dir = dir_path if dir_path is not None else work_dir()
     os.makedirs(dir, exist_ok=True)
     config.enable_record_to_file(os.path.join(dir, "data.bag"))
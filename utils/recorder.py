@@ -0,0 +1,221 @@
+import time
+import threading
+import numpy as np
+import pyrealsense2 as rs
+
+from utils import viewer
+from utils.telemetry import LatencyStats
+from auto_exposure import next_exposure
+
+
+class LatestSlot:
+    # Single-item mailbox: put() overwrites whatever was not consumed yet,
+    # so readers always get the newest item and stale ones are counted as dropped.
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if self.item is None and not self.closed:
+                self.cond.wait(timeout)
+            item = self.item
+            self.item = None
+            return item
+
+    def get_nowait(self):
+        with self.cond:
+            item = self.item
+            self.item = None
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class CapturedFrame:
+    def __init__(self, frame, image, actual_exp_time, timestamp, arrival, exposure_cmd):
+        # keep a reference to the realsense frame so the zero-copy image stays valid
+        self.frame = frame
+        self.image = image
+        self.actual_exp_time = actual_exp_time
+        self.timestamp = timestamp
+        self.arrival = arrival
+        self.exposure_cmd = exposure_cmd
+
+
+class ConcurrentRecorder:
+    # Runs the AE recorder as three stages: a capture thread that only grabs
+    # frames and logs metadata, an AE worker that meters the newest frame and
+    # sets the exposure on the sensor itself, and the display loop on the calling
+    # thread (HighGUI windows must live on the main thread on some platforms).
+    # pipeline only needs wait_for_frames() and color_sensor only set_option(),
+    # so fake sources can stand in for the camera. With a CaptureTelemetry the
+    # stage timings are shared with it and every frame is checked for drops.
+    # A throttled viewer only takes the newest frame when a preview is due.
+    # A utils.segment_writer.SegmentWriter gets a copy of every frame.
+    def __init__(self, pipeline, color_sensor, auto_exposure, initial_exposure,
+                 exposure_time_saver=None, timestamps_saver=None, display=True, telemetry=None, preview=None,
+                 frame_writer=None):
+        self.pipeline = pipeline
+        self.color_sensor = color_sensor
+        self.auto_exposure = auto_exposure
+        self.exposure = initial_exposure
+        self.exposure_time_saver = exposure_time_saver
+        self.timestamps_saver = timestamps_saver
+        self.preview = preview if preview is not None else viewer.Viewer()
+        self.display = display and not self.preview.headless
+        self.telemetry = telemetry
+        self.frame_writer = frame_writer
+
+        self.ae_slot = LatestSlot()
+        self.display_slot = LatestSlot()
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.frame_count = 0
+
+        if telemetry is not None:
+            self.wait_stats = telemetry.stage_stats("wait")
+            self.ae_stats = telemetry.stage_stats("ae")
+            self.display_stats = telemetry.stage_stats("display")
+            self.log_stats = telemetry.stage_stats("logging")
+            self.apply_stats = telemetry.stage_stats("exposure applied")
+        else:
+            self.wait_stats = LatencyStats("wait_for_frames")
+            self.ae_stats = LatencyStats("auto exposure")
+            self.display_stats = LatencyStats("display")
+            self.log_stats = LatencyStats("logging")
+            self.apply_stats = LatencyStats("frame to exposure applied")
+
+    def stop(self):
+        self.stop_event.set()
+        self.ae_slot.close()
+        self.display_slot.close()
+
+    def _run_stage(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.errors.append(e)
+            self.stop()
+
+    def _apply_exposure(self, exposure, frame_arrival):
+        # called from the AE worker as soon as the command is computed, option writes are
+        # thread-safe in librealsense, so it does not wait for the capture thread to come
+        # back from wait_for_frames
+        self.exposure = exposure
+        self.color_sensor.set_option(rs.option.exposure, exposure)
+        self.apply_stats.add(time.perf_counter() - frame_arrival)
+
+    def _capture_loop(self):
+        self.color_sensor.set_option(rs.option.exposure, self.exposure)
+        while not self.stop_event.is_set():
+            # Wait for a frames metadata
+            start = time.perf_counter()
+            frames = self.pipeline.wait_for_frames()
+            arrival = time.perf_counter()
+            self.wait_stats.add(arrival - start)
+            color_frame = frames.get_color_frame()
+            if not color_frame:
+                continue
+
+            # get actual exposure time and timestamp
+            actual_exp_time = color_frame.get_frame_metadata(rs.frame_metadata_value.actual_exposure)
+            color_sensor_timestamp = color_frame.get_timestamp() / 1000
+            if self.telemetry is not None:
+                self.telemetry.frame(color_frame.get_frame_number(), color_sensor_timestamp, arrival)
+            log_start = time.perf_counter()
+            if self.exposure_time_saver is not None:
+                self.exposure_time_saver.save_exposure_time(actual_exp_time / 10)
+            if self.timestamps_saver is not None:
+                self.timestamps_saver.save_timestamps(color_sensor_timestamp)
+            image = np.asanyarray(color_frame.get_data())
+            if self.frame_writer is not None:
+                self.frame_writer.push(image, None, color_sensor_timestamp, exposure=actual_exp_time,
+                                       frame_number=color_frame.get_frame_number())
+            self.log_stats.add(time.perf_counter() - log_start)
+
+            frame = CapturedFrame(color_frame, image, actual_exp_time, color_sensor_timestamp, arrival, self.exposure)
+            self.frame_count += 1
+            self.ae_slot.put(frame)
+            if self.display:
+                self.display_slot.put(frame)
+            if self.telemetry is not None:
+                self.telemetry.set_counter("ae_skipped", self.ae_slot.dropped)
+                self.telemetry.set_counter("display_skipped", self.display_slot.dropped)
+
+    def _ae_loop(self):
+        while not self.stop_event.is_set():
+            frame = self.ae_slot.get(timeout=0.5)
+            if frame is None:
+                continue
+            start = time.perf_counter()
+            # update from the exposure the frame was taken with: a command reaches the sensor a frame
+            # or two late and this worker skips frames, so the command at capture time can already be
+            # newer than the frame, and stepping from it compounds into an oscillation
+            exposure = frame.actual_exp_time if frame.actual_exp_time else frame.exposure_cmd
+            next_exposure_time = next_exposure(self.auto_exposure, frame.image, exposure, frame.actual_exp_time)
+            self.ae_stats.add(time.perf_counter() - start)
+            self._apply_exposure(next_exposure_time, frame.arrival)
+
+    def _display_loop(self):
+        while not self.stop_event.is_set():
+            # sleep until the next preview is due, frames in between are skipped by the slot
+            if self.stop_event.wait(self.preview.time_until_due()):
+                break
+            frame = self.display_slot.get(timeout=0.5)
+            if frame is None:
+                continue
+            start = time.perf_counter()
+            # the viewer draws into its own buffer, the AE worker may still be reading the frame
+            telemetry_lines = self.telemetry.overlay_lines() if self.telemetry is not None else []
+            if self.frame_writer is not None:
+                telemetry_lines += self.frame_writer.overlay_lines()
+            key = self.preview.show_exposure(frame.image, frame.actual_exp_time,
+                                             self.auto_exposure.w_avg_bright, frame.timestamp, telemetry_lines)
+            self.display_stats.add(time.perf_counter() - start)
+            if key & 0xFF == ord('q') or key == 27:
+                self.preview.close()
+                self.stop()
+
+    def run(self, duration=None):
+        stages = [threading.Thread(target=self._run_stage, args=(self._capture_loop,), daemon=True),
+                  threading.Thread(target=self._run_stage, args=(self._ae_loop,), daemon=True)]
+        for stage in stages:
+            stage.start()
+        try:
+            if self.display:
+                timer = threading.Timer(duration, self.stop) if duration else None
+                if timer is not None:
+                    timer.start()
+                self._display_loop()
+                if timer is not None:
+                    timer.cancel()
+            else:
+                self.stop_event.wait(duration)
+        finally:
+            self.stop()
+            for stage in stages:
+                stage.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.report()
+
+    def report(self):
+        lines = [f"[INFO] Captured {self.frame_count} frames, AE skipped {self.ae_slot.dropped} stale frames, "
+                 f"display skipped {self.display_slot.dropped}"]
+        for stats in (self.wait_stats, self.ae_stats, self.display_stats, self.log_stats, self.apply_stats):
+            lines.append("[INFO] " + stats.summary())
+        print("\n".join(lines))
+        return lines
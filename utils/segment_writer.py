@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import struct
+import threading
+import collections
+from pathlib import Path
+import numpy as np
+
+from utils.index_writer import FRAME_TABLE_DTYPE
+
+# Buffered recording path instead of librealsense's own data.bag writer. The
+# capture loop copies each frame into a preallocated slot of a bounded ring
+# and returns immediately; a writer thread drains the ring to disk. When the
+# disk stalls and the ring is full the drop policy decides which frame is
+# lost ("oldest" reuses the oldest queued slot, "newest" rejects the
+# incoming frame), so wait_for_frames is never blocked by IO. Every drop is
+# counted and fill level and throughput are exposed through stats().
+#
+# On disk the recording is a directory of segments, rotated by size or age:
+#
+#   segments.json         segment list with frame counts and time ranges
+#   segment_000000.rsc    chunks of up to chunk_frames frames each
+#
+# A chunk is a CHUNK_HEADER (magic, frame count, color and depth shapes,
+# payload size), count FRAME_TABLE_DTYPE rows (timestamps, exposure, frame
+# numbers) and the raw color frames followed by the raw uint16 depth frames,
+# so read_segment() can memory-map every chunk without decoding anything.
+
+SEGMENT_INDEX = "segments.json"
+SEGMENT_SUFFIX = ".rsc"
+DROP_POLICIES = ("oldest", "newest")
+
+CHUNK_MAGIC = b"RSC1"
+CHUNK_HEADER = struct.Struct("<4sIIIIIIQ")
+
+
+class FrameRing:
+    # fixed number of preallocated frame slots, push() never blocks
+    def __init__(self, capacity=120, policy="oldest"):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        self.cond = threading.Condition()
+        self.color = None
+        self.depth = None
+        self.meta = np.zeros(capacity, dtype=FRAME_TABLE_DTYPE)
+        self.free = collections.deque(range(capacity))
+        self.filled = collections.deque()
+        self.closed = False
+        self.pushed = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def _allocate(self, color_image, depth_image):
+        self.color = np.empty((self.capacity,) + color_image.shape, dtype=np.uint8)
+        if depth_image is not None:
+            self.depth = np.empty((self.capacity,) + depth_image.shape, dtype=np.uint16)
+
+    def push(self, color_image, depth_image, timestamp, sensor_timestamp, exposure, frame_number):
+        # False when the frame was dropped
+        with self.cond:
+            if self.closed:
+                return False
+            if self.color is None:
+                self._allocate(color_image, depth_image)
+            self.pushed += 1
+            if self.free:
+                slot = self.free.popleft()
+            elif self.policy == "oldest" and self.filled:
+                slot = self.filled.popleft()
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return False
+            np.copyto(self.color[slot], color_image)
+            if self.depth is not None:
+                np.copyto(self.depth[slot], depth_image)
+            self.meta[slot] = (timestamp, sensor_timestamp, exposure, frame_number)
+            self.filled.append(slot)
+            self.high_water = max(self.high_water, len(self.filled))
+            self.cond.notify()
+            return True
+
+    def take(self, max_count, timeout=None):
+        # claims up to max_count queued slots in frame order, empty at the end
+        with self.cond:
+            if not self.filled and not self.closed:
+                self.cond.wait(timeout)
+            slots = []
+            while self.filled and len(slots) < max_count:
+                slots.append(self.filled.popleft())
+            return slots
+
+    def release(self, slots):
+        with self.cond:
+            self.free.extend(slots)
+
+    def fill(self):
+        with self.cond:
+            return len(self.filled) / self.capacity
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class SegmentWriter:
+    def __init__(self, output_dir, capacity=120, policy="oldest", chunk_frames=8,
+                 max_segment_bytes=1 << 30, max_segment_sec=60., buffer_size=1 << 22, telemetry=None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.ring = FrameRing(capacity, policy)
+        self.chunk_frames = chunk_frames
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_sec = max_segment_sec
+        self.buffer_size = buffer_size
+        # ring fill and drops are mirrored into the CaptureTelemetry counters
+        self.telemetry = telemetry
+        self.segments = []
+        self.file = None
+        self.segment = None
+        self.written_frames = 0
+        self.written_bytes = 0
+        self.write_seconds = 0.
+        self.errors = []
+        # throughput over the last stats() interval
+        self.rate_time = time.perf_counter()
+        self.rate_bytes = 0
+        self.throughput = 0.
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def push(self, color_image, depth_image=None, timestamp=0., sensor_timestamp=np.nan, exposure=np.nan,
+             frame_number=-1):
+        # copies the frame into the ring, cheap enough for the capture thread
+        pushed = self.ring.push(color_image, depth_image, timestamp, sensor_timestamp, exposure, frame_number)
+        if self.telemetry is not None:
+            self.telemetry.set_counter("ring_fill", round(self.ring.fill(), 2))
+            self.telemetry.set_counter("ring_dropped", self.ring.dropped)
+        return pushed
+
+    def _open_segment(self, timestamp):
+        name = f"segment_{len(self.segments):06d}{SEGMENT_SUFFIX}"
+        self.file = open(self.output_dir / name, "wb", buffering=self.buffer_size)
+        self.segment = {"name": name, "frames": 0, "bytes": 0, "first_timestamp": float(timestamp),
+                        "last_timestamp": float(timestamp), "opened": time.monotonic()}
+        self.segments.append(self.segment)
+
+    def _close_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self._save_index()
+
+    def _save_index(self):
+        segments = [{k: v for k, v in s.items() if k != "opened"} for s in self.segments]
+        tmp_path = self.output_dir / (SEGMENT_INDEX + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"segments": segments, "frames": self.written_frames, "dropped": self.ring.dropped}, f,
+                      indent=2)
+        os.replace(tmp_path, self.output_dir / SEGMENT_INDEX)
+
+    def _write_chunk(self, slots):
+        ring = self.ring
+        meta = ring.meta[slots]
+        if self.file is not None and (self.segment["bytes"] >= self.max_segment_bytes or
+                                      time.monotonic() - self.segment["opened"] >= self.max_segment_sec):
+            self._close_segment()
+        if self.file is None:
+            self._open_segment(meta["timestamp"][0])
+
+        color_shape = ring.color.shape[1:]
+        depth_shape = ring.depth.shape[1:] if ring.depth is not None else (0, 0)
+        payload = len(slots) * (ring.color[0].nbytes + (ring.depth[0].nbytes if ring.depth is not None else 0))
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(slots), *color_shape, *depth_shape, payload))
+        self.file.write(meta.tobytes())
+        # straight from the ring slots, no staging copy
+        for slot in slots:
+            self.file.write(memoryview(ring.color[slot]).cast("B"))
+        if ring.depth is not None:
+            for slot in slots:
+                self.file.write(memoryview(ring.depth[slot]).cast("B"))
+
+        size = CHUNK_HEADER.size + meta.nbytes + payload
+        self.segment["frames"] += len(slots)
+        self.segment["bytes"] += size
+        self.segment["last_timestamp"] = float(meta["timestamp"][-1])
+        self.written_frames += len(slots)
+        self.written_bytes += size
+
+    def _writer_loop(self):
+        try:
+            while True:
+                slots = self.ring.take(self.chunk_frames, timeout=0.5)
+                if not slots:
+                    if self.ring.closed:
+                        break
+                    continue
+                start = time.perf_counter()
+                try:
+                    self._write_chunk(slots)
+                finally:
+                    self.ring.release(slots)
+                self.write_seconds += time.perf_counter() - start
+        except Exception as e:
+            # keep accepting (and dropping) frames, the capture loop must not block
+            self.errors.append(e)
+            print(f"[ERROR] Segment writer stopped: {e}")
+
+    def stats(self):
+        now = time.perf_counter()
+        if now - self.rate_time >= 1.:
+            self.throughput = (self.written_bytes - self.rate_bytes) / (now - self.rate_time)
+            self.rate_time, self.rate_bytes = now, self.written_bytes
+        return {"fill": self.ring.fill(), "high_water": self.ring.high_water / self.ring.capacity,
+                "pushed": self.ring.pushed, "dropped": self.ring.dropped, "written_frames": self.written_frames,
+                "written_mb": self.written_bytes / 1e6, "throughput_mb_s": self.throughput / 1e6,
+                "segments": len(self.segments)}
+
+    def overlay_lines(self):
+        stats = self.stats()
+        return [f"ring {stats['fill'] * 100:.0f}% write {stats['throughput_mb_s']:.1f} MB/s "
+                f"dropped {stats['dropped']}"]
+
+    def close(self):
+        self.ring.close()
+        self.thread.join()
+        self._close_segment()
+        if self.segments:
+            self._save_index()
+        stats = self.stats()
+        print(f"[INFO] Wrote {self.written_frames} frames ({stats['written_mb']:.1f} MB) in {len(self.segments)} "
+              f"segments, dropped {stats['dropped']} ({self.ring.policy} first), ring peak {stats['high_water'] * 100:.0f}%")
+        return stats
+
+
+def read_segment(path):
+    # yields (meta, color, depth or None) per chunk, arrays are memory-mapped views
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    offset = 0
+    while offset + CHUNK_HEADER.size <= len(data):
+        magic, count, height, width, channels, depth_height, depth_width, payload = \
+            CHUNK_HEADER.unpack_from(data, offset)
+        if magic != CHUNK_MAGIC:
+            raise ValueError(f"{path}: bad chunk at byte {offset}")
+        offset += CHUNK_HEADER.size
+        meta_size = count * FRAME_TABLE_DTYPE.itemsize
+        if offset + meta_size + payload > len(data):
+            # last chunk of an interrupted recording
+            break
+        meta = data[offset:offset + meta_size].view(FRAME_TABLE_DTYPE)
+        offset += meta_size
+        color_size = count * height * width * channels
+        color = data[offset:offset + color_size].reshape(count, height, width, channels)
+        depth = None
+        if depth_height:
+            depth = data[offset + color_size:offset + payload].view(np.uint16).reshape(count, depth_height, depth_width)
+        offset += payload
+        yield meta, color, depth
+
+
+def read_recording(output_dir):
+    # yields (meta row, color, depth or None) for every frame in segment order
+    for path in sorted(Path(output_dir).glob("segment_*" + SEGMENT_SUFFIX)):
+        for meta, color, depth in read_segment(path):
+            for i in range(len(meta)):
+                yield meta[i], color[i], depth[i] if depth is not None else None
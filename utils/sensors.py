@@ -0,0 +1,37 @@
+import pyrealsense2 as rs
+
+def find_sensors(device):
+    # check sensor
+    found_rgb = False
+    found_depth = False
+    found_imu = False
+    rgb_sensor_index = None
+    depth_sensor_index = None
+    imu_sensor_index = None
+    for i, s in enumerate(device.query_sensors()):
+        print("[INFO] Sensor name:", s)
+        if s.get_info(rs.camera_info.name) == 'RGB Camera':
+            found_rgb = True
+            rgb_sensor_index = i
+            print("[INFO] RGB camera sensor is sucessfully detected!")
+        if s.get_info(rs.camera_info.name) == 'Stereo Module':
+            found_depth = True
+            depth_sensor_index = i
+            print("[INFO] Depth camera sensor is sucessfully detected!")
+        if s.get_info(rs.camera_info.name) == 'Motion Module':
+            found_imu = True
+            imu_sensor_index = i
+            print("[INFO] Motion sensor is sucessfully detected!")
+        else:
+            pass
+    if not found_rgb:
+        print("[ERROR] Can't find RGB camera sensor!")
+        exit(0)
+    if not found_depth:
+        print("[ERROR] Can't find Depth camera sensor!")
+        exit(0)
+    if not found_imu:
+        print("[ERROR] Can't find motion sensor!")
+        exit(0)
+
+    return rgb_sensor_index, depth_sensor_index, imu_sensor_index
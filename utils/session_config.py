@@ -0,0 +1,224 @@
+import os
+import ast
+import copy
+import json
+import time
+import pyrealsense2 as rs
+
+from utils import device_profile
+from utils import segment_writer
+
+# Recording session configuration. Every recorder starts from its own
+# defaults (defaults() below), a JSON file given with --config overrides
+# them, and command line flags plus --set section.key=value pairs override
+# the file. The result selects the stream profiles, the AE parameters, the
+# output directory and which processing stages run live while recording and
+# which are deferred to extraction. The resolved configuration is saved as
+# session_config.json next to data.bag. --dry-run only checks the
+# configuration against the modes the connected device supports.
+#
+#   {"output":  {"root": "./bags", "name": "indoor_", "timestamp": true},
+#    "streams": {"depth": {"enabled": true, "width": 848, "height": 480, "fps": 90}},
+#    "stages":  {"align": "deferred", "preview": "off"}}
+
+CONFIG_FILE = "session_config.json"
+
+# stage -> allowed modes, "deferred" work is left to extract_bag.py
+STAGE_MODES = {"align": ("live", "deferred"),
+               "preview": ("live", "off")}
+
+STREAMS = {"color": rs.stream.color, "depth": rs.stream.depth}
+
+DEFAULTS = {
+    "output": {"root": "./bags", "name": "test_mbavo2_10ms_expo", "timestamp": True},
+    "streams": {"color": {"enabled": True, "width": 1280, "height": 720, "format": "bgr8", "fps": 15},
+                "depth": {"enabled": False, "width": 640, "height": 480, "format": "z16", "fps": 30}},
+    # initial_ms is where AE starts, color/depth are fixed exposures in 100 usec units
+    "exposure": {"initial_ms": 25, "color": 300, "depth": 300},
+    # None keeps the engine default, zones and max_step only apply to the adaptive engine
+    "ae": {"algorithm": "baseline", "target_brightness": 128, "metering": None, "stride": 2,
+           "deadband": None, "zones": "4x4", "max_step": 4.0},
+    "align": {"method": "rs"},
+    "stages": {"align": "live", "preview": "live"},
+    "preview": {"fps": 10, "scale": 1.0, "min_depth": 0.3, "max_depth": 5.0, "colormap": "jet"},
+    "record": {"format": "bag", "ring_frames": 120, "drop_policy": "oldest", "segment_mb": 1024,
+               "segment_sec": 60},
+}
+
+
+def defaults(**sections):
+    # DEFAULTS with some keys changed, e.g. defaults(streams={"depth": {"enabled": True}})
+    data = copy.deepcopy(DEFAULTS)
+    merge(data, sections)
+    return data
+
+
+def merge(data, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(data.get(key), dict):
+            merge(data[key], value)
+        else:
+            data[key] = value
+    return data
+
+
+def parse_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+class SessionConfig:
+    def __init__(self, data):
+        self.data = data
+        self.dir = None
+
+    def __getitem__(self, section):
+        return self.data[section]
+
+    def set(self, path, value):
+        # path like "streams.depth.fps", only keys that exist can be set
+        section = self.data
+        keys = path.split(".")
+        for key in keys[:-1]:
+            if not isinstance(section.get(key), dict):
+                raise KeyError(f"Unknown session setting: {path}")
+            section = section[key]
+        if keys[-1] not in section:
+            raise KeyError(f"Unknown session setting: {path}")
+        section[keys[-1]] = value
+
+    def stream(self, name):
+        # (rs.stream, width, height, rs.format, fps) like enable_stream takes, None when disabled
+        s = self.data["streams"][name]
+        if not s["enabled"]:
+            return None
+        return STREAMS[name], s["width"], s["height"], getattr(rs.format, s["format"]), s["fps"]
+
+    def streams(self):
+        return [stream for stream in (self.stream(name) for name in STREAMS) if stream is not None]
+
+    def live(self, stage):
+        return self.data["stages"][stage] == "live"
+
+    def work_dir(self):
+        # resolved once per session, e.g. ./bags/test_mbavo2_10ms_expo20240101-120000
+        if self.dir is None:
+            output = self.data["output"]
+            name = output["name"] + (time.strftime("%Y%m%d-%H%M%S") if output["timestamp"] else "")
+            self.dir = os.path.expanduser(os.path.join(output["root"], name))
+        return self.dir
+
+    def errors(self):
+        # problems that need no device
+        errors = []
+        for stage, mode in self.data["stages"].items():
+            if mode not in STAGE_MODES.get(stage, ()):
+                errors.append(f"stages.{stage} must be one of {STAGE_MODES.get(stage, ())}, not {mode!r}")
+        for name, s in self.data["streams"].items():
+            if name not in STREAMS:
+                errors.append(f"Unknown stream {name}")
+            elif s["enabled"] and not hasattr(rs.format, str(s["format"])):
+                errors.append(f"streams.{name}.format {s['format']!r} is not a librealsense format")
+        if not self.data["streams"]["color"]["enabled"]:
+            errors.append("The color stream is required")
+        if self.data["record"]["format"] not in ("bag", "segments"):
+            errors.append(f"record.format must be bag or segments, not {self.data['record']['format']!r}")
+        if self.data["record"]["drop_policy"] not in segment_writer.DROP_POLICIES:
+            errors.append(f"record.drop_policy must be one of {segment_writer.DROP_POLICIES}, "
+                          f"not {self.data['record']['drop_policy']!r}")
+        return errors
+
+    def save(self, dir_path=None):
+        dir_path = dir_path if dir_path is not None else self.work_dir()
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, CONFIG_FILE), "w") as f:
+            json.dump(dict(self.data, work_dir=self.work_dir()), f, indent=2)
+
+
+def add_arguments(parser):
+    parser.add_argument("--config", type=str, help="Session configuration JSON, flags override it")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override one setting, e.g. --set streams.depth.fps=90 (repeatable)")
+    parser.add_argument("--output", type=str, help="Directory the session directory is created in")
+    parser.add_argument("--name", type=str, help="Session directory name, a timestamp is appended")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Check the configuration against the device and exit without recording")
+
+
+def from_args(args, base, flags):
+    # base defaults < --config file < flags that were given < --set; flags maps argument names to setting paths
+    data = copy.deepcopy(base)
+    if args.config:
+        with open(args.config) as f:
+            merge(data, json.load(f))
+    config = SessionConfig(data)
+    flags = dict(flags, output="output.root", name="output.name")
+    try:
+        for name, path in flags.items():
+            value = getattr(args, name, None)
+            if value is not None:
+                config.set(path, value)
+        for item in args.set:
+            path, sep, value = item.partition("=")
+            if not sep:
+                raise ValueError(f"--set needs KEY=VALUE, got {item!r}")
+            config.set(path.strip(), parse_value(value.strip()))
+    except (KeyError, ValueError) as e:
+        raise SystemExit(f"[ERROR] {e.args[0]}")
+    return config
+
+
+def check_device(config, device, refresh=False):
+    # dry run: every enabled stream and the exposures against what the device reports
+    errors = []
+    profile, device_sensors = device_profile.load_device_profile(device, [], refresh=refresh)
+    sensors = {"color": device_sensors[profile.rgb_index], "depth": device_sensors[profile.depth_index]}
+    for name in STREAMS:
+        stream = config.stream(name)
+        if stream is None:
+            continue
+        try:
+            device_profile.find_stream_profile(sensors[name], *stream)
+            print(f"[INFO] {device_profile.stream_key(*stream)} is supported")
+        except ValueError as e:
+            errors.append(str(e))
+
+    exposure = config["exposure"]
+    checks = [("color", "rgb", exposure["initial_ms"] * 10, "exposure.initial_ms"),
+              ("color", "rgb", exposure["color"], "exposure.color")]
+    if config.stream("depth") is not None:
+        checks.append(("depth", "depth", exposure["depth"], "exposure.depth"))
+    for name, sensor, value, path in checks:
+        if config.stream(name) is None:
+            continue
+        r = profile.option_range(sensor, "exposure")
+        if not r.min <= value <= r.max:
+            errors.append(f"{path} ({value}) is outside the {name} exposure range {r.min}-{r.max}")
+    color_fps = config["streams"]["color"]["fps"]
+    if exposure["initial_ms"] >= 1e3 / color_fps:
+        errors.append(f"exposure.initial_ms ({exposure['initial_ms']}) does not fit a {color_fps} fps frame")
+
+    # the combination has to resolve too, e.g. USB 2 links do not carry every pair of modes
+    if not errors:
+        rs_config = rs.config()
+        rs_config.enable_device(profile.serial)
+        for stream in config.streams():
+            rs_config.enable_stream(*stream)
+        if not rs_config.can_resolve(rs.pipeline_wrapper(rs.pipeline())):
+            errors.append("The device cannot stream these profiles together")
+    return errors
+
+
+def dry_run(config, device=None, refresh=False):
+    # prints the resolved configuration and the problems found, True when it can record
+    print(json.dumps(config.data, indent=2))
+    errors = config.errors()
+    if not errors and device is not None:
+        errors = check_device(config, device, refresh)
+    for error in errors:
+        print("[ERROR] " + error)
+    if not errors:
+        print(f"[INFO] Configuration is valid, the session would be recorded to {config.work_dir()}")
+    return not errors
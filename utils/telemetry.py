@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import threading
+import collections
+import contextlib
+import numpy as np
+
+# Capture health telemetry for the recorders. Every received color frame is
+# checked against the configured framerate: gaps in the frame counter and in
+# the sensor timestamps count as dropped frames, and the host arrival time is
+# compared with the sensor clock to see whether the loop falls behind real
+# time (frames piling up in the librealsense queue). Stage timings (wait, AE,
+# display, logging) are kept in rolling windows. A summary is rewritten every
+# summary_interval seconds, e.g. as telemetry.json next to data.bag, by a
+# writer thread so the capture loop never waits on the json dump.
+
+SUMMARY_FILE = "telemetry.json"
+
+
+class LatencyStats:
+    def __init__(self, name, window=1000):
+        self.name = name
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds * 1e3)
+            self.count += 1
+
+    def values(self):
+        with self.lock:
+            return np.array(self.samples, dtype=np.float64)
+
+    def stats(self):
+        # rolling percentiles in msec
+        samples = self.values()
+        if not samples.size:
+            return {"count": self.count}
+        p50, p95 = np.percentile(samples, [50, 95])
+        return {"count": self.count, "mean_ms": float(samples.mean()), "p50_ms": float(p50),
+                "p95_ms": float(p95), "max_ms": float(samples.max())}
+
+    def summary(self):
+        stats = self.stats()
+        if "p50_ms" not in stats:
+            return f"{self.name}: no samples"
+        return (f"{self.name}: n={self.count} p50={stats['p50_ms']:.2f} ms p95={stats['p95_ms']:.2f} ms "
+                f"max={stats['max_ms']:.2f} ms")
+
+
+class CaptureTelemetry:
+    def __init__(self, framerate, summary_path=None, summary_interval=5.0, window=300,
+                 max_lag=None, warn_interval=5.0, busy_stages=None):
+        self.framerate = framerate
+        self.period = 1. / framerate
+        self.summary_path = summary_path
+        self.summary_interval = summary_interval
+        # allowed host-vs-sensor lag before warning, default three frame periods
+        self.max_lag = max_lag if max_lag is not None else 3 * self.period
+        self.warn_interval = warn_interval
+        self.window = window
+        # stages that run one after the other in the capture loop, default all but "wait";
+        # stages on other threads (the concurrent recorder) do not add up
+        self.busy_stages = busy_stages
+
+        self.interval_stats = LatencyStats("frame interval", window)
+        self.lag_stats = LatencyStats("host lag", window)
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+        self.frames = 0
+        self.dropped_by_number = 0
+        self.dropped_by_timestamp = 0
+        self.dropped = 0
+        # drops within the last second of frames
+        self.recent_drops = collections.deque(maxlen=max(int(round(framerate)), 1))
+        self.behind_count = 0
+        self.last_number = None
+        self.last_timestamp = None
+        self.first_timestamp = None
+        self.min_offset = None
+        self.lag = 0.
+        self.start_time = time.monotonic()
+        self.last_summary = self.start_time
+        self.last_warning = 0.
+        self.summary_lock = threading.Lock()
+        self.summary_due = threading.Event()
+        self.summary_writer = None
+
+    def stage_stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            with self.lock:
+                stats = self.stages.setdefault(name, LatencyStats(name, self.window))
+        return stats
+
+    def add(self, name, seconds):
+        self.stage_stats(name).add(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def set_counter(self, name, value):
+        # externally tracked counts, e.g. frames skipped by a queue
+        self.counters[name] = value
+
+    def frame(self, frame_number, timestamp, arrival=None):
+        # frame_number from get_frame_number(), timestamp in seconds
+        arrival = time.perf_counter() if arrival is None else arrival
+        with self.lock:
+            self.frames += 1
+            gap_number = gap_time = 0
+            if self.last_number is not None and frame_number is not None:
+                gap_number = max(frame_number - self.last_number - 1, 0)
+            if self.last_timestamp is not None:
+                interval = timestamp - self.last_timestamp
+                self.interval_stats.add(interval)
+                gap_time = max(int(round(interval / self.period)) - 1, 0)
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            self.last_number = frame_number
+            self.last_timestamp = timestamp
+
+            self.dropped_by_number += gap_number
+            self.dropped_by_timestamp += gap_time
+            # either signal can miss drops (counter resets, timestamp jitter), count the larger one
+            drops = max(gap_number, gap_time)
+            self.dropped += drops
+            self.recent_drops.append(drops)
+
+            # a growing lag of the host clock behind the sensor clock means frames are queueing up,
+            # measured against the smallest offset seen so a slow first frame does not hide it
+            offset = arrival - (timestamp - self.first_timestamp)
+            if self.min_offset is None or offset < self.min_offset:
+                self.min_offset = offset
+            self.lag = offset - self.min_offset
+            self.lag_stats.add(self.lag)
+
+        now = time.monotonic()
+        self._check_behind(now)
+        if self.summary_path is not None and now - self.last_summary >= self.summary_interval:
+            self.last_summary = now
+            self._request_summary()
+
+    def _request_summary(self):
+        if self.summary_writer is None:
+            self.summary_writer = threading.Thread(target=self._summary_loop, daemon=True)
+            self.summary_writer.start()
+        self.summary_due.set()
+
+    def _summary_loop(self):
+        while True:
+            self.summary_due.wait()
+            self.summary_due.clear()
+            try:
+                self.write_summary()
+            except OSError as e:
+                print(f"[ERROR] Could not write {self.summary_path}: {e}")
+
+    def busy_time(self):
+        # rolling mean of the per-frame work outside of waiting for frames, msec
+        total = 0.
+        for name, stats in list(self.stages.items()):
+            if name == "wait" or (self.busy_stages is not None and name not in self.busy_stages):
+                continue
+            samples = stats.values()
+            if samples.size:
+                total += samples[-self.recent_drops.maxlen:].mean()
+        return total
+
+    def _check_behind(self, now):
+        reasons = []
+        if self.lag > self.max_lag:
+            reasons.append(f"{self.lag * 1e3:.0f} ms behind the sensor clock")
+        recent = sum(self.recent_drops)
+        if recent:
+            reasons.append(f"{recent} frames dropped in the last {len(self.recent_drops)}")
+        busy = self.busy_time()
+        if busy > self.period * 1e3:
+            reasons.append(f"{busy:.1f} ms of work per {self.period * 1e3:.1f} ms frame")
+        if not reasons:
+            return
+        self.behind_count += 1
+        if now - self.last_warning >= self.warn_interval:
+            self.last_warning = now
+            print("[WARNING] Capture loop is falling behind real time: " + ", ".join(reasons))
+
+    def fps(self):
+        samples = self.interval_stats.values()
+        if not samples.size:
+            return 0.
+        return 1e3 / float(np.median(samples))
+
+    def overlay_lines(self):
+        # short lines for the viewer overlay
+        lines = [f"fps {self.fps():.1f}/{self.framerate}  dropped {self.dropped}  lag {self.lag * 1e3:.0f} ms"]
+        stages = []
+        for name, stats in list(self.stages.items()):
+            values = stats.values()
+            if values.size:
+                stages.append(f"{name} {np.median(values):.1f}")
+        if stages:
+            lines.append("ms: " + "  ".join(stages))
+        return lines
+
+    def summary(self):
+        with self.lock:
+            summary = {"framerate": self.framerate,
+                       "elapsed_sec": time.monotonic() - self.start_time,
+                       "frames": self.frames,
+                       "dropped_frames": self.dropped,
+                       "dropped_by_frame_number": self.dropped_by_number,
+                       "dropped_by_timestamp": self.dropped_by_timestamp,
+                       "drop_rate": self.dropped / (self.frames + self.dropped) if self.frames else 0.,
+                       "measured_fps": self.fps(),
+                       "lag_ms": self.lag * 1e3,
+                       "behind_real_time_frames": self.behind_count,
+                       "frame_interval": self.interval_stats.stats(),
+                       "host_lag": self.lag_stats.stats()}
+        summary["stages"] = {name: stats.stats() for name, stats in list(self.stages.items())}
+        summary["counters"] = dict(self.counters)
+        return summary
+
+    def write_summary(self):
+        self.last_summary = time.monotonic()
+        summary = self.summary()
+        # report() writes the final summary on the caller's thread while the writer may be busy
+        with self.summary_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.summary_path)), exist_ok=True)
+            tmp_path = self.summary_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(summary, f, indent=2)
+            os.replace(tmp_path, self.summary_path)
+        return summary
+
+    def report(self):
+        summary = self.write_summary() if self.summary_path is not None else self.summary()
+        lines = [f"[INFO] {summary['frames']} frames at {summary['measured_fps']:.1f}/{self.framerate} fps, "
+                 f"{summary['dropped_frames']} dropped ({summary['drop_rate'] * 100:.2f}%), "
+                 f"behind real time on {summary['behind_real_time_frames']} frames"]
+        for stats in [self.interval_stats, self.lag_stats] + list(self.stages.values()):
+            lines.append("[INFO] " + stats.summary())
+        print("\n".join(lines))
+        return lines
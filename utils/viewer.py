@@ -1,25 +1,180 @@
+import time
 import cv2
+import numpy as np
 
-def visualizer(color_image, actual_exp_time, w_avg_bright, timestamps):
+from utils import buffer_pool
+
+EXPOSURE_WINDOW = 'RealSense D455 online stream'
+
+# colormaps for the depth preview, None is plain gray
+DEPTH_COLORMAPS = {"gray": None, "jet": cv2.COLORMAP_JET, "turbo": cv2.COLORMAP_TURBO,
+                   "inferno": cv2.COLORMAP_INFERNO, "bone": cv2.COLORMAP_BONE}
+
+
+class Viewer:
+    # Preview window for the recorders. The window is created once, frames
+    # are copied (or downscaled) into a reused buffer before the overlay is
+    # drawn, so the camera frame buffer that AE and the loggers read is never
+    # touched. show() only displays at preview_fps, independent of the
+    # capture rate, and headless viewers never call imshow/waitKey at all.
+    # Buffers come from (and go back to) a utils.buffer_pool pool.
+    def __init__(self, window_name=EXPOSURE_WINDOW, preview_fps=None, scale=1.0, headless=False, pool=None):
+        self.window_name = window_name
+        self.pool = pool if pool is not None else buffer_pool.default_pool
+        self.interval = 1. / preview_fps if preview_fps else 0.
+        self.scale = scale
+        self.headless = headless
+        self.buffer = None
+        self.window_created = False
+        self.last_show = None
+        self.shown = 0
+        self.skipped = 0
+
+    def due(self):
+        # whether the next show() will display, callers can skip preparing the image otherwise
+        if self.headless:
+            return False
+        return self.last_show is None or time.perf_counter() - self.last_show >= self.interval
+
+    def time_until_due(self):
+        if self.last_show is None:
+            return 0.
+        return max(self.interval - (time.perf_counter() - self.last_show), 0.)
+
+    def render(self, image):
+        # copy into the preview buffer, reallocated only when the frame size changes
+        height, width = image.shape[:2]
+        size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+        shape = (size[1], size[0]) + image.shape[2:]
+        if self.buffer is None or self.buffer.shape != shape or self.buffer.dtype != image.dtype:
+            self.pool.put(self.buffer)
+            self.buffer = self.pool.get(shape, image.dtype)
+        if self.scale == 1.0:
+            np.copyto(self.buffer, image)
+        else:
+            cv2.resize(image, size, dst=self.buffer, interpolation=cv2.INTER_AREA)
+        return self.buffer
+
+    def show(self, image, lines=(), font_scale=1.5, thickness=2, origin=(10, 30), copy=True):
+        # returns the waitKey code, -1 when nothing was displayed. copy=False draws
+        # straight onto image, for buffers the caller owns (e.g. DepthPreview.output)
+        if not self.due():
+            self.skipped += 1
+            return -1
+        self.last_show = time.perf_counter()
+        preview = self.render(image) if copy or self.scale != 1.0 else image
+        if lines:
+            draw_overlay(preview, lines, (int(origin[0] * self.scale), int(origin[1] * self.scale)),
+                         font_scale * self.scale, max(int(round(thickness * self.scale)), 1))
+        if not self.window_created:
+            cv2.namedWindow(self.window_name, cv2.WINDOW_AUTOSIZE)
+            self.window_created = True
+        cv2.imshow(self.window_name, preview)
+        self.shown += 1
+        return cv2.waitKey(1)
+
+    def show_exposure(self, color_image, actual_exp_time, w_avg_bright, timestamps, telemetry_lines=None):
+        lines = exposure_lines(actual_exp_time, w_avg_bright, timestamps)
+        if telemetry_lines:
+            # capture health from utils.telemetry
+            lines += [(text, (255, 255, 255)) for text in telemetry_lines]
+        return self.show(color_image, lines)
+
+    def close(self):
+        if self.window_created:
+            cv2.destroyWindow(self.window_name)
+            self.window_created = False
+
+
+class DepthPreview:
+    # Colorizes uint16 depth for display with one 65536-entry lookup table
+    # built for a fixed metric range, so the colors do not flicker with the
+    # per-frame min/max. The table holds packed BGRA words: a single np.take
+    # gathers every pixel and cvtColor drops the alpha straight into the right
+    # half of a preallocated side-by-side buffer, so render() allocates nothing.
+    def __init__(self, depth_scale, min_depth=0.3, max_depth=5.0, colormap="jet", pool=None):
+        self.pool = pool if pool is not None else buffer_pool.default_pool
+        self.depth_scale = depth_scale
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.lut = depth_lut(depth_scale, min_depth, max_depth, colormap)
+        self.depth_bgra = None
+        self.index = None
+        self.output = None
+
+    def colorize(self, depth_image, out=None):
+        # BGR image of depth_image, written to out when given
+        if self.depth_bgra is None or self.depth_bgra.shape[:2] != depth_image.shape:
+            self.pool.put(self.depth_bgra)
+            self.pool.put(self.index)
+            self.depth_bgra = self.pool.get(depth_image.shape + (4,), np.uint8)
+            self.index = self.pool.get(depth_image.shape, np.intp)
+        # np.take would allocate an intp copy of the indices on every call, reuse one instead;
+        # uint16 indices are always inside the table, clip skips the bounds check
+        np.copyto(self.index, depth_image)
+        np.take(self.lut, self.index, out=self.depth_bgra.view(np.uint32)[..., 0], mode="clip")
+        return cv2.cvtColor(self.depth_bgra, cv2.COLOR_BGRA2BGR, dst=out)
+
+    def render(self, color_image, depth_image):
+        # color | depth side by side in the reused output buffer, unaligned depth
+        # of another resolution is scaled to the color height
+        height, color_width = color_image.shape[:2]
+        depth_height, depth_width = depth_image.shape
+        if depth_height != height:
+            depth_width = int(round(depth_width * height / depth_height))
+        shape = (height, color_width + depth_width, 3)
+        if self.output is None or self.output.shape != shape:
+            self.pool.put(self.output)
+            self.output = self.pool.get(shape, np.uint8)
+        np.copyto(self.output[:, :color_width], color_image)
+        if depth_height == height:
+            self.colorize(depth_image, self.output[:, color_width:])
+        else:
+            cv2.resize(self.colorize(depth_image), (depth_width, height), dst=self.output[:, color_width:],
+                       interpolation=cv2.INTER_NEAREST)
+        return self.output
+
+
+def depth_lut(depth_scale, min_depth, max_depth, colormap="jet"):
+    # raw depth value -> packed BGRA color, zero (no depth) stays black
+    meters = np.arange(65536, dtype=np.float64) * depth_scale
+    index = np.clip((meters - min_depth) / (max_depth - min_depth), 0., 1.)
+    # valid depth uses entries 1..255 so the near end never looks like missing depth
+    index = (1 + np.round(index * 254)).astype(np.uint8)
+    ramp = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    if DEPTH_COLORMAPS[colormap] is None:
+        colors = cv2.cvtColor(ramp, cv2.COLOR_GRAY2BGR).reshape(256, 3)
+    else:
+        colors = cv2.applyColorMap(ramp, DEPTH_COLORMAPS[colormap]).reshape(256, 3)
+    lut = np.zeros((65536, 4), dtype=np.uint8)
+    lut[:, :3] = colors[index]
+    lut[0] = 0
+    return lut.view(np.uint32).ravel()
+
+
+def exposure_lines(actual_exp_time, w_avg_bright, timestamps):
+    return [(f'Actual exposure time: {(actual_exp_time / 10):.2f}', (0, 255, 0)),
+            (f'Weighted average brightness: {w_avg_bright:.2f}', (0, 0, 255)),
+            (f'color sensor timestamps: {timestamps}', (0, 255, 255))]
+
+
+def draw_overlay(image, lines, origin=(10, 30), font_scale=0.6, thickness=1, color=(255, 255, 255)):
+    # lines are strings or (string, color) pairs
     font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 1.5
-    thickness = 2
-    line_type = cv2.LINE_AA
-
-    text_1 = f'Actual exposure time: {(actual_exp_time / 10):.2f}'
-    position_1 = (10, 30)
-    font_color_1 = (0, 255, 0)  
-    cv2.putText(color_image, text_1, position_1, font, font_scale, font_color_1, thickness, line_type)
-    
-    text_2 = f'Weighted average brightness: {w_avg_bright:.2f}'
-    position_2 = (10, 70)  
-    font_color_2 = (0, 0, 255)  
-    cv2.putText(color_image, text_2, position_2, font, font_scale, font_color_2, thickness, line_type)
-
-    text_3 = f'color sensor timestamps: {timestamps}'
-    position_3 = (10, 110)  
-    font_color_3 = (0, 255, 255)  
-    cv2.putText(color_image, text_3, position_3, font, font_scale, font_color_3, thickness, line_type)
-    
-    cv2.namedWindow('RealSense D455 online stream', cv2.WINDOW_AUTOSIZE)
-    cv2.imshow('RealSense D455 online stream', color_image)
\ No newline at end of file
+    # 40 px apart at the original font scale of 1.5
+    line_height = int(font_scale * 20) + 10
+    x, y = origin
+    for i, text in enumerate(lines):
+        text, text_color = text if isinstance(text, tuple) else (text, color)
+        cv2.putText(image, text, (x, int(y + i * line_height)), font, font_scale, text_color, thickness, cv2.LINE_AA)
+
+
+_default_viewer = None
+
+
+def visualizer(color_image, actual_exp_time, w_avg_bright, timestamps, telemetry_lines=None):
+    # unthrottled preview with the original overlay, drawn on a copy of the frame
+    global _default_viewer
+    if _default_viewer is None:
+        _default_viewer = Viewer()
+    return _default_viewer.show_exposure(color_image, actual_exp_time, w_avg_bright, timestamps, telemetry_lines)
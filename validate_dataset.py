@@ -0,0 +1,337 @@
+import os
+import csv
+import json
+import time
+import struct
+import zipfile
+import argparse
+import concurrent.futures
+from pathlib import Path
+import numpy as np
+
+from utils import frame_codec
+from utils import frame_archive
+from utils import index_writer
+from utils import checkpoint
+
+# Validates extracted sequences (folders with rgb.txt written by
+# extract_bag.py) in bulk. Index files are parsed into NumPy columns in one
+# pass and every timestamp check is an array operation, so the cost per
+# sequence is dominated by the image checks. Those only read the file
+# headers (plus the PNG trailer or the PNM size) from a thread pool, and
+# sequences are spread over worker processes. The result is one JSON report
+# with per-sequence timestamp statistics, color/depth skew, host/sensor clock
+# offset and drift, and every anomaly found, plus a CSV with a row per sequence.
+
+INDEX_FILES = ("depth.txt", "rgb.txt", "sensor_timestamp.txt", "exposure_time.txt")
+REPORT_FILE = "validation_report.json"
+REPORT_CSV = "validation_report.csv"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+
+
+def find_sequences(root):
+    # a directory with rgb.txt is a sequence, root itself included
+    root = Path(root)
+    return sorted(path.parent for path in root.rglob("rgb.txt"))
+
+
+def read_columns(path):
+    # "timestamp value" rows as a float64 timestamp column and a bytes value column
+    with open(path, "rb") as f:
+        data = f.read()
+    if b"#" in data:
+        data = b"\n".join(line for line in data.splitlines() if not line.startswith(b"#"))
+    tokens = data.split()
+    if len(tokens) % 2:
+        raise ValueError(f"{path} has a malformed row")
+    return np.array(tokens[0::2]).astype(np.float64), np.array(tokens[1::2])
+
+
+def timestamp_stats(timestamps, gap_factor):
+    # monotonicity, duplicates and gaps against the median frame period
+    stats = {"frames": int(len(timestamps)), "duration_sec": 0., "period_ms": None, "fps": None,
+             "non_monotonic": 0, "duplicates": 0, "gaps": 0, "missing_frames": 0, "max_gap_ms": 0.}
+    if len(timestamps) < 2:
+        return stats
+    diff = np.diff(timestamps)
+    forward = diff[diff > 0]
+    period = float(np.median(forward)) if len(forward) else 0.
+    stats.update(duration_sec=float(timestamps[-1] - timestamps[0]),
+                 non_monotonic=int(np.count_nonzero(diff < 0)),
+                 duplicates=int(np.count_nonzero(diff == 0)),
+                 max_gap_ms=float(diff.max() * 1e3))
+    if period > 0:
+        gaps = diff[diff > gap_factor * period]
+        stats.update(period_ms=period * 1e3, fps=1. / period, gaps=int(len(gaps)),
+                     missing_frames=int(np.round(gaps / period).sum() - len(gaps)))
+    return stats
+
+
+def nearest_skew(timestamps, reference):
+    # |t - nearest reference timestamp| for every t, reference sorted
+    i = np.clip(np.searchsorted(reference, timestamps), 1, len(reference) - 1)
+    return np.minimum(np.abs(timestamps - reference[i - 1]), np.abs(timestamps - reference[i]))
+
+
+def sync_stats(rgb_timestamps, depth_timestamps, sensor_timestamps, period):
+    stats = {}
+    if len(rgb_timestamps) and len(depth_timestamps) > 1:
+        skew = nearest_skew(rgb_timestamps, np.sort(depth_timestamps))
+        stats["depth_color_skew_ms"] = {"mean": float(skew.mean() * 1e3), "max": float(skew.max() * 1e3)}
+        if period:
+            stats["unmatched_color_frames"] = int(np.count_nonzero(skew > period / 2))
+    if sensor_timestamps is not None and len(sensor_timestamps) == len(rgb_timestamps) > 1:
+        # host (backend) clock minus sensor clock, its slope is the clock drift
+        offset = rgb_timestamps - sensor_timestamps
+        t = rgb_timestamps - rgb_timestamps[0]
+        slope = float(np.polyfit(t, offset, 1)[0]) if t[-1] > 0 else 0.
+        sensor_period = np.diff(sensor_timestamps)
+        stats["host_sensor_offset_ms"] = {"mean": float(offset.mean() * 1e3), "std": float(offset.std() * 1e3),
+                                          "min": float(offset.min() * 1e3), "max": float(offset.max() * 1e3)}
+        stats["drift_ppm"] = slope * 1e6
+        stats["sensor_jitter_ms"] = float(sensor_period.std() * 1e3)
+        stats["host_jitter_ms"] = float(np.diff(rgb_timestamps).std() * 1e3)
+    return stats
+
+
+def pnm_header(head):
+    # magic, width, height, maxval and the header length of a binary PGM/PPM
+    fields = []
+    i = 0
+    while len(fields) < 4 and i < len(head):
+        while i < len(head) and head[i:i + 1].isspace():
+            i += 1
+        if head[i:i + 1] == b"#":
+            while i < len(head) and head[i:i + 1] != b"\n":
+                i += 1
+            continue
+        start = i
+        while i < len(head) and not head[i:i + 1].isspace():
+            i += 1
+        fields.append(head[start:i])
+    if len(fields) < 4:
+        raise ValueError("short PNM header")
+    return fields[0], int(fields[1]), int(fields[2]), int(fields[3]), i + 1
+
+
+def check_image(path):
+    # header-only check, returns (error or None, format info)
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            head = f.read(64)
+            if head.startswith(PNG_SIGNATURE):
+                if len(head) < 26 or head[12:16] != b"IHDR":
+                    return "corrupt header", None
+                width, height = struct.unpack(">II", head[16:24])
+                # a complete PNG ends with the IEND chunk
+                f.seek(max(size - 12, 0))
+                if f.read(12)[4:8] != b"IEND":
+                    return "truncated", None
+                return None, ("png", width, height, head[24], head[25])
+            if head[:2] in (b"P5", b"P6"):
+                magic, width, height, maxval, header_size = pnm_header(head)
+                channels = 1 if magic == b"P5" else 3
+                if size != header_size + width * height * channels * (2 if maxval > 255 else 1):
+                    return "truncated", None
+                return None, ("pnm", width, height, channels, maxval)
+            if head[:4] in TIFF_SIGNATURES:
+                return None, ("tiff",)
+    except FileNotFoundError:
+        return "missing", None
+    except (OSError, ValueError) as e:
+        return f"unreadable: {e}", None
+    return "unknown format", None
+
+
+def check_chunk(path):
+    # the zip central directory is at the end of the file, a partial chunk has none
+    try:
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    except FileNotFoundError:
+        return "missing", None
+    except (OSError, zipfile.BadZipFile) as e:
+        return f"corrupt: {e}", None
+    if "depth.npy" not in names:
+        return "no depth array", None
+    return None, ("chunk",)
+
+
+def check_files(sequence_dir, names, threads, stride, chunked):
+    # returns counts and a few examples of missing or corrupt files
+    if chunked:
+        paths = sorted({sequence_dir / name.rsplit(":", 1)[0] for name in names})
+        check = check_chunk
+    else:
+        paths = [sequence_dir / name for name in names[::stride]]
+        check = check_image
+    result = {"checked": len(paths), "missing": 0, "corrupt": 0, "inconsistent": 0, "examples": []}
+    formats = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for path, (error, info) in zip(paths, executor.map(check, paths)):
+            if error is None:
+                # every image of a stream should share size and format, keyed by the stream folder
+                expected = formats.setdefault(path.parent.name, info)
+                if info == expected:
+                    continue
+                error = f"format {info} differs from {expected}"
+                result["inconsistent"] += 1
+            elif error == "missing":
+                result["missing"] += 1
+            else:
+                result["corrupt"] += 1
+            if len(result["examples"]) < 10:
+                result["examples"].append({"file": str(path.relative_to(sequence_dir)), "error": error})
+    return result
+
+
+def validate_sequence(sequence_dir, options):
+    # runs in a worker process, every problem ends up in the returned report
+    sequence_dir = Path(sequence_dir)
+    report = {"sequence": str(sequence_dir), "status": "ok", "errors": [], "warnings": []}
+    errors, warnings = report["errors"], report["warnings"]
+    try:
+        columns = {}
+        for name in INDEX_FILES:
+            if (sequence_dir / name).exists():
+                columns[name] = read_columns(sequence_dir / name)
+            elif name in ("depth.txt", "rgb.txt"):
+                errors.append(f"{name} is missing")
+        rows = {name: len(c[0]) for name, c in columns.items()}
+        report["rows"] = rows
+        if len(set(rows.values())) > 1:
+            errors.append(f"index files disagree on the frame count: {rows}")
+
+        rgb_timestamps, rgb_names = columns.get("rgb.txt", (np.zeros(0), np.zeros(0, dtype="S1")))
+        depth_timestamps, depth_names = columns.get("depth.txt", (np.zeros(0), np.zeros(0, dtype="S1")))
+        stats = timestamp_stats(rgb_timestamps, options["gap_factor"])
+        report["timestamps"] = stats
+        report["frames"] = stats["frames"]
+        if stats["non_monotonic"]:
+            errors.append(f"{stats['non_monotonic']} color timestamps go backwards")
+        if stats["duplicates"]:
+            errors.append(f"{stats['duplicates']} duplicate color timestamps")
+        if stats["gaps"]:
+            warnings.append(f"{stats['gaps']} gaps, about {stats['missing_frames']} frames missing, "
+                            f"longest {stats['max_gap_ms']:.1f} ms")
+
+        sensor_timestamps = None
+        if "sensor_timestamp.txt" in columns:
+            host, sensor = columns["sensor_timestamp.txt"]
+            sensor_timestamps = sensor.astype(np.float64)
+            sensor_diff = np.diff(sensor_timestamps)
+            if np.count_nonzero(sensor_diff <= 0):
+                errors.append(f"{np.count_nonzero(sensor_diff <= 0)} sensor timestamps do not increase")
+            if len(host) == len(rgb_timestamps) and not np.array_equal(host, rgb_timestamps):
+                errors.append("sensor_timestamp.txt rows do not match rgb.txt")
+        report["sync"] = sync_stats(rgb_timestamps, depth_timestamps, sensor_timestamps,
+                                    stats["period_ms"] / 1e3 if stats["period_ms"] else None)
+        if report["sync"].get("unmatched_color_frames"):
+            warnings.append(f"{report['sync']['unmatched_color_frames']} color frames have no depth frame "
+                            f"within half a frame period")
+
+        if "exposure_time.txt" in columns:
+            exposures = columns["exposure_time.txt"][1].astype(np.float64)
+            report["exposure"] = {"min": float(exposures.min()), "max": float(exposures.max()),
+                                  "mean": float(exposures.mean())} if len(exposures) else {}
+            if np.count_nonzero(exposures <= 0):
+                warnings.append(f"{np.count_nonzero(exposures <= 0)} frames without exposure metadata")
+
+        # binary frame table and archive written next to the text indexes
+        if (sequence_dir / index_writer.FRAME_TABLE).exists():
+            table = index_writer.load_frame_table(sequence_dir, mmap=True)
+            if len(table) != len(rgb_timestamps) or not np.array_equal(table["timestamp"], rgb_timestamps):
+                warnings.append(f"{index_writer.FRAME_TABLE} does not match rgb.txt")
+        if (sequence_dir / frame_archive.ARCHIVE_DIR / "meta.json").exists():
+            with open(sequence_dir / frame_archive.ARCHIVE_DIR / "meta.json") as f:
+                count = json.load(f)["count"]
+            if count != len(rgb_timestamps):
+                warnings.append(f"archive holds {count} frames, rgb.txt {len(rgb_timestamps)}")
+        if (sequence_dir / checkpoint.MANIFEST_FILE).exists():
+            with open(sequence_dir / checkpoint.MANIFEST_FILE) as f:
+                if not json.load(f).get("complete"):
+                    warnings.append("extraction did not complete")
+
+        if options["check_files"]:
+            codec = {"codec": "png"}
+            if (sequence_dir / frame_codec.CODEC_FILE).exists():
+                with open(sequence_dir / frame_codec.CODEC_FILE) as f:
+                    codec = json.load(f)
+            names = [n.decode() for n in np.concatenate([rgb_names, depth_names])]
+            files = check_files(sequence_dir, names, options["threads"], options["file_stride"],
+                                codec["codec"] == "chunk")
+            report["files"] = files
+            for key in ("missing", "corrupt", "inconsistent"):
+                if files[key]:
+                    errors.append(f"{files[key]} {key} files")
+    except Exception as e:
+        errors.append(f"validation failed: {e!r}")
+
+    if errors:
+        report["status"] = "error"
+    elif warnings:
+        report["status"] = "warning"
+    return report
+
+
+def summary_row(report):
+    stats = report.get("timestamps", {})
+    sync = report.get("sync", {})
+    return [report["sequence"], report["status"], report.get("frames", 0), stats.get("fps"),
+            stats.get("gaps"), stats.get("missing_frames"), stats.get("non_monotonic"), stats.get("duplicates"),
+            sync.get("depth_color_skew_ms", {}).get("max"), sync.get("drift_ppm"),
+            report.get("files", {}).get("missing"), report.get("files", {}).get("corrupt"),
+            "; ".join(report["errors"] + report["warnings"])]
+
+
+def validate_dataset(sequences, options, jobs, output_dir):
+    print(f"[INFO] Validating {len(sequences)} sequences with {jobs} processes")
+    start_time = time.perf_counter()
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # small batches per task, thousands of tiny sequences would otherwise be dominated by IPC
+        for report in executor.map(validate_sequence, sequences, [options] * len(sequences),
+                                   chunksize=max(1, len(sequences) // (jobs * 8))):
+            reports.append(report)
+            if report["status"] == "error":
+                print(f"[ERROR] {report['sequence']}: {'; '.join(report['errors'])}")
+    elapsed = time.perf_counter() - start_time
+
+    counts = {status: sum(r["status"] == status for r in reports) for status in ("ok", "warning", "error")}
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / REPORT_FILE, "w") as f:
+        json.dump({"sequences": len(reports), "frames": sum(r.get("frames", 0) for r in reports),
+                   "elapsed_sec": elapsed, "options": options, **counts, "reports": reports}, f, indent=2)
+    with open(output_dir / REPORT_CSV, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sequence", "status", "frames", "fps", "gaps", "missing_frames", "non_monotonic",
+                         "duplicates", "max_skew_ms", "drift_ppm", "missing_files", "corrupt_files", "issues"])
+        writer.writerows(summary_row(r) for r in reports)
+    print(f"[INFO] {counts['ok']} ok, {counts['warning']} with warnings, {counts['error']} with errors "
+          f"in {elapsed:.1f} sec, report in {output_dir / REPORT_FILE}")
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check extracted sequences for timestamp anomalies, color/depth "
+                                                 "sync and missing or corrupt images.")
+    parser.add_argument("root", type=str, help="Extracted sequence, or a directory searched for sequences")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="Header check threads per worker")
+    parser.add_argument("--gap-factor", type=float, default=1.5,
+                        help="A step longer than this many median frame periods is a gap")
+    parser.add_argument("--no-files", action="store_true", help="Only check the indexes, not the images")
+    parser.add_argument("--file-stride", type=int, default=1, help="Check every n-th image only")
+    parser.add_argument("--output", type=str, help="Report directory (default: root)")
+    args = parser.parse_args()
+
+    sequences = find_sequences(args.root)
+    assert sequences, f"No extracted sequences found in {args.root}"
+    options = dict(gap_factor=args.gap_factor, check_files=not args.no_files, threads=args.threads,
+                   file_stride=max(1, args.file_stride))
+    reports = validate_dataset(sequences, options, args.jobs, args.output or args.root)
+    exit(1 if any(r["status"] == "error" for r in reports) else 0)